@@ -0,0 +1,143 @@
+# coding=utf-8
+"""
+Generator for synthetic G-code corpora resembling sliced prints.
+
+Each layer starts with a Z move, optionally resets E with G92, and consists of perimeters and infill made of
+extruding G1 moves, travel moves with retraction, occasional arcs and slicer comments. Multi-tool corpora switch
+tools with heat-up commands in between. Write a corpus to a file for use with other tools:
+
+    python benchmarks/gcode_corpus.py multi_tool --lines 100000 > multi_tool.gcode
+"""
+
+from __future__ import absolute_import, print_function
+
+__author__ = "Sven Lohrmann <malnvenshorn@gmail.com>"
+__license__ = "GNU Affero General Public License http://www.gnu.org/licenses/agpl.html"
+__copyright__ = "Copyright (C) 2017 Sven Lohrmann - Released under terms of the AGPLv3 License"
+
+import argparse
+import random
+import re
+
+# name -> keyword arguments of generate()
+PROFILES = dict(
+    single_absolute=dict(tools=1, relative=False),
+    single_relative=dict(tools=1, relative=True),
+    multi_tool=dict(tools=4, relative=False),
+    multi_tool_relative=dict(tools=4, relative=True),
+    large=dict(tools=2, relative=False, lines=1000000),
+)
+
+DEFAULT_LINES = 100000
+
+# same matching as OctoPrint's gcode_command_for_cmd
+REGEX_COMMAND = re.compile(r"^\s*(?:N\d+\s*)?((?P<codeGM>[GM]\d+)|(?P<codeT>T)\d+|(?P<codeF>F)\d+)")
+
+
+def generate(lines=DEFAULT_LINES, tools=1, relative=False, seed=0):
+    """
+    Returns a list of exactly ``lines`` G-code lines. The output only depends on the arguments, so results of
+    different runs are comparable.
+    """
+    rnd = random.Random(seed)
+    out = []
+
+    # line numbers and checksums are added by OctoPrint after the sending hooks, so they are never part of a corpus
+    def emit(line):
+        out.append(line)
+
+    emit("; generated by benchmarks/gcode_corpus.py")
+    emit("G21")
+    emit("G90")
+    emit("M83" if relative else "M82")
+    emit("G92 E0")
+
+    e = 0.0
+    z = 0.0
+    tool = 0
+    layer = 0
+    while len(out) < lines:
+        layer += 1
+        z += 0.2
+        emit(";LAYER:{layer}".format(layer=layer))
+        emit("G1 Z{z:.3f} F600".format(z=z))
+        if not relative and layer % 2 == 0:
+            # slicers commonly reset E every layer to keep the numbers small
+            emit("G92 E0")
+            e = 0.0
+
+        if tools > 1 and layer % 3 == 0:
+            tool = (tool + 1) % tools
+            emit("M104 T{tool} S215".format(tool=tool))
+            emit("T{tool}".format(tool=tool))
+            emit("M109 S215")
+            if not relative:
+                emit("G92 E0")
+                e = 0.0
+
+        for feature in ("WALL-OUTER", "WALL-INNER", "FILL"):
+            emit(";TYPE:{feature}".format(feature=feature))
+            x, y = rnd.uniform(50, 150), rnd.uniform(50, 150)
+            # retract, travel, unretract
+            e = retract(emit, e, relative, -0.8)
+            emit("G0 F7200 X{x:.3f} Y{y:.3f}".format(x=x, y=y))
+            e = retract(emit, e, relative, 0.8)
+            for _ in range(rnd.randint(20, 60)):
+                x += rnd.uniform(-5, 5)
+                y += rnd.uniform(-5, 5)
+                amount = rnd.uniform(0.01, 0.3)
+                e += amount
+                value = amount if relative else e
+                kind = rnd.random()
+                if kind < 0.05:
+                    emit("G2 X{x:.3f} Y{y:.3f} I1.5 J0 E{e:.5f}".format(x=x, y=y, e=value))
+                elif kind < 0.1:
+                    emit("G1 X{x:.3f} Y{y:.3f} E{e:.5f} ; {feature}".format(x=x, y=y, e=value, feature=feature))
+                else:
+                    emit("G1 X{x:.3f} Y{y:.3f} E{e:.5f}".format(x=x, y=y, e=value))
+            if rnd.random() < 0.2:
+                emit("M106 S{speed}".format(speed=rnd.randint(0, 255)))
+
+    return out[:lines]
+
+
+def retract(emit, e, relative, amount):
+    e += amount
+    emit("G1 E{e:.5f} F2400".format(e=amount if relative else e))
+    return e
+
+
+def prepare(lines):
+    """
+    Converts raw lines into the (gcode, cmd) pairs passed to the sent hook. Like OctoPrint, comments are stripped
+    and empty lines are dropped before sending.
+    """
+    commands = []
+    for line in lines:
+        cmd = line.split(";", 1)[0].strip()
+        if not cmd:
+            continue
+        match = REGEX_COMMAND.search(cmd)
+        gcode = None
+        if match is not None:
+            gcode = match.group("codeGM") or match.group("codeT") or match.group("codeF")
+        commands.append((gcode, cmd))
+    return commands
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Synthetic G-code corpus generator")
+    parser.add_argument("profile", choices=sorted(PROFILES.keys()))
+    parser.add_argument("--lines", type=int, default=None)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    kwargs = dict(PROFILES[args.profile])
+    if args.lines is not None:
+        kwargs["lines"] = args.lines
+    for line in generate(seed=args.seed, **kwargs):
+        print(line)
+
+
+if __name__ == "__main__":
+    main()
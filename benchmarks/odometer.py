@@ -0,0 +1,201 @@
+# coding=utf-8
+"""
+Throughput benchmark for the code which runs on every sent line.
+
+Measures FilamentOdometer.parse, check_threshold and the complete gcode sent hook over the synthetic corpora of
+gcode_corpus.py. The headline numbers are lines per second and, where tracemalloc is available (python 3),
+the memory allocated per line. Results can be written as JSON and compared against a previous run:
+
+    python benchmarks/odometer.py --output results.json
+    python benchmarks/odometer.py --baseline results.json [--tolerance 0.1]
+
+The comparison exits with status 1 if the throughput of any case dropped by more than the tolerance. The hook
+case requires OctoPrint to be installed and is skipped otherwise.
+"""
+
+from __future__ import absolute_import, print_function
+
+__author__ = "Sven Lohrmann <malnvenshorn@gmail.com>"
+__license__ = "GNU Affero General Public License http://www.gnu.org/licenses/agpl.html"
+__copyright__ = "Copyright (C) 2017 Sven Lohrmann - Released under terms of the AGPLv3 License"
+
+import argparse
+import gc
+import json
+import os
+import platform
+import sys
+import time
+import types
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path.insert(0, ROOT)
+
+try:
+    import octoprint  # noqa: F401
+except ImportError:
+    # The package __init__ imports OctoPrint, the odometer only depends on the metrics module. An empty package
+    # module allows to import the odometer without running the __init__.
+    package = types.ModuleType("octoprint_filamentmanager")
+    package.__path__ = [os.path.join(ROOT, "octoprint_filamentmanager")]
+    sys.modules["octoprint_filamentmanager"] = package
+
+from gcode_corpus import PROFILES, DEFAULT_LINES, generate, prepare  # noqa: E402
+from octoprint_filamentmanager.odometer import FilamentOdometer  # noqa: E402
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+timer = getattr(time, "perf_counter", time.time)
+
+
+def parse_case(commands):
+    odometer = FilamentOdometer()
+
+    def run():
+        odometer.reset()
+        parse = odometer.parse
+        for gcode, cmd in commands:
+            parse(gcode, cmd)
+    return run
+
+
+def check_threshold_case(commands):
+    plugin = create_plugin()
+    if plugin is None:
+        return None
+    plugin.filamentOdometer.parse("T3", "T3")  # thresholds are checked for the current tool
+
+    def run():
+        check_threshold = plugin.check_threshold
+        for _ in commands:
+            check_threshold()
+    return run
+
+
+def hook_case(commands):
+    plugin = create_plugin()
+    if plugin is None:
+        return None
+
+    def run():
+        plugin.filamentOdometer.reset()
+        hook = plugin.filament_odometer
+        for gcode, cmd in commands:
+            hook(None, "sent", cmd, None, gcode)
+    return run
+
+
+def create_plugin():
+    try:
+        from octoprint_filamentmanager import FilamentManagerPlugin
+    except ImportError:
+        return None
+
+    plugin = FilamentManagerPlugin()
+    plugin.filamentOdometer = FilamentOdometer()
+    plugin.odometerEnabled = True
+    plugin.pauseEnabled = True
+    # high enough to never pause, so that every line runs the complete threshold check
+    plugin.pauseThresholds = dict(("tool%d" % tool, 1e12) for tool in range(4))
+    return plugin
+
+
+CASES = [
+    ("parse", parse_case),
+    ("check_threshold", check_threshold_case),
+    ("hook", hook_case),
+]
+
+
+def measure(run, lines, repeat):
+    run()  # warm up
+    best = None
+    for _ in range(repeat):
+        gc.collect()
+        start = timer()
+        run()
+        elapsed = timer() - start
+        best = elapsed if best is None else min(best, elapsed)
+    result = dict(lines_per_second=lines / best, us_per_line=best / lines * 1e6)
+
+    if tracemalloc is not None:
+        gc.collect()
+        tracemalloc.start()
+        before, _ = tracemalloc.get_traced_memory()
+        run()
+        after, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        # peak includes the temporary objects of every line which are alive at the same time, retained is what
+        # is still allocated after the run
+        result["peak_bytes_per_line"] = float(peak - before) / lines
+        result["retained_bytes_per_line"] = float(after - before) / lines
+    return result
+
+
+def compare(results, baseline, tolerance):
+    regressions = []
+    for key, result in sorted(results.items()):
+        if key not in baseline:
+            continue
+        old = baseline[key]["lines_per_second"]
+        new = result["lines_per_second"]
+        change = (new - old) / old
+        print("{:<40}{:>14.0f}{:>14.0f}{:>+10.1%}".format(key, old, new, change))
+        if change < -tolerance:
+            regressions.append(key)
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Odometer throughput benchmark")
+    parser.add_argument("--profiles", nargs="+", choices=sorted(PROFILES.keys()),
+                        default=sorted(PROFILES.keys()))
+    parser.add_argument("--lines", type=int, default=None, help="override the number of lines of all corpora")
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--output", help="write the results as JSON to this file")
+    parser.add_argument("--baseline", help="compare against the JSON results of a previous run")
+    parser.add_argument("--tolerance", type=float, default=0.1, help="allowed throughput drop, default 10%%")
+    args = parser.parse_args()
+
+    results = dict()
+    print("{:<40}{:>14}{:>12}{:>12}{:>12}".format("case", "lines/s", "µs/line", "peak B/l", "kept B/l"))
+    for profile in args.profiles:
+        kwargs = dict(PROFILES[profile])
+        kwargs.setdefault("lines", DEFAULT_LINES)
+        if args.lines is not None:
+            kwargs["lines"] = args.lines
+        commands = prepare(generate(**kwargs))
+
+        for name, case in CASES:
+            run = case(commands)
+            if run is None:
+                print("{:<40}skipped, OctoPrint is not installed".format(profile + "/" + name))
+                continue
+            key = profile + "/" + name
+            results[key] = result = measure(run, len(commands), args.repeat)
+            print("{:<40}{:>14.0f}{:>12.2f}{:>12}{:>12}".format(
+                key, result["lines_per_second"], result["us_per_line"],
+                "{:.1f}".format(result["peak_bytes_per_line"]) if "peak_bytes_per_line" in result else "-",
+                "{:.2f}".format(result["retained_bytes_per_line"]) if "retained_bytes_per_line" in result else "-"))
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(dict(python=platform.python_version(), machine=platform.machine(), results=results), f,
+                      indent=2, sort_keys=True)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)["results"]
+        print()
+        print("{:<40}{:>14}{:>14}{:>10}".format("case", "baseline/s", "current/s", "change"))
+        regressions = compare(results, baseline, args.tolerance)
+        if regressions:
+            print("Throughput regressed by more than {:.0%}: {}".format(args.tolerance, ", ".join(regressions)))
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,339 @@
+# coding=utf-8
+"""
+Concurrency soak harness for the REST API and the database layer.
+
+Drives the blueprint routes through Flask's test client from many threads against a file-backed SQLite database
+(or a local PostgreSQL instance with --postgres). The workload mixes:
+
+- pollers: conditional GETs of /spools, like browser tabs revalidating their cached list
+- editors: GET a spool, then increment its cost with a PATCH conditional on its ETag (412 on conflicts)
+- selectors: PATCH /selections/<tool>
+- an admin repeatedly exporting and importing the data
+- a printer finishing prints, i.e. updating the used filament of the selected spools
+
+At the end it reports latency percentiles per operation, status counts including 5xx, lost updates (successful
+cost increments that are missing from the final state), the wait time for the connection lock and the throughput:
+
+    python benchmarks/soak.py [--duration 60] [--pollers 50] [--editors 5]
+    python benchmarks/soak.py --postgres postgresql://localhost --name filamentmanager --user fm --password fm
+
+Requires OctoPrint to be installed. The plugin runs outside of OctoPrint, so the printer and the plugin manager
+are replaced by minimal stand-ins, and access control is disabled with a fixed admin identity.
+"""
+
+from __future__ import absolute_import, print_function
+
+__author__ = "Sven Lohrmann <malnvenshorn@gmail.com>"
+__license__ = "GNU Affero General Public License http://www.gnu.org/licenses/agpl.html"
+__copyright__ = "Copyright (C) 2017 Sven Lohrmann - Released under terms of the AGPLv3 License"
+
+import argparse
+import io
+import json
+import logging
+import os
+import random
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import zipfile
+from collections import defaultdict
+
+from backports import csv
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+timer = getattr(time, "perf_counter", time.time)
+
+URL_PREFIX = "/plugin/filamentmanager"
+CLIENT_ID = "soak"
+TOOLS = 2
+
+
+class Printer(object):
+
+    def is_printing(self):
+        return False
+
+    def set_temperature_offset(self, offsets):
+        pass
+
+
+class PrinterProfileManager(object):
+
+    def get_current_or_default(self):
+        return dict(extruder=dict(count=TOOLS))
+
+
+class PluginManager(object):
+
+    def __init__(self):
+        self.messages = 0
+
+    def send_plugin_message(self, identifier, data):
+        self.messages += 1
+
+
+class Stats(object):
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.latencies = defaultdict(list)
+        self.statuses = defaultdict(lambda: defaultdict(int))
+        self.increments = defaultdict(int)  # spool id -> successful cost increments
+
+    def record(self, operation, started, status):
+        latency = timer() - started
+        with self.lock:
+            self.latencies[operation].append(latency)
+            self.statuses[operation][status] += 1
+
+
+def create_plugin(workdir, db_config):
+    from octoprint.settings import settings
+    from octoprint.plugin import PluginSettings
+    from octoprint_filamentmanager import FilamentManagerPlugin
+    from octoprint_filamentmanager.data import FilamentManager
+    from octoprint_filamentmanager.odometer import FilamentOdometer
+
+    settings(init=True, basedir=workdir)
+
+    plugin = FilamentManagerPlugin()
+    plugin._identifier = "filamentmanager"
+    plugin._basefolder = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "octoprint_filamentmanager")
+    plugin._logger = logging.getLogger("soak.plugin")
+    plugin._settings = PluginSettings(settings(), plugin._identifier, defaults=plugin.get_settings_defaults())
+    plugin._printer = Printer()
+    plugin._printer_profile_manager = PrinterProfileManager()
+    plugin._plugin_manager = PluginManager()
+
+    plugin.client_id = CLIENT_ID
+    plugin.snapshotPath = os.path.join(workdir, "inventory.snapshot")
+    plugin.filamentOdometer = FilamentOdometer()
+    plugin.filamentManager = FilamentManager(db_config)
+    plugin.filamentManager.initialize()
+    if plugin.filamentManager.get_schema_version() is None:
+        plugin.filamentManager.set_schema_version(plugin.DB_VERSION)
+    return plugin
+
+
+def create_app(plugin):
+    from flask import Flask
+    from flask_login import LoginManager
+    from flask_principal import Principal, Identity, RoleNeed, UserNeed
+
+    app = Flask("soak")
+    app.config["TESTING"] = True
+    app.config["LOGIN_DISABLED"] = True
+    app.secret_key = "soak"
+    LoginManager().init_app(app)
+
+    principal = Principal(app, use_sessions=False)
+
+    @principal.identity_loader
+    def load_identity():
+        identity = Identity("soak")
+        identity.provides.add(UserNeed("soak"))
+        identity.provides.add(RoleNeed("user"))
+        identity.provides.add(RoleNeed("admin"))
+        return identity
+
+    app.register_blueprint(plugin.get_blueprint(), url_prefix=URL_PREFIX)
+    return app
+
+
+def populate(fm, num_spools):
+    profile = fm.create_profile(dict(vendor="Soak", material="PLA", density=1.24, diameter=1.75))
+    spools = []
+    for i in range(num_spools):
+        spools.append(fm.create_spool(dict(name="Spool %d" % i, cost=0, weight=1000, used=0, temp_offset=0,
+                                           profile=dict(id=profile["id"]))))
+    for tool in range(TOOLS):
+        fm.update_selection(tool, CLIENT_ID, dict(spool=dict(id=spools[tool]["id"])))
+    return spools
+
+
+def poller(client, stats, stop):
+    headers = dict()
+    while not stop.is_set():
+        started = timer()
+        response = client.get(URL_PREFIX + "/spools", headers=headers)
+        stats.record("poll", started, response.status_code)
+        if response.status_code == 200:
+            headers = {"If-None-Match": response.headers.get("ETag", ""),
+                       "If-Modified-Since": response.headers.get("Last-Modified", "")}
+        time.sleep(random.uniform(0.05, 0.2))
+
+
+def editor(client, stats, stop, spool_ids):
+    while not stop.is_set():
+        identifier = random.choice(spool_ids)
+        started = timer()
+        response = client.get(URL_PREFIX + "/spools/%d" % identifier)
+        stats.record("get_spool", started, response.status_code)
+        if response.status_code != 200:
+            continue
+
+        spool = json.loads(response.get_data(as_text=True))["spool"]
+        started = timer()
+        response = client.patch(URL_PREFIX + "/spools/%d" % identifier, content_type="application/json",
+                                headers={"If-Match": response.headers["ETag"]},
+                                data=json.dumps(dict(spool=dict(cost=spool["cost"] + 1))))
+        stats.record("patch_spool", started, response.status_code)
+        if response.status_code == 200:
+            with stats.lock:
+                stats.increments[identifier] += 1
+
+
+def selector(client, stats, stop, spool_ids):
+    while not stop.is_set():
+        tool = random.randrange(TOOLS)
+        body = dict(selection=dict(tool=tool, spool=dict(id=random.choice(spool_ids))))
+        started = timer()
+        response = client.patch(URL_PREFIX + "/selections/%d" % tool, content_type="application/json",
+                                data=json.dumps(body))
+        stats.record("patch_selection", started, response.status_code)
+        time.sleep(random.uniform(0.1, 0.5))
+
+
+def admin(client, stats, stop, workdir, import_ids):
+    while not stop.is_set():
+        started = timer()
+        response = client.get(URL_PREFIX + "/export")
+        stats.record("export", started, response.status_code)
+        if response.status_code != 200:
+            continue
+
+        # only spools which are not edited concurrently are imported, otherwise the import would overwrite the
+        # cost increments of the editors and show up as lost updates
+        archive = os.path.join(workdir, "import.zip")
+        with zipfile.ZipFile(io.BytesIO(response.get_data()), "r") as exported, \
+                zipfile.ZipFile(archive, "w") as filtered:
+            filtered.writestr("profiles.csv", exported.read("profiles.csv"))
+            rows = list(csv.reader(io.StringIO(exported.read("spools.csv").decode("utf-8"))))
+            output = io.StringIO()
+            csv.writer(output).writerows([rows[0]] + [row for row in rows[1:] if int(row[0]) in import_ids])
+            filtered.writestr("spools.csv", output.getvalue().encode("utf-8"))
+
+        started = timer()
+        response = client.post(URL_PREFIX + "/import", data={"file.path": archive, "file.name": "import.zip"})
+        stats.record("import", started, response.status_code)
+        time.sleep(random.uniform(0.5, 2))
+
+
+def printer(plugin, stats, stop):
+    while not stop.is_set():
+        time.sleep(random.uniform(0.5, 2))
+        plugin.filamentOdometer.reset()
+        for tool in range(TOOLS):
+            plugin.filamentOdometer.parse("T%d" % tool, "T%d" % tool)
+            plugin.filamentOdometer.parse("G1", "G1 X10 E%f" % random.uniform(100, 1000))
+        started = timer()
+        plugin.update_filament_usage()
+        stats.record("print_done", started, "ok")
+
+
+def percentile(values, fraction):
+    index = min(len(values) - 1, int(round(fraction * (len(values) - 1))))
+    return values[index]
+
+
+def report(stats, plugin, duration, spools):
+    from octoprint_filamentmanager.metrics import DB_LOCK_WAIT_SECONDS
+
+    print("{:<18}{:>8}{:>10}{:>10}{:>10}{:>10}  {}".format("operation", "count", "p50 ms", "p90 ms", "p99 ms",
+                                                          "max ms", "statuses"))
+    total = 0
+    errors = 0
+    for operation in sorted(stats.latencies):
+        values = sorted(stats.latencies[operation])
+        total += len(values)
+        statuses = stats.statuses[operation]
+        errors += sum(count for status, count in statuses.items() if isinstance(status, int) and status >= 500)
+        print("{:<18}{:>8}{:>10.1f}{:>10.1f}{:>10.1f}{:>10.1f}  {}".format(
+            operation, len(values), percentile(values, 0.5) * 1000, percentile(values, 0.9) * 1000,
+            percentile(values, 0.99) * 1000, values[-1] * 1000,
+            ", ".join("{}: {}".format(status, count) for status, count in sorted(statuses.items()))))
+
+    lock_wait = DB_LOCK_WAIT_SECONDS.labels()
+    acquisitions = sum(lock_wait.counts)
+    slow_waits = sum(lock_wait.counts[i] for i, bound in enumerate(lock_wait.buckets) if bound > 0.01) \
+        + lock_wait.counts[-1]
+
+    lost = 0
+    for spool in spools:
+        final = plugin.filamentManager.get_spool(spool["id"])
+        lost += max(0, stats.increments[spool["id"]] - int(final["cost"]))
+
+    print()
+    print("throughput:         {:.1f} operations/s".format(total / duration))
+    print("5xx responses:      {}".format(errors))
+    print("lost updates:       {}".format(lost))
+    print("lock acquisitions:  {} (mean wait {:.3f} ms, {} waited longer than 10 ms)".format(
+        acquisitions, lock_wait.sum / acquisitions * 1000 if acquisitions else 0, slow_waits))
+    print("client messages:    {}".format(plugin._plugin_manager.messages))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Concurrency soak harness")
+    parser.add_argument("--duration", type=float, default=60, help="seconds")
+    parser.add_argument("--pollers", type=int, default=50)
+    parser.add_argument("--editors", type=int, default=5)
+    parser.add_argument("--selectors", type=int, default=2)
+    parser.add_argument("--spools", type=int, default=20)
+    parser.add_argument("--group-commit", action="store_true", help="enable the group commit writer")
+    parser.add_argument("--postgres", metavar="URI", help="use a local PostgreSQL instead of SQLite")
+    parser.add_argument("--name", default="filamentmanager")
+    parser.add_argument("--user", default="")
+    parser.add_argument("--password", default="")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.ERROR)
+
+    workdir = tempfile.mkdtemp(prefix="filamentmanager-soak-")
+    if args.postgres:
+        db_config = dict(uri=args.postgres, name=args.name, user=args.user, password=args.password)
+    else:
+        db_config = dict(uri="sqlite:///" + os.path.join(workdir, "filament.db"))
+
+    try:
+        plugin = create_plugin(workdir, db_config)
+        if args.group_commit:
+            plugin.filamentManager.start_writer(0.01)
+        app = create_app(plugin)
+
+        spools = populate(plugin.filamentManager, args.spools)
+        import_spools = populate(plugin.filamentManager, 5)
+        spool_ids = [spool["id"] for spool in spools]
+        import_ids = set(spool["id"] for spool in import_spools)
+
+        stats = Stats()
+        stop = threading.Event()
+        workers = [(poller, (stats, stop))] * args.pollers \
+            + [(editor, (stats, stop, spool_ids))] * args.editors \
+            + [(selector, (stats, stop, spool_ids))] * args.selectors \
+            + [(admin, (stats, stop, workdir, import_ids))]
+
+        threads = [threading.Thread(target=func, args=(app.test_client(),) + func_args) for func, func_args in workers]
+        threads.append(threading.Thread(target=printer, args=(plugin, stats, stop)))
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+
+        started = timer()
+        time.sleep(args.duration)
+        stop.set()
+        for thread in threads:
+            thread.join()
+        duration = timer() - started
+
+        report(stats, plugin, duration, spools)
+        plugin.filamentManager.close()
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
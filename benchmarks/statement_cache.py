@@ -0,0 +1,103 @@
+# coding=utf-8
+"""
+Micro-benchmark for the prebuilt statements of FilamentManager.
+
+Compares the per-call CPU time of building a statement on every call (as done before the statements
+were prebuilt) with executing the prebuilt statement through the compiled cache, both against an
+in-memory SQLite database. Run it on the target machine, e.g. a Raspberry Pi:
+
+    python benchmarks/statement_cache.py [--iterations 2000]
+"""
+
+from __future__ import absolute_import, print_function
+
+__author__ = "Sven Lohrmann <malnvenshorn@gmail.com>"
+__license__ = "GNU Affero General Public License http://www.gnu.org/licenses/agpl.html"
+__copyright__ = "Copyright (C) 2017 Sven Lohrmann - Released under terms of the AGPLv3 License"
+
+import argparse
+import os
+import sys
+import time
+
+from sqlalchemy.sql import select, update
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from octoprint_filamentmanager.data import FilamentManager  # noqa: E402
+
+
+def setup(num_spools=50):
+    fm = FilamentManager(dict(uri="sqlite://"))
+    fm.initialize()
+    profile = fm.create_profile(dict(vendor="Vendor", material="PLA", density=1.24, diameter=1.75))
+    for i in range(num_spools):
+        spool = fm.create_spool(dict(name="Spool %d" % i, cost=20, weight=1000, used=0, temp_offset=0,
+                                     profile=dict(id=profile["id"])))
+    fm.update_selection(0, "benchmark", dict(spool=dict(id=spool["id"])))
+    return fm, spool
+
+
+def rebuilt_get_spool(fm, identifier):
+    with fm.lock, fm.conn.begin():
+        j = fm.spools.join(fm.profiles, fm.spools.c.profile_id == fm.profiles.c.id)
+        stmt = select([fm.spools, fm.profiles]).select_from(j).where(fm.spools.c.id == identifier)
+        return fm.conn.execute(stmt).fetchone()
+
+
+def rebuilt_get_selection(fm, identifier, client_id):
+    with fm.lock, fm.conn.begin():
+        j1 = fm.selections.join(fm.spools, fm.selections.c.spool_id == fm.spools.c.id)
+        j2 = j1.join(fm.profiles, fm.spools.c.profile_id == fm.profiles.c.id)
+        stmt = select([fm.selections, fm.spools, fm.profiles]).select_from(j2)\
+            .where((fm.selections.c.tool == identifier) & (fm.selections.c.client_id == client_id))
+        return fm.conn.execute(stmt).fetchone()
+
+
+def rebuilt_update_spool(fm, identifier, data):
+    with fm.lock, fm.conn.begin():
+        stmt = update(fm.spools).where(fm.spools.c.id == identifier)\
+            .values(name=data["name"], cost=data["cost"], weight=data["weight"], used=data["used"],
+                    temp_offset=data["temp_offset"], profile_id=data["profile"]["id"])
+        fm.conn.execute(stmt)
+
+
+def measure(func, iterations):
+    func()  # warm up
+    start = time.clock() if hasattr(time, "clock") else time.process_time()
+    for _ in range(iterations):
+        func()
+    end = time.clock() if hasattr(time, "clock") else time.process_time()
+    return (end - start) / iterations * 1e6  # µs per call
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Statement cache micro-benchmark")
+    parser.add_argument("--iterations", type=int, default=2000)
+    args = parser.parse_args()
+
+    fm, spool = setup()
+    # the rebuilt statements never hit the compiled cache, since every call creates a new statement object
+    cases = [
+        ("get_spool",
+         lambda: rebuilt_get_spool(fm, spool["id"]),
+         lambda: fm.get_spool(spool["id"])),
+        ("get_selection",
+         lambda: rebuilt_get_selection(fm, 0, "benchmark"),
+         lambda: fm.get_selection(0, "benchmark")),
+        ("update_spool",
+         lambda: rebuilt_update_spool(fm, spool["id"], spool),
+         lambda: fm.update_spool(spool["id"], spool)),
+    ]
+
+    print("{:<16}{:>14}{:>14}{:>14}".format("operation", "rebuilt µs", "prebuilt µs", "saved µs"))
+    for name, rebuilt, prebuilt in cases:
+        before = measure(rebuilt, args.iterations)
+        after = measure(prebuilt, args.iterations)
+        print("{:<16}{:>14.1f}{:>14.1f}{:>14.1f}".format(name, before, after, before - after))
+
+    fm.close()
+
+
+if __name__ == "__main__":
+    main()
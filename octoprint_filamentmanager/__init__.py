@@ -5,17 +5,26 @@ __author__ = "Sven Lohrmann <malnvenshorn@gmail.com>"
 __license__ = "GNU Affero General Public License http://www.gnu.org/licenses/agpl.html"
 __copyright__ = "Copyright (C) 2017 Sven Lohrmann - Released under terms of the AGPLv3 License"
 
+import os
+import time
+from datetime import timedelta
 from math import pi as PI
+from threading import Thread, Timer, Lock, Event
 
 import octoprint.plugin
+import octoprint.filemanager
+import octoprint.filemanager.util
 from octoprint.settings import valid_boolean_trues
 from octoprint.events import Events
-from octoprint.util import dict_merge
+from octoprint.util import dict_merge, RepeatedTimer
 from octoprint.util.version import is_octoprint_compatible
 
 from .api import FilamentManagerApi
 from .data import FilamentManager
-from .odometer import FilamentOdometer
+from .data.snapshot import InventorySnapshot, InventoryView
+from .odometer import FilamentOdometer, FirmwareOdometer, ExtrusionTracker
+from .preprocessor import FeatureMarkerStream, FEATURE_ATCOMMAND
+from .metrics import ODOMETER_HOOK_SECONDS, ODOMETER_HOOK_SAMPLE_RATE
 
 
 class FilamentManagerPlugin(FilamentManagerApi,
@@ -26,19 +35,51 @@ class FilamentManagerPlugin(FilamentManagerApi,
                             octoprint.plugin.TemplatePlugin,
                             octoprint.plugin.EventHandlerPlugin):
 
-    DB_VERSION = 3
+    DB_VERSION = 6
+
+    JOURNAL_KEY_RETENTION = 30  # days
+
+    SNAPSHOT_DELAY = 1  # s
+
+    # delay before connecting to the database again if it isn't available, doubled on every attempt
+    RECONNECT_DELAY = 5  # s
+    RECONNECT_MAX_DELAY = 300  # s
+
+    # usage telemetry is only published if the extruded length of any tool changed at least by this amount
+    USAGE_MIN_CHANGE = 1.0  # mm
 
     def __init__(self):
         self.client_id = None
         self.filamentManager = None
         self.filamentOdometer = None
+        self.extrusionTracker = None
+        self.positionTimer = None
+        self.usageTimer = None
+        self.usageSpools = dict()
+        self.publishedExtrusion = None
+        self.journal = None
         self.lastPrintState = None
+        self.shutdownEvent = Event()
+
+        self.snapshot = None
+        self.snapshotPath = None
+        self.snapshotLock = Lock()
+        self.snapshotTimer = None
+        self.inventoryView = None
+        self.inventorySubscribers = []
 
         self.odometerEnabled = False
         self.pauseEnabled = False
         self.pauseThresholds = dict()
+        # tool -> (spool id, profile id) of the selections the thresholds have been calculated for
+        self.thresholdSpools = dict()
+
+        # duration of the startup phases in ms, logged once the database has been initialized
+        self.startupTimes = dict()
 
     def initialize(self):
+        started = time.time()
+
         def get_client_id():
             client_id = self._settings.get(["database", "clientID"])
             if client_id is None:
@@ -49,25 +90,78 @@ class FilamentManagerPlugin(FilamentManagerApi,
 
         self.client_id = get_client_id()
 
-        self.filamentOdometer = FilamentOdometer()
-        self.filamentOdometer.set_g90_extruder(self._settings.getBoolean(["feature", "g90InfluencesExtruder"]))
+        self.filamentOdometer = self.create_odometer()
+        self.extrusionTracker = ExtrusionTracker()
 
         db_config = self._settings.get(["database"], merged=True)
         migrate_schema_version = False
 
         if db_config["useExternal"] not in valid_boolean_trues:
-            import os
             # set uri for internal sqlite database
             db_path = os.path.join(self.get_plugin_data_folder(), "filament.db")
             db_config["uri"] = "sqlite:///" + db_path
             migrate_schema_version = os.path.isfile(db_path)
+        else:
+            # usage and selection changes are written to a local journal first and replayed to the external
+            # database in the background, so that a slow or unreachable database doesn't block the event thread
+            from .data.journal import Journal
+
+            journal_path = os.path.join(self.get_plugin_data_folder(), "journal.db")
+            try:
+                self.journal = Journal(journal_path, self.apply_journal_entry, self.on_journal_entry_applied)
+            except Exception as e:
+                self._logger.error("Failed to open journal: {message}".format(message=str(e)))
 
+        # serve reads and pause thresholds from the last snapshot until the database is available
+        self.snapshotPath = os.path.join(self.get_plugin_data_folder(), "inventory.snapshot")
         try:
-            # initialize database
-            self.filamentManager = FilamentManager(db_config)
-            self.filamentManager.initialize()
+            self.snapshot = InventorySnapshot.load(self.snapshotPath)
+        except Exception as e:
+            self._logger.warn("Failed to load inventory snapshot: {message}".format(message=str(e)))
+        if self.snapshot is not None:
+            self.update_pause_thresholds()
+            self.publish_inventory(self.snapshot)
+
+        # connecting to a remote database may take a while, so we don't block OctoPrint's startup
+        init_thread = Thread(target=self.initialize_database, args=(db_config, migrate_schema_version),
+                             name="FilamentManagerInit")
+        init_thread.daemon = True
+        init_thread.start()
 
-            schema_version = self.filamentManager.get_schema_version()
+        self.startupTimes["initialize"] = (time.time() - started) * 1000
+
+    def initialize_database(self, db_config, migrate_schema_version):
+        started = time.time()
+        delay = self.RECONNECT_DELAY
+        while True:
+            try:
+                manager = self.open_database(db_config, migrate_schema_version, started)
+                break
+            except Exception as e:
+                self._logger.error("Failed to initialize database, retrying in {delay}s: {message}"
+                                   .format(delay=delay, message=str(e)))
+            if self.shutdownEvent.wait(delay):
+                return
+            delay = min(delay * 2, self.RECONNECT_MAX_DELAY)
+
+        # only published once the schema is initialized and migrated, the API and the journal expect it to be usable
+        self.filamentManager = manager
+        self.on_database_initialized()
+
+        self.startupTimes["database"] = (time.time() - started) * 1000
+        self._logger.info("Startup times: {times}".format(
+            times=", ".join("{phase} {ms:.0f}ms".format(phase=phase, ms=self.startupTimes[phase])
+                            for phase in ["load", "initialize", "connect", "schema", "database"]
+                            if phase in self.startupTimes)))
+
+    def open_database(self, db_config, migrate_schema_version, started):
+        manager = FilamentManager(db_config)
+        try:
+            self.startupTimes["connect"] = (time.time() - started) * 1000
+            manager.initialize()
+            self.startupTimes["schema"] = (time.time() - started) * 1000 - self.startupTimes["connect"]
+
+            schema_version = manager.get_schema_version()
 
             # migrate schema version to database if needed
             # since plugin version 0.5.0 the schema version will be expected in the database
@@ -83,26 +177,42 @@ class FilamentManagerPlugin(FilamentManagerApi,
                     # migrate schema version from config.yaml
                     schema_version = self._settings.getInt(["_db_version"])
                 self._logger.warn("No schema_id found in database, setting id to %s" % schema_version)
-                self.filamentManager.set_schema_version(schema_version)
+                manager.set_schema_version(schema_version)
 
             # migrate database schema if needed
             if schema_version is None:
                 # we assume the database is initialized the first time => we got the latest db scheme
-                self.filamentManager.set_schema_version(self.DB_VERSION)
+                manager.set_schema_version(self.DB_VERSION)
             elif schema_version < self.DB_VERSION:
                 # migrate existing database
-                self.migrate_database_schema(self.DB_VERSION, schema_version)
-                self.filamentManager.set_schema_version(self.DB_VERSION)
+                self.migrate_database_schema(manager, self.DB_VERSION, schema_version)
+                manager.set_schema_version(self.DB_VERSION)
                 self._logger.info("Updated database schema from version {old} to {new}"
                                   .format(old=schema_version, new=self.DB_VERSION))
-        except Exception as e:
-            self._logger.error("Failed to initialize database: {message}".format(message=str(e)))
 
-    def migrate_database_schema(self, target, current):
+            if manager.get_schema_fingerprint() != manager.schema_fingerprint:
+                # skips creating the schema on the next start
+                manager.set_schema_fingerprint()
+
+            if db_config["groupCommit"] in valid_boolean_trues:
+                # commit writes which arrive within the window in a single transaction
+                manager.start_writer(float(db_config["groupCommitWindow"]) / 1000)
+
+            if self.journal is not None:
+                manager.prune_journal_keys(timedelta(days=self.JOURNAL_KEY_RETENTION))
+        except Exception:
+            try:
+                manager.close()
+            except Exception as e:
+                self._logger.debug("Failed to close database connection: {message}".format(message=str(e)))
+            raise
+        return manager
+
+    def migrate_database_schema(self, manager, target, current):
         if current <= 1:
             # add temperature column
             sql = "ALTER TABLE spools ADD COLUMN temp_offset INTEGER NOT NULL DEFAULT 0;"
-            self.filamentManager.execute_script(sql)
+            manager.execute_script(sql)
 
         if current <= 2:
             # recreate tables except profiles and spools
@@ -114,20 +224,65 @@ class FilamentManagerPlugin(FilamentManagerApi,
                       DROP TRIGGER spools_onINSERT;
                       DROP TRIGGER spools_onUPDATE;
                       DROP TRIGGER spools_onDELETE; """
-            self.filamentManager.execute_script(sql)
-            self.filamentManager.initialize()
+            manager.execute_script(sql)
+            manager.initialize(force=True)
+
+        if current <= 3:
+            # add row versions for optimistic concurrency control
+            sql = """ ALTER TABLE profiles ADD COLUMN version INTEGER NOT NULL DEFAULT 1;
+                      ALTER TABLE spools ADD COLUMN version INTEGER NOT NULL DEFAULT 1; """
+            manager.execute_script(sql)
+
+        if current <= 4:
+            # add schema fingerprint
+            sql = "ALTER TABLE versioning ADD COLUMN fingerprint VARCHAR(40);"
+            manager.execute_script(sql)
+
+        if current <= 5:
+            # add external identifier of spools
+            sql = """ ALTER TABLE spools ADD COLUMN tag VARCHAR(255);
+                      CREATE UNIQUE INDEX spools_tag_idx ON spools (tag); """
+            manager.execute_script(sql)
 
     def on_after_startup(self):
+        # set temperature offsets for the selections of the snapshot, the database might not be available yet
+        if self.snapshot is not None and self.filamentManager is None:
+            try:
+                self.set_temp_offsets(self.snapshot.get_all_selections(self.client_id))
+            except Exception as e:
+                self._logger.error("Failed to set temperature offsets: {message}".format(message=str(e)))
+
+    def on_database_initialized(self):
         # subscribe to the notify channel so that we get notified if another client has altered the data
         # notify is not available if we are connected to the internal sqlite database
-        if self.filamentManager is not None and self.filamentManager.notify is not None:
+        if self.filamentManager.notify is not None:
             def notify(pid, channel, payload):
                 # ignore notifications triggered by our own connection
-                if pid != self.filamentManager.conn.connection.get_backend_pid():
-                    self.send_client_message("data_changed", data=dict(table=channel, action=payload))
-                    self.on_data_modified(channel, payload)
+                if pid == self.filamentManager.conn.connection.get_backend_pid():
+                    return
+                # the payload contains the ids of the modified rows, e.g. UPDATE:1,2
+                action, _, identifiers = payload.partition(":")
+                identifiers = identifiers.split(",") if identifiers else None
+                if channel == "selections" and identifiers is not None:
+                    # selections are identified by client and tool, e.g. UPDATE:<client_id>/0, only the
+                    # selections of this client affect it
+                    identifiers = [int(tool) for client_id, _, tool in (i.rpartition("/") for i in identifiers)
+                                   if client_id == self.client_id]
+                    if not identifiers:
+                        return
+                elif identifiers is not None:
+                    identifiers = [int(i) for i in identifiers]
+                # read the changes from the primary until the replica has caught up
+                self.filamentManager.mark_written()
+                self.send_client_message("data_changed", data=dict(table=channel, action=action))
+                self.on_data_modified(channel, action, identifiers)
             self.filamentManager.notify.subscribe(notify)
 
+        self.update_client_name()
+
+        # reconcile the snapshot with the database
+        self.save_snapshot()
+
         # initialize the pause thresholds
         self.update_pause_thresholds()
 
@@ -139,14 +294,144 @@ class FilamentManagerPlugin(FilamentManagerApi,
             self._logger.error("Failed to set temperature offsets: {message}".format(message=str(e)))
 
     def on_shutdown(self):
+        self.shutdownEvent.set()
+        if self.journal is not None:
+            self.journal.stop(timeout=5)
         if self.filamentManager is not None:
             self.filamentManager.close()
 
-    def on_data_modified(self, data, action):
-        if action.lower() == "update":
-            # if either profiles, spools or selections are updated
-            # we have to recalculate the pause thresholds
-            self.update_pause_thresholds()
+    def apply_journal_entry(self, key, operation, payload):
+        if self.filamentManager is None:
+            raise RuntimeError("Database is not available")
+        return self.filamentManager.apply_journal_entry(key, operation, payload)
+
+    def on_journal_entry_applied(self, operation, payload, selection):
+        if selection is None:
+            # entry had already been applied before
+            return
+
+        if operation == "usage":
+            if selection["spool"] is None:
+                self._logger.warn("No selected spool for tool{id}".format(id=payload["tool"]))
+                return
+            spool = selection["spool"]
+            self._logger.debug("Updated remaining filament on spool '{name}' to {remaining}g"
+                               .format(name=spool["name"], remaining=str(spool["weight"] - spool["used"])))
+            table = "spools"
+        else:
+            try:
+                self.set_temp_offsets([selection])
+            except Exception as e:
+                self._logger.error("Failed to set temperature offsets: {message}".format(message=str(e)))
+            table = "selections"
+
+        self.send_client_message("data_changed", data=dict(table=table, action="update"))
+        self.on_data_modified(table, "update",
+                              [spool["id"]] if table == "spools" else [selection["tool"]])
+
+    def on_data_modified(self, data, action, identifiers=None):
+        """
+        Called after rows of the given table have been modified. Identifiers are the ids of the modified rows, the
+        tools in case of selections, or None if they are unknown.
+        """
+        if action.lower() in ["update", "delete"] or data == "selections":
+            # if either profiles, spools or selections are updated or deleted, or a spool is selected for another
+            # tool, we have to recalculate the pause thresholds
+            self.update_pause_thresholds(data, identifiers)
+
+        self.schedule_snapshot()
+
+    def update_client_name(self):
+        name = self._settings.get(["database", "clientName"])
+        if not name or self.filamentManager is None:
+            return
+        try:
+            self.filamentManager.set_client_name(self.client_id, name)
+        except Exception as e:
+            self._logger.error("Failed to update client name: {message}".format(message=str(e)))
+
+    def schedule_snapshot(self):
+        # changes often come in bursts, so the snapshot is written once after a short delay
+        with self.snapshotLock:
+            if self.snapshotTimer is None:
+                self.snapshotTimer = Timer(self.SNAPSHOT_DELAY, self.save_snapshot)
+                self.snapshotTimer.daemon = True
+                self.snapshotTimer.start()
+
+    def save_snapshot(self):
+        with self.snapshotLock:
+            self.snapshotTimer = None
+
+        try:
+            snapshot = InventorySnapshot.from_inventory(self.filamentManager.get_inventory(self.client_id))
+            snapshot.save(self.snapshotPath)
+        except Exception as e:
+            self._logger.error("Failed to save inventory snapshot: {message}".format(message=str(e)))
+        else:
+            self.snapshot = snapshot
+            self.publish_inventory(snapshot)
+
+    def publish_inventory(self, snapshot):
+        # the view read by other plugins is replaced as a whole, so that readers never see a partial update
+        try:
+            self.inventoryView = InventoryView(snapshot, self.client_id)
+        except Exception as e:
+            self._logger.error("Failed to update inventory view: {message}".format(message=str(e)))
+            return
+
+        for callback in list(self.inventorySubscribers):
+            try:
+                callback()
+            except Exception as e:
+                self._logger.error("Failed to notify inventory subscriber: {message}".format(message=str(e)))
+
+    # helpers for other plugins, see __plugin_helpers__
+
+    def get_selections_snapshot(self):
+        """
+        Returns the selections of this instance as a tuple of read-only dicts with tool and spool.
+        """
+        view = self.inventoryView
+        return view.selections if view is not None else tuple()
+
+    def get_spool_snapshot(self, identifier):
+        """
+        Returns the spool with the given id as a read-only dict, including its remaining weight and length.
+        """
+        view = self.inventoryView
+        return view.spools.get(identifier) if view is not None else None
+
+    def get_remaining_snapshot(self, tool):
+        """
+        Returns the remaining weight (g) and length (mm) of the spool selected for the tool, None if there is none.
+        """
+        view = self.inventoryView
+        return view.remaining.get(tool) if view is not None else None
+
+    def subscribe_inventory(self, callback):
+        """
+        Registers a callback without arguments, which is called after the inventory has changed.
+        """
+        if callback not in self.inventorySubscribers:
+            self.inventorySubscribers.append(callback)
+
+    def unsubscribe_inventory(self, callback):
+        if callback in self.inventorySubscribers:
+            self.inventorySubscribers.remove(callback)
+
+    def read_inventory(self, method, *args, **kwargs):
+        # reads from the database and falls back to the snapshot if the database is not available
+        if self.filamentManager is not None:
+            try:
+                return getattr(self.filamentManager, method)(*args, **kwargs)
+            except Exception as e:
+                if self.snapshot is None:
+                    raise
+                self._logger.warn("Database read failed, serving data from snapshot: {message}"
+                                  .format(message=str(e)))
+        elif self.snapshot is None:
+            raise RuntimeError("Database is not available")
+        return getattr(self.snapshot, method)(*args, **kwargs)
 
     def send_client_message(self, message_type, data=None):
         self._plugin_manager.send_plugin_message(self._identifier, dict(type=message_type, data=data))
@@ -168,6 +453,11 @@ class FilamentManagerPlugin(FilamentManagerApi,
             enableWarning=True,
             autoPause=False,
             pauseThreshold=100,
+            odometerMode="parse",  # or "firmware" to sample the E position reported by the firmware
+            positionInterval=5,  # s
+            usageInterval=1,  # s, 0 disables the live usage telemetry
+            trackExtrusion=False,
+            markFeatureTypes=False,
             database=dict(
                 useExternal=False,
                 uri="postgresql://",
@@ -175,6 +465,11 @@ class FilamentManagerPlugin(FilamentManagerApi,
                 user="",
                 password="",
                 clientID=None,
+                clientName="",  # shown in the overview of all clients sharing the database
+                replicaUri="",
+                groupCommit=False,
+                groupCommitWindow=10,  # ms
+                slowQueryThreshold=500,  # ms, 0 disables the slow query log
             ),
             currencySymbol="€",
             confirmSpoolSelection=False,
@@ -188,8 +483,12 @@ class FilamentManagerPlugin(FilamentManagerApi,
     def on_settings_save(self, data):
         # before saving
         old_threshold = self._settings.getFloat(["pauseThreshold"])
+        old_client_name = self._settings.get(["database", "clientName"])
         octoprint.plugin.SettingsPlugin.on_settings_save(self, data)
 
+        if old_client_name != self._settings.get(["database", "clientName"]):
+            self.update_client_name()
+
         # after saving
         if old_threshold != self._settings.getFloat(["pauseThreshold"]):
             # if the threshold settings has been modified
@@ -223,6 +522,12 @@ class FilamentManagerPlugin(FilamentManagerApi,
     def on_event(self, event, payload):
         if event == Events.PRINTER_STATE_CHANGED:
             self.on_printer_state_changed(payload)
+        elif event == Events.PRINT_DONE:
+            self.save_job_usage("done", payload)
+        elif event == Events.PRINT_FAILED:
+            self.save_job_usage("failed", payload)
+        elif event == getattr(Events, "PRINT_CANCELLED", None):
+            self.save_job_usage("cancelled", payload)
 
     def on_printer_state_changed(self, payload):
         if payload['state_id'] == "PRINTING":
@@ -231,15 +536,24 @@ class FilamentManagerPlugin(FilamentManagerApi,
                 self.filamentOdometer.reset_extruded_length()
             else:
                 # starting new print
-                self.filamentOdometer.reset()
+                self.filamentOdometer = self.create_odometer()
+                if self._settings.getBoolean(["trackExtrusion"]):
+                    self.extrusionTracker.reset()
+                    self.filamentOdometer.set_tracker(self.extrusionTracker)
             self.odometerEnabled = self._settings.getBoolean(["enableOdometer"])
             self.pauseEnabled = self._settings.getBoolean(["autoPause"])
+            if self.odometerEnabled and isinstance(self.filamentOdometer, FirmwareOdometer):
+                self.start_position_polling()
+            if self.odometerEnabled:
+                self.start_usage_telemetry()
             self._logger.debug("Printer State: %s" % payload["state_string"])
             self._logger.debug("Odometer: %s" % ("On" if self.odometerEnabled else "Off"))
             self._logger.debug("AutoPause: %s" % ("On" if self.pauseEnabled and self.odometerEnabled else "Off"))
         elif self.lastPrintState == "PRINTING":
             # print state changed from printing => update filament usage
             self._logger.debug("Printer State: %s" % payload["state_string"])
+            self.stop_position_polling()
+            self.stop_usage_telemetry()
             if self.odometerEnabled:
                 self.odometerEnabled = False  # disabled because we don't want to track manual extrusion
                 self.update_filament_usage()
@@ -247,59 +561,202 @@ class FilamentManagerPlugin(FilamentManagerApi,
         # update last print state
         self.lastPrintState = payload['state_id']
 
+    def create_odometer(self):
+        if self._settings.get(["odometerMode"]) == "firmware":
+            odometer = FirmwareOdometer()
+        else:
+            odometer = FilamentOdometer()
+        odometer.set_g90_extruder(self._settings.getBoolean(["feature", "g90InfluencesExtruder"]))
+        return odometer
+
+    def start_position_polling(self):
+        self.stop_position_polling()
+        self.positionTimer = RepeatedTimer(self._settings.getFloat(["positionInterval"]), self.request_position,
+                                           run_first=True)
+        self.positionTimer.start()
+
+    def stop_position_polling(self):
+        if self.positionTimer is not None:
+            self.positionTimer.cancel()
+            self.positionTimer = None
+
+    def request_position(self):
+        # don't pile up requests while the firmware is busy
+        if self.filamentOdometer.pending_requests() < 2:
+            self._printer.commands("M114")
+
+    def start_usage_telemetry(self):
+        self.stop_usage_telemetry()
+        interval = self._settings.getFloat(["usageInterval"])
+        if not interval:
+            return
+
+        try:
+            selections = self.read_inventory("get_all_selections", self.client_id)
+        except Exception as e:
+            self._logger.error("Failed to fetch selected spools, usage telemetry will not be available: {message}"
+                               .format(message=str(e)))
+            return
+        self.usageSpools = dict((selection["tool"], selection["spool"]) for selection in selections
+                                if selection["spool"] is not None)
+        self.publishedExtrusion = None
+        self.usageTimer = RepeatedTimer(interval, self.publish_usage)
+        self.usageTimer.start()
+
+    def stop_usage_telemetry(self):
+        if self.usageTimer is not None:
+            self.usageTimer.cancel()
+            self.usageTimer = None
+            # the print has ended or paused, the spools are reloaded with the recorded usage
+            self.send_client_message("usage", data=None)
+
+    def publish_usage(self):
+        # Runs on the timer thread, so that the comm thread only updates the odometer. Lengths extruded between two
+        # runs are coalesced into one message, which is skipped if nothing changed noticeably.
+        extrusion = list(self.filamentOdometer.get_extrusion())
+        published = self.publishedExtrusion
+        if published is not None and len(published) == len(extrusion) \
+                and all(abs(length - old) < self.USAGE_MIN_CHANGE for length, old in zip(extrusion, published)):
+            return
+        self.publishedExtrusion = extrusion
+
+        tools = []
+        for tool, length in enumerate(extrusion):
+            usage = dict(tool=tool, length=length, weight=None, remaining_weight=None, remaining_length=None,
+                         remaining_percent=None)
+            spool = self.usageSpools.get(tool)
+            if spool is not None:
+                usage["weight"] = self.calculate_weight(length, spool["profile"])
+                usage["remaining_weight"] = spool["remaining_weight"] - usage["weight"]
+                if spool["remaining_length"] is not None:
+                    usage["remaining_length"] = spool["remaining_length"] - length
+                if spool["weight"]:
+                    usage["remaining_percent"] = usage["remaining_weight"] * 100 / spool["weight"]
+            tools.append(usage)
+        self.send_client_message("usage", data=dict(tools=tools))
+
+    @staticmethod
+    def calculate_weight(length, profile):
+        radius = profile["diameter"] / 2  # mm
+        volume = (length * PI * radius * radius) / 1000  # cm³
+        return volume * profile["density"]  # g
+
     def update_filament_usage(self):
         printer_profile = self._printer_profile_manager.get_current_or_default()
         extrusion = self.filamentOdometer.get_extrusion()
         numTools = min(printer_profile['extruder']['count'], len(extrusion))
 
-        def calculate_weight(length, profile):
-            radius = profile["diameter"] / 2  # mm
-            volume = (length * PI * radius * radius) / 1000  # cm³
-            return volume * profile["density"]  # g
+        if self.journal is not None:
+            # recorded locally, the replayer applies the usage to the external database
+            for tool in xrange(0, numTools):
+                self._logger.info("Filament used: {length} mm (tool{id})"
+                                  .format(length=str(extrusion[tool]), id=str(tool)))
+                if extrusion[tool] > 0:
+                    self.journal.append("usage", client_id=self.client_id, tool=tool, length=extrusion[tool],
+                                        recorded_at=time.time())
+            return
+
+        pending_updates = []
 
         for tool in xrange(0, numTools):
             self._logger.info("Filament used: {length} mm (tool{id})"
                               .format(length=str(extrusion[tool]), id=str(tool)))
 
+            if extrusion[tool] <= 0:
+                continue
+
+            try:
+                # the database adds the used weight to the selected spool, so that concurrent writes aren't lost
+                # with group commit enabled the updates of all tools are committed together
+                future = self.filamentManager.submit(self.filamentManager.debit_spool, self.client_id, tool,
+                                                     extrusion[tool])
+                pending_updates.append((tool, future))
+            except Exception as e:
+                self._logger.error("Failed to update filament on tool{id}: {message}"
+                                   .format(id=str(tool), message=str(e)))
+
+        updated_spools = []
+        for tool, future in pending_updates:
             try:
-                selection = self.filamentManager.get_selection(tool, self.client_id)
-                spool = selection["spool"]
-
-                if spool is None:
-                    # spool not found => skip
-                    self._logger.warn("No selected spool for tool{id}".format(id=tool))
-                    continue
-
-                # update spool
-                weight = calculate_weight(extrusion[tool], spool["profile"])
-                old_value = spool["weight"] - spool["used"]
-                spool["used"] += weight
-                new_value = spool["weight"] - spool["used"]
-
-                self.filamentManager.update_spool(spool["id"], spool)
-
-                # logging
-                spool_string = "{name} - {material} ({vendor})"
-                spool_string = spool_string.format(name=spool["name"], material=spool["profile"]["material"],
-                                                   vendor=spool["profile"]["vendor"])
-                self._logger.debug("Updated remaining filament on spool '{spool}' from {old}g to {new}g ({diff}g)"
-                                   .format(spool=spool_string, old=str(old_value), new=str(new_value),
-                                           diff=str(new_value - old_value)))
+                spool = future.result()["spool"]
             except Exception as e:
                 self._logger.error("Failed to update filament on tool{id}: {message}"
                                    .format(id=str(tool), message=str(e)))
+                continue
+
+            if spool is None:
+                # spool not found => skip
+                self._logger.warn("No selected spool for tool{id}".format(id=tool))
+                continue
+
+            updated_spools.append(spool["id"])
+
+            # logging
+            new_value = spool["weight"] - spool["used"]
+            old_value = new_value + self.calculate_weight(extrusion[tool], spool["profile"])
+            spool_string = "{name} - {material} ({vendor})"
+            spool_string = spool_string.format(name=spool["name"], material=spool["profile"]["material"],
+                                               vendor=spool["profile"]["vendor"])
+            self._logger.debug("Updated remaining filament on spool '{spool}' from {old}g to {new}g ({diff}g)"
+                               .format(spool=spool_string, old=str(old_value), new=str(new_value),
+                                       diff=str(new_value - old_value)))
 
         self.send_client_message("data_changed", data=dict(table="spools", action="update"))
-        self.on_data_modified("spools", "update")
+        self.on_data_modified("spools", "update", updated_spools)
+
+    def save_job_usage(self, status, payload):
+        tracker = self.filamentOdometer.tracker
+        if tracker is None or self.filamentManager is None:
+            return
+        # detach the tracker, so that a subsequent event of the same job doesn't record it again
+        self.filamentOdometer.set_tracker(None)
+
+        job = dict(client_id=self.client_id, status=status, extrusion=tracker.totals(),
+                   name=payload.get("name", ""), path=payload.get("path", payload.get("file", "")))
+        job.update(tracker.to_dict())
+        try:
+            self.filamentManager.create_job(job)
+        except Exception as e:
+            self._logger.error("Failed to save filament usage of the job: {message}".format(message=str(e)))
+            return
+        self.send_client_message("data_changed", data=dict(table="jobs", action="insert"))
 
     # Protocol hook
 
+    @ODOMETER_HOOK_SECONDS.sample_time(ODOMETER_HOOK_SAMPLE_RATE)
     def filament_odometer(self, comm_instance, phase, cmd, cmd_type, gcode, *args, **kwargs):
         if self.odometerEnabled:
             self.filamentOdometer.parse(gcode, cmd)
+            # in firmware mode the extruded length only changes with position reports
+            if self.pauseEnabled and self.positionTimer is None and self.check_threshold():
+                self._logger.info("Filament is running out, pausing print")
+                self._printer.pause_print()
+
+    def request_position_before_reset(self, comm_instance, phase, cmd, cmd_type, gcode, *args, **kwargs):
+        # in firmware mode a position report right before an E reset or tool change completes the current origin
+        if self.positionTimer is not None and gcode is not None \
+                and (gcode == "G92" and "E" in cmd or gcode.startswith("T")):
+            return ["M114", cmd]
+
+    def on_gcode_received(self, comm_instance, line, *args, **kwargs):
+        if self.positionTimer is not None and "E:" in line and self.filamentOdometer.parse_position(line):
             if self.pauseEnabled and self.check_threshold():
                 self._logger.info("Filament is running out, pausing print")
                 self._printer.pause_print()
+        return line
+
+    def on_atcommand_sending(self, comm_instance, phase, command, parameters, tags=None, *args, **kwargs):
+        if command == FEATURE_ATCOMMAND and self.filamentOdometer.tracker is not None:
+            self.filamentOdometer.tracker.set_feature(parameters.strip())
+
+    # Preprocessor hook
+
+    def mark_feature_types(self, path, file_object, *args, **kwargs):
+        if not self._settings.getBoolean(["markFeatureTypes"]) \
+                or not octoprint.filemanager.valid_file_type(path, type="gcode"):
+            return file_object
+        return octoprint.filemanager.util.StreamWrapper(file_object.filename,
+                                                        FeatureMarkerStream(file_object.stream()))
 
     def check_threshold(self):
         extrusion = self.filamentOdometer.get_extrusion()
@@ -307,32 +764,70 @@ class FilamentManagerPlugin(FilamentManagerApi,
         threshold = self.pauseThresholds.get("tool%s" % tool)
         return (threshold is not None and extrusion[tool] >= threshold)
 
-    def update_pause_thresholds(self):
-        def set_threshold(selection):
-            def threshold(spool):
-                radius = spool["profile"]["diameter"] / 2
-                volume = (spool["weight"] - spool["used"]) / spool["profile"]["density"]
-                length = (volume * 1000) / (PI * radius * radius)
-                return length - self._settings.getFloat(["pauseThreshold"])
+    def update_pause_thresholds(self, table=None, identifiers=None):
+        """
+        Recalculates the pause thresholds of all tools. If the ids of the modified rows of the table are known, only
+        the tools whose selected spool is affected are recalculated.
+        """
+        pause_threshold = self._settings.getFloat(["pauseThreshold"])
+
+        def set_threshold(thresholds, spools, selection):
+            # the remaining length is computed by the database, it is unknown without density and diameter
+            tool = selection["tool"]
+            spool = selection["spool"]
+            thresholds.pop("tool%s" % tool, None)
+            spools.pop(tool, None)
+            if spool is None:
+                return
+            spools[tool] = (spool["id"], spool["profile"]["id"])
+            if spool["remaining_length"] is None:
+                self._logger.warn("Remaining length unknown for tool{tool}, pause feature not available for "
+                                  "selected spool".format(tool=tool))
+                return
+            thresholds["tool%s" % tool] = spool["remaining_length"] - pause_threshold
+
+        if identifiers is not None:
+            identifiers = set(identifiers)
+            if table == "selections":
+                tools = identifiers
+            elif table in ["spools", "profiles"]:
+                index = 0 if table == "spools" else 1
+                tools = [tool for tool, ids in self.thresholdSpools.items() if ids[index] in identifiers]
+            else:
+                tools = []
 
+            # the copies are updated and swapped in, like the full recalculation below
+            thresholds = dict(self.pauseThresholds)
+            spools = dict(self.thresholdSpools)
             try:
-                spool = selection["spool"]
-                if spool is not None:
-                    self.pauseThresholds["tool%s" % selection["tool"]] = threshold(spool)
-            except ZeroDivisionError:
-                self._logger.warn("ZeroDivisionError while calculating pause threshold for tool{tool}, "
-                                  "pause feature not available for selected spool".format(tool=tool))
-
-        self.pauseThresholds = dict()
-
+                for tool in tools:
+                    set_threshold(thresholds, spools, self.read_inventory("get_selection", tool, self.client_id))
+            except Exception as e:
+                self._logger.error("Failed to fetch selected spools, pause feature will not be available: {message}"
+                                   .format(message=str(e)))
+                self.pauseThresholds = dict()
+                self.thresholdSpools = dict()
+            else:
+                self.pauseThresholds = thresholds
+                self.thresholdSpools = spools
+                if tools:
+                    self._logger.debug("Updated thresholds: {thresholds}"
+                                       .format(thresholds=str(self.pauseThresholds)))
+                return
+
+        # the new thresholds replace the old ones at once, they are read by the comm thread meanwhile
+        thresholds = dict()
+        spools = dict()
         try:
-            selections = self.filamentManager.get_all_selections(self.client_id)
+            selections = self.read_inventory("get_all_selections", self.client_id)
         except Exception as e:
             self._logger.error("Failed to fetch selected spools, pause feature will not be available: {message}"
                                .format(message=str(e)))
         else:
-            for s in selections:
-                set_threshold(s)
+            for selection in selections:
+                set_threshold(thresholds, spools, selection)
+        self.pauseThresholds = thresholds
+        self.thresholdSpools = spools
 
         self._logger.debug("Updated thresholds: {thresholds}".format(thresholds=str(self.pauseThresholds)))
 
@@ -358,10 +853,13 @@ class FilamentManagerPlugin(FilamentManagerApi,
 
 __plugin_name__ = "Filament Manager"
 
-__required_octoprint_version__ = ">=1.3.6"
+# the atcommand.sending hook used to attribute the extrusion to feature types was added in 1.3.7
+__required_octoprint_version__ = ">=1.3.7"
 
 
 def __plugin_load__():
+    started = time.time()
+
     if not is_octoprint_compatible(__required_octoprint_version__):
         import logging
         logger = logging.getLogger(__name__)
@@ -375,5 +873,20 @@ def __plugin_load__():
     global __plugin_hooks__
     __plugin_hooks__ = {
         "octoprint.plugin.softwareupdate.check_config": __plugin_implementation__.get_update_information,
-        "octoprint.comm.protocol.gcode.sent": __plugin_implementation__.filament_odometer
+        "octoprint.comm.protocol.gcode.sent": __plugin_implementation__.filament_odometer,
+        "octoprint.comm.protocol.gcode.queuing": __plugin_implementation__.request_position_before_reset,
+        "octoprint.comm.protocol.gcode.received": __plugin_implementation__.on_gcode_received,
+        "octoprint.comm.protocol.atcommand.sending": __plugin_implementation__.on_atcommand_sending,
+        "octoprint.filemanager.preprocessor": __plugin_implementation__.mark_feature_types
     }
+
+    global __plugin_helpers__
+    __plugin_helpers__ = dict(
+        get_selections=__plugin_implementation__.get_selections_snapshot,
+        get_spool=__plugin_implementation__.get_spool_snapshot,
+        get_remaining=__plugin_implementation__.get_remaining_snapshot,
+        subscribe=__plugin_implementation__.subscribe_inventory,
+        unsubscribe=__plugin_implementation__.unsubscribe_inventory,
+    )
+
+    __plugin_implementation__.startupTimes["load"] = (time.time() - started) * 1000
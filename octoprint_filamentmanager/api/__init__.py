@@ -8,22 +8,71 @@ __copyright__ = "Copyright (C) 2017 Sven Lohrmann - Released under terms of the
 import os
 import tempfile
 import shutil
-from datetime import datetime
+from datetime import datetime, date
 
-from flask import jsonify, request, make_response, Response
+from flask import jsonify, request, make_response, Response, g
 from werkzeug.exceptions import BadRequest
+from sqlalchemy.exc import IntegrityError
 
 import octoprint.plugin
 from octoprint.settings import valid_boolean_trues
 from octoprint.server import admin_permission
 from octoprint.server.util.flask import restricted_access, check_lastmodified, check_etag
-from octoprint.util import dict_merge
 
 from .util import *
+from ..data import FilamentManager, VersionConflictError, BatchError
+from ..data.writer import WriteTimeoutError
+from ..metrics import timer, REGISTRY, API_REQUEST_SECONDS
 
 
 class FilamentManagerApi(octoprint.plugin.BlueprintPlugin):
 
+    # seconds to wait for a journaled change to reach the database before answering with 202 Accepted
+    JOURNAL_TIMEOUT = 5
+
+    # upper bound of operations per batch, also keeps the IN lists below SQLite's limit of bound parameters
+    MAX_BATCH_SIZE = 500
+
+    # upper bound of spools returned per search request
+    MAX_SEARCH_LIMIT = 100
+
+    # columns the usage statistics can be grouped by
+    STATS_DIMENSIONS = ("material", "vendor", "client_id")
+
+    # added to the demand of spool recommendations if the request doesn't specify a margin
+    RECOMMEND_MARGIN = 0.1
+
+    # status codes of the reasons why a batch operation can't be applied
+    BATCH_ERROR_STATUS = dict(unknown=404, conflict=412, in_use=409, unknown_profile=400)
+    BATCH_ERROR_MESSAGE = dict(unknown="Unknown {entity}", conflict="{Entity} has been modified in the meantime",
+                               in_use="{Entity} is still in use", unknown_profile="Unknown profile")
+
+    def get_blueprint(self):
+        if hasattr(self, "_blueprint"):
+            return self._blueprint
+
+        blueprint = octoprint.plugin.BlueprintPlugin.get_blueprint(self)
+
+        @blueprint.before_request
+        def start_request_timer():
+            g.filamentmanager_request_started = timer()
+
+        @blueprint.after_request
+        def observe_request_duration(response):
+            started = getattr(g, "filamentmanager_request_started", None)
+            if started is not None and request.url_rule is not None:
+                endpoint = request.url_rule.endpoint.rsplit(".", 1)[-1]
+                API_REQUEST_SECONDS.labels(endpoint, response.status_code).observe(timer() - started)
+            return response
+
+        return blueprint
+
+    @octoprint.plugin.BlueprintPlugin.route("/metrics", methods=["GET"])
+    @restricted_access
+    def get_metrics(self):
+        # collected all the time, rendering only happens when being scraped
+        return Response(REGISTRY.render(), mimetype="text/plain; version=0.0.4")
+
     @octoprint.plugin.BlueprintPlugin.route("/profiles", methods=["GET"])
     def get_profiles_list(self):
         force = request.values.get("force", "false") in valid_boolean_trues
@@ -40,7 +89,7 @@ class FilamentManagerApi(octoprint.plugin.BlueprintPlugin):
             return make_response("Not Modified", 304)
 
         try:
-            all_profiles = self.filamentManager.get_all_profiles()
+            all_profiles = self.read_inventory("get_all_profiles")
             response = jsonify(dict(profiles=all_profiles))
             return add_revalidation_header_with_no_max_age(response, lm, etag)
         except Exception as e:
@@ -50,9 +99,11 @@ class FilamentManagerApi(octoprint.plugin.BlueprintPlugin):
     @octoprint.plugin.BlueprintPlugin.route("/profiles/<int:identifier>", methods=["GET"])
     def get_profile(self, identifier):
         try:
-            profile = self.filamentManager.get_profile(identifier)
+            profile = self.read_inventory("get_profile", identifier)
             if profile is not None:
-                return jsonify(dict(profile=profile))
+                response = jsonify(dict(profile=profile))
+                response.set_etag(version_tag(profile))
+                return response
             else:
                 self._logger.warn("Profile with id {id} does not exist".format(id=identifier))
                 return make_response("Unknown profile", 404)
@@ -83,6 +134,7 @@ class FilamentManagerApi(octoprint.plugin.BlueprintPlugin):
 
         try:
             saved_profile = self.filamentManager.create_profile(new_profile)
+            self.on_data_modified("profiles", "insert")
             return jsonify(dict(profile=saved_profile))
         except Exception as e:
             self._logger.error("Failed to create profile: {message}".format(message=str(e)))
@@ -103,44 +155,55 @@ class FilamentManagerApi(octoprint.plugin.BlueprintPlugin):
             return make_response("No profile included in request", 400)
 
         try:
-            profile = self.filamentManager.get_profile(identifier)
-        except Exception as e:
-            self._logger.error("Failed to fetch profile with id {id}: {message}"
-                               .format(id=str(identifier), message=str(e)))
-            return make_response("Failed to fetch profile, see the log for more details", 500)
-
-        if not profile:
-            self._logger.warn("Profile with id {id} does not exist".format(id=identifier))
-            return make_response("Unknown profile", 404)
-
-        updated_profile = json_data["profile"]
-        merged_profile = dict_merge(profile, updated_profile)
+            version = expected_version(request.if_match, identifier)
+        except ValueError:
+            return make_response("Profile has been modified in the meantime", 412)
 
         try:
-            saved_profile = self.filamentManager.update_profile(identifier, merged_profile)
+            saved_profile = self.filamentManager.update_profile(identifier, json_data["profile"], version=version)
+        except VersionConflictError:
+            return make_response("Profile has been modified in the meantime", 412)
         except Exception as e:
             self._logger.error("Failed to update profile with id {id}: {message}"
                                .format(id=str(identifier), message=str(e)))
             return make_response("Failed to update profile, see the log for more details", 500)
-        else:
-            self.on_data_modified("profiles", "update")
-            return jsonify(dict(profile=saved_profile))
+
+        if not saved_profile:
+            self._logger.warn("Profile with id {id} does not exist".format(id=identifier))
+            return make_response("Unknown profile", 404)
+
+        self.on_data_modified("profiles", "update", [identifier])
+        response = jsonify(dict(profile=saved_profile))
+        response.set_etag(version_tag(saved_profile))
+        return response
 
     @octoprint.plugin.BlueprintPlugin.route("/profiles/<int:identifier>", methods=["DELETE"])
     @restricted_access
     def delete_profile(self, identifier):
         try:
             self.filamentManager.delete_profile(identifier)
+            self.on_data_modified("profiles", "delete", [identifier])
             return make_response("", 204)
         except Exception as e:
             self._logger.error("Failed to delete profile with id {id}: {message}"
                                .format(id=str(identifier), message=str(e)))
             return make_response("Failed to delete profile, see the log for more details", 500)
 
+    @octoprint.plugin.BlueprintPlugin.route("/profiles/batch", methods=["POST"])
+    @restricted_access
+    def apply_profile_batch(self):
+        return self.apply_batch("profile", ["vendor", "material", "density", "diameter"],
+                                "apply_profile_batch")
+
     @octoprint.plugin.BlueprintPlugin.route("/spools", methods=["GET"])
     def get_spools_list(self):
         force = request.values.get("force", "false") in valid_boolean_trues
 
+        try:
+            query = parse_spool_query(request.values, FilamentManager.REMAINING_KEYS, FilamentManager.SPOOL_SORT_KEYS)
+        except ValueError as e:
+            return make_response(str(e), 400)
+
         try:
             lm = self.filamentManager.get_spools_lastmodified()
         except Exception as e:
@@ -153,19 +216,136 @@ class FilamentManagerApi(octoprint.plugin.BlueprintPlugin):
             return make_response("Not Modified", 304)
 
         try:
-            all_spools = self.filamentManager.get_all_spools()
-            response = jsonify(dict(spools=all_spools))
+            if query is not None:
+                response = jsonify(self.read_inventory("get_spools", **query))
+            elif request.values.get("format") == "normalized":
+                response = jsonify(self.read_inventory("get_all_spools_normalized"))
+            else:
+                all_spools = self.read_inventory("get_all_spools")
+                response = jsonify(dict(spools=all_spools))
             return add_revalidation_header_with_no_max_age(response, lm, etag)
         except Exception as e:
             self._logger.error("Failed to fetch spools: {message}".format(message=str(e)))
             return make_response("Failed to fetch spools, see the log for more details", 500)
 
+    @octoprint.plugin.BlueprintPlugin.route("/spools/search", methods=["GET"])
+    def search_spools(self):
+        query = request.values.get("q", "")
+        if not query.strip():
+            return make_response("No search query included in request", 400)
+
+        try:
+            limit = min(int(request.values.get("limit", 20)), self.MAX_SEARCH_LIMIT)
+            offset = int(request.values.get("offset", 0))
+        except ValueError:
+            return make_response("Limit and offset have to be numbers", 400)
+
+        if limit < 1 or offset < 0:
+            return make_response("Limit has to be positive and offset must not be negative", 400)
+
+        try:
+            result = self.filamentManager.search_spools(query, limit=limit, offset=offset)
+            return jsonify(result)
+        except Exception as e:
+            self._logger.error("Failed to search spools: {message}".format(message=str(e)))
+            return make_response("Failed to search spools, see the log for more details", 500)
+
+    @octoprint.plugin.BlueprintPlugin.route("/spools/recommend", methods=["POST"])
+    def recommend_spools(self):
+        if "application/json" not in request.headers["Content-Type"]:
+            return make_response("Expected content-type JSON", 400)
+
+        try:
+            json_data = request.json
+        except BadRequest:
+            return make_response("Malformed JSON body in request", 400)
+
+        try:
+            margin = float(json_data.get("margin", self.RECOMMEND_MARGIN))
+            limit = int(json_data.get("limit", 3))
+        except (TypeError, ValueError):
+            return make_response("Margin and limit have to be numbers", 400)
+
+        if margin < 0 or not 0 < limit <= self.MAX_SEARCH_LIMIT:
+            return make_response("Margin must not be negative and limit has to be between 1 and {}"
+                                 .format(self.MAX_SEARCH_LIMIT), 400)
+
+        # demands given per tool take precedence over the ones computed from the file
+        demands = dict()
+        for demand in json_data.get("tools") or []:
+            if not isinstance(demand, dict) or not isinstance(demand.get("tool"), int):
+                return make_response("Tool demand does not contain a valid 'tool' field", 400)
+            demands[demand["tool"]] = dict(demand)
+
+        if "file" in json_data:
+            file_data = json_data["file"] if isinstance(json_data["file"], dict) else dict()
+            try:
+                metadata = self._file_manager.get_metadata(file_data.get("origin", "local"), file_data.get("path"))
+            except Exception:
+                metadata = None
+            if metadata is None:
+                return make_response("Unknown file", 404)
+            filament = (metadata.get("analysis") or dict()).get("filament")
+            if not filament:
+                return make_response("File has not been analysed yet", 409)
+            for key, usage in filament.items():
+                if key.startswith("tool") and key[4:].isdigit() and (usage or dict()).get("length"):
+                    tool = int(key[4:])
+                    demands.setdefault(tool, dict(tool=tool)).setdefault("length", usage["length"])
+
+        for demand in demands.values():
+            amount = demand.get("length", demand.get("weight"))
+            if not isinstance(amount, (int, float)) or amount <= 0:
+                return make_response("Demand of tool{} does not contain a positive length or weight"
+                                     .format(demand["tool"]), 400)
+
+        try:
+            if any(demand.get("material") is None or demand.get("diameter") is None for demand in demands.values()):
+                # by default spools of the same material and diameter as the selected one are recommended
+                for selection in self.read_inventory("get_all_selections", self.client_id):
+                    demand = demands.get(selection["tool"])
+                    if demand is not None and selection["spool"] is not None:
+                        demand.setdefault("material", selection["spool"]["profile"]["material"])
+                        demand.setdefault("diameter", selection["spool"]["profile"]["diameter"])
+
+            tools = sorted(demands.values(), key=lambda demand: demand["tool"])
+            queries = []
+            for demand in tools:
+                query = dict(material=demand.get("material"), diameter=demand.get("diameter"))
+                kind = "length" if demand.get("length") is not None else "weight"
+                query[kind] = demand[kind] * (1 + margin)
+                queries.append(query)
+            recommendations = self.filamentManager.recommend_spools(queries, limit=limit)
+        except Exception as e:
+            self._logger.error("Failed to recommend spools: {message}".format(message=str(e)))
+            return make_response("Failed to recommend spools, see the log for more details", 500)
+
+        for demand, spools in zip(tools, recommendations):
+            demand["spools"] = spools
+        return jsonify(dict(margin=margin, tools=tools))
+
+    @octoprint.plugin.BlueprintPlugin.route("/spools/by-tag/<string:tag>", methods=["GET"])
+    def get_spool_by_tag(self, tag):
+        try:
+            spool = self.read_inventory("get_spool_by_tag", tag)
+        except Exception as e:
+            self._logger.error("Failed to fetch spool with tag {tag}: {message}".format(tag=tag, message=str(e)))
+            return make_response("Failed to fetch spool, see the log for more details", 500)
+
+        if spool is None:
+            return make_response("Unknown spool", 404)
+        response = jsonify(dict(spool=spool))
+        response.set_etag(version_tag(spool))
+        return response
+
     @octoprint.plugin.BlueprintPlugin.route("/spools/<int:identifier>", methods=["GET"])
     def get_spool(self, identifier):
         try:
-            spool = self.filamentManager.get_spool(identifier)
+            spool = self.read_inventory("get_spool", identifier)
             if spool is not None:
-                return jsonify(dict(spool=spool))
+                response = jsonify(dict(spool=spool))
+                response.set_etag(version_tag(spool))
+                return response
             else:
                 self._logger.warn("Spool with id {id} does not exist".format(id=identifier))
                 return make_response("Unknown spool", 404)
@@ -199,7 +379,13 @@ class FilamentManagerApi(octoprint.plugin.BlueprintPlugin):
 
         try:
             saved_spool = self.filamentManager.create_spool(new_spool)
+            self.on_data_modified("spools", "insert")
             return jsonify(dict(spool=saved_spool))
+        except IntegrityError as e:
+            if is_duplicate_tag(e):
+                return make_response("Tag is already assigned to another spool", 409)
+            self._logger.warn("Failed to create spool: {message}".format(message=str(e)))
+            return make_response("Spool violates a constraint of the database, e.g. an unknown profile", 400)
         except Exception as e:
             self._logger.error("Failed to create spool: {message}".format(message=str(e)))
             return make_response("Failed to create spool, see the log for more details", 500)
@@ -219,49 +405,139 @@ class FilamentManagerApi(octoprint.plugin.BlueprintPlugin):
             return make_response("No spool included in request", 400)
 
         try:
-            spool = self.filamentManager.get_spool(identifier)
-        except Exception as e:
-            self._logger.error("Failed to fetch spool with id {id}: {message}"
-                               .format(id=str(identifier), message=str(e)))
-            return make_response("Failed to fetch spool, see the log for more details", 500)
-
-        if not spool:
-            self._logger.warn("Spool with id {id} does not exist".format(id=identifier))
-            return make_response("Unknown spool", 404)
-
-        updated_spool = json_data["spool"]
-        merged_spool = dict_merge(spool, updated_spool)
+            version = expected_version(request.if_match, identifier)
+        except ValueError:
+            return make_response("Spool has been modified in the meantime", 412)
 
         try:
-            saved_spool = self.filamentManager.update_spool(identifier, merged_spool)
+            saved_spool = self.filamentManager.update_spool(identifier, json_data["spool"], version=version)
+        except VersionConflictError:
+            return make_response("Spool has been modified in the meantime", 412)
+        except IntegrityError as e:
+            if is_duplicate_tag(e):
+                return make_response("Tag is already assigned to another spool", 409)
+            self._logger.warn("Failed to update spool with id {id}: {message}"
+                              .format(id=str(identifier), message=str(e)))
+            return make_response("Spool violates a constraint of the database, e.g. an unknown profile", 400)
         except Exception as e:
             self._logger.error("Failed to update spool with id {id}: {message}"
                                .format(id=str(identifier), message=str(e)))
             return make_response("Failed to update spool, see the log for more details", 500)
-        else:
-            self.on_data_modified("spools", "update")
-            return jsonify(dict(spool=saved_spool))
+
+        if not saved_spool:
+            self._logger.warn("Spool with id {id} does not exist".format(id=identifier))
+            return make_response("Unknown spool", 404)
+
+        self.on_data_modified("spools", "update", [identifier])
+        response = jsonify(dict(spool=saved_spool))
+        response.set_etag(version_tag(saved_spool))
+        return response
 
     @octoprint.plugin.BlueprintPlugin.route("/spools/<int:identifier>", methods=["DELETE"])
     @restricted_access
     def delete_spool(self, identifier):
         try:
             self.filamentManager.delete_spool(identifier)
+            self.on_data_modified("spools", "delete", [identifier])
             return make_response("", 204)
         except Exception as e:
             self._logger.error("Failed to delete spool with id {id}: {message}"
                                .format(id=str(identifier), message=str(e)))
             return make_response("Failed to delete spool, see the log for more details", 500)
 
+    @octoprint.plugin.BlueprintPlugin.route("/spools/batch", methods=["POST"])
+    @restricted_access
+    def apply_spool_batch(self):
+        return self.apply_batch("spool", ["name", "profile", "cost", "weight", "used", "temp_offset"],
+                                "apply_spool_batch")
+
+    def apply_batch(self, entity, mandatory_fields, method):
+        if "application/json" not in request.headers["Content-Type"]:
+            return make_response("Expected content-type JSON", 400)
+
+        try:
+            json_data = request.json
+        except BadRequest:
+            return make_response("Malformed JSON body in request", 400)
+
+        operations = json_data.get("operations")
+        if not isinstance(operations, list):
+            return make_response("No operations included in request", 400)
+
+        if len(operations) > self.MAX_BATCH_SIZE:
+            return make_response("Batch exceeds the maximum of {} operations".format(self.MAX_BATCH_SIZE), 400)
+
+        # everything is validated before anything is written, a batch is either applied completely or not at all
+        errors = batch_operation_errors(operations, entity, mandatory_fields)
+        if errors:
+            return make_response(jsonify(dict(errors=errors)), 400)
+
+        try:
+            # resolved here, the database manager is missing while the database is (re)connected
+            results = getattr(self.filamentManager, method)(operations)
+        except BatchError as e:
+            errors = [dict(index=index, status=self.BATCH_ERROR_STATUS[reason],
+                           message=self.BATCH_ERROR_MESSAGE[reason].format(entity=entity,
+                                                                           Entity=entity.capitalize()))
+                      for index, reason in e.errors]
+            return make_response(jsonify(dict(errors=errors)), errors[0]["status"])
+        except IntegrityError as e:
+            if entity == "spool" and is_duplicate_tag(e):
+                return make_response("Tag is already assigned to another spool", 409)
+            self._logger.warn("Failed to apply {entity} batch: {message}".format(entity=entity, message=str(e)))
+            return make_response("Batch violates a constraint of the database, e.g. an unknown profile", 400)
+        except Exception as e:
+            self._logger.error("Failed to apply {entity} batch: {message}".format(entity=entity, message=str(e)))
+            return make_response("Failed to apply batch, see the log for more details", 500)
+
+        # a single notification for the whole batch, thresholds are only recalculated for updates and deletes
+        modified = [op["id"] for op in operations if op["action"] != "create"]
+        self.on_data_modified(entity + "s", "update" if modified else "insert", modified)
+
+        status = dict(create=201, update=200, delete=204)
+        items = []
+        for op, result in zip(operations, results):
+            item = dict(status=status[op["action"]])
+            if result is not None:
+                item[entity] = result
+            items.append(item)
+        return jsonify(dict(results=items))
+
     @octoprint.plugin.BlueprintPlugin.route("/selections", methods=["GET"])
     def get_selections_list(self):
         try:
-            all_selections = self.filamentManager.get_all_selections(self.client_id)
+            if request.values.get("format") == "normalized":
+                return jsonify(self.read_inventory("get_all_selections_normalized", self.client_id))
+            all_selections = self.read_inventory("get_all_selections", self.client_id)
             return jsonify(dict(selections=all_selections))
         except Exception as e:
             self._logger.error("Failed to fetch selected spools: {message}".format(message=str(e)))
             return make_response("Failed to fetch selected spools, see the log for more details", 500)
 
+    @octoprint.plugin.BlueprintPlugin.route("/selections/all", methods=["GET"])
+    @restricted_access
+    @admin_permission.require(403)
+    def get_all_client_selections(self):
+        force = request.values.get("force", "false") in valid_boolean_trues
+
+        try:
+            lm = self.filamentManager.get_all_client_selections_lastmodified()
+        except Exception as e:
+            lm = None
+            self._logger.error("Failed to fetch selections lastmodified timestamp: {message}".format(message=str(e)))
+
+        etag = entity_tag(lm)
+
+        if not force and check_lastmodified(lm) and check_etag(etag):
+            return make_response("Not Modified", 304)
+
+        try:
+            all_clients = self.filamentManager.get_all_client_selections()
+            return add_revalidation_header_with_no_max_age(jsonify(dict(clients=all_clients)), lm, etag)
+        except Exception as e:
+            self._logger.error("Failed to fetch selections of all clients: {message}".format(message=str(e)))
+            return make_response("Failed to fetch selections, see the log for more details", 500)
+
     @octoprint.plugin.BlueprintPlugin.route("/selections/<int:identifier>", methods=["PATCH"])
     @restricted_access
     def update_selection(self, identifier):
@@ -280,12 +556,38 @@ class FilamentManagerApi(octoprint.plugin.BlueprintPlugin):
 
         if "tool" not in selection:
             return make_response("Selection does not contain mandatory 'tool' field", 400)
-        if "id" not in selection.get("spool", {}):
-            return make_response("Selection does not contain mandatory 'id (spool)' field", 400)
+        if "id" not in selection.get("spool", {}) and not selection.get("spool", {}).get("tag"):
+            return make_response("Selection does not contain mandatory 'id (spool)' or 'tag (spool)' field", 400)
 
         if self._printer.is_printing():
             return make_response("Trying to change filament while printing", 409)
 
+        if "id" not in selection["spool"]:
+            # selected by scanning the tag of the spool
+            try:
+                spool = self.read_inventory("get_spool_by_tag", selection["spool"]["tag"])
+            except Exception as e:
+                self._logger.error("Failed to fetch spool with tag {tag}: {message}"
+                                   .format(tag=selection["spool"]["tag"], message=str(e)))
+                return make_response("Failed to update selected spool, see the log for more details", 500)
+            if spool is None:
+                return make_response("Unknown spool", 404)
+            selection["spool"]["id"] = spool["id"]
+
+        if self.journal is not None:
+            # the change is applied through the journal, which also takes care of the temperature offsets
+            future = self.journal.append("selection", client_id=self.client_id, tool=identifier,
+                                         spool_id=selection["spool"]["id"])
+            try:
+                saved_selection = future.result(timeout=self.JOURNAL_TIMEOUT)
+            except WriteTimeoutError:
+                return make_response(jsonify(dict(selection=selection)), 202)
+            except Exception as e:
+                self._logger.error("Failed to update selected spool for tool{id}: {message}"
+                                   .format(id=str(identifier), message=str(e)))
+                return make_response("Failed to update selected spool, see the log for more details", 500)
+            return jsonify(dict(selection=saved_selection))
+
         try:
             saved_selection = self.filamentManager.update_selection(identifier, self.client_id, selection)
         except Exception as e:
@@ -297,9 +599,62 @@ class FilamentManagerApi(octoprint.plugin.BlueprintPlugin):
                 self.set_temp_offsets([saved_selection])
             except Exception as e:
                 self._logger.error("Failed to set temperature offsets: {message}".format(message=str(e)))
-            self.on_data_modified("selections", "update")
+            self.on_data_modified("selections", "update", [identifier])
             return jsonify(dict(selection=saved_selection))
 
+    @octoprint.plugin.BlueprintPlugin.route("/stats", methods=["GET"])
+    def get_usage_stats(self):
+        today = date.today()
+        try:
+            start = parse_date(request.values.get("start"), today.replace(day=1))
+            end = parse_date(request.values.get("end"), today)
+        except ValueError:
+            return make_response("Start and end have to be dates in the format YYYY-MM-DD", 400)
+
+        period = request.values.get("period", "month")
+        if period not in ["day", "month", "total"]:
+            return make_response("Period has to be one of day, month or total", 400)
+
+        group_by = [key for key in request.values.get("group_by", "").split(",") if key]
+        if any(key not in self.STATS_DIMENSIONS for key in group_by):
+            return make_response("Statistics can only be grouped by {}".format(", ".join(self.STATS_DIMENSIONS)),
+                                 400)
+
+        try:
+            stats = self.filamentManager.get_usage_stats(start, end, group_by=group_by, period=period)
+            return jsonify(dict(start=start.isoformat(), end=end.isoformat(), period=period, stats=stats))
+        except Exception as e:
+            self._logger.error("Failed to fetch usage statistics: {message}".format(message=str(e)))
+            return make_response("Failed to fetch usage statistics, see the log for more details", 500)
+
+    @octoprint.plugin.BlueprintPlugin.route("/jobs", methods=["GET"])
+    def get_jobs_list(self):
+        try:
+            limit = int(request.values.get("limit", 100))
+        except ValueError:
+            return make_response("Limit has to be a number", 400)
+
+        try:
+            all_jobs = self.filamentManager.get_all_jobs(self.client_id, limit=limit)
+            return jsonify(dict(jobs=all_jobs))
+        except Exception as e:
+            self._logger.error("Failed to fetch jobs: {message}".format(message=str(e)))
+            return make_response("Failed to fetch jobs, see the log for more details", 500)
+
+    @octoprint.plugin.BlueprintPlugin.route("/jobs/<int:identifier>", methods=["GET"])
+    def get_job(self, identifier):
+        try:
+            job = self.filamentManager.get_job(identifier)
+            if job is not None:
+                return jsonify(dict(job=job))
+            else:
+                self._logger.warn("Job with id {id} does not exist".format(id=identifier))
+                return make_response("Unknown job", 404)
+        except Exception as e:
+            self._logger.error("Failed to fetch job with id {id}: {message}"
+                               .format(id=str(identifier), message=str(e)))
+            return make_response("Failed to fetch job, see the log for more details", 500)
+
     @octoprint.plugin.BlueprintPlugin.route("/export", methods=["GET"])
     @restricted_access
     @admin_permission.require(403)
@@ -372,8 +727,17 @@ class FilamentManagerApi(octoprint.plugin.BlueprintPlugin):
                 self._logger.warn("Could not remove temporary directory {path}: {message}"
                                   .format(path=tempdir, message=str(e)))
 
+        self.on_data_modified("spools", "update")
         return make_response("", 204)
 
+    @octoprint.plugin.BlueprintPlugin.route("/database/slowqueries", methods=["GET"])
+    @restricted_access
+    @admin_permission.require(403)
+    def get_slow_queries(self):
+        if self.filamentManager is None or self.filamentManager.slow_queries is None:
+            return jsonify(dict(queries=list()))
+        return jsonify(dict(queries=self.filamentManager.slow_queries.recent()))
+
     @octoprint.plugin.BlueprintPlugin.route("/database/test", methods=["POST"])
     @restricted_access
     def test_database_connection(self):
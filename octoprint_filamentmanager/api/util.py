@@ -6,6 +6,8 @@ __license__ = "GNU Affero General Public License http://www.gnu.org/licenses/agp
 __copyright__ = "Copyright (C) 2017 Sven Lohrmann - Released under terms of the AGPLv3 License"
 
 import hashlib
+from datetime import datetime
+
 from werkzeug.http import http_date
 
 
@@ -18,3 +20,95 @@ def add_revalidation_header_with_no_max_age(response, lm, etag):
 
 def entity_tag(lm):
     return (hashlib.sha1(str(lm))).hexdigest()
+
+
+def version_tag(entity):
+    return "{id}-{version}".format(id=entity["id"], version=entity["version"])
+
+
+def expected_version(if_match, identifier):
+    # returns the row version requested by an If-Match header, None if the update is unconditional
+    if not if_match or if_match.star_tag:
+        return None
+    for tag in if_match.as_set():
+        entity_id, _, version = tag.partition("-")
+        if entity_id == str(identifier) and version.isdigit():
+            return int(version)
+    raise ValueError("If-Match does not contain a valid entity tag")
+
+
+def parse_date(value, default):
+    # parses a date in the format YYYY-MM-DD, raises a ValueError if the format doesn't match
+    if not value:
+        return default
+    return datetime.strptime(value, "%Y-%m-%d").date()
+
+
+def is_duplicate_tag(error):
+    # the unique index is named in the message of PostgreSQL, SQLite names the column
+    message = str(error.orig)
+    return "spools_tag_idx" in message or "spools.tag" in message
+
+
+def parse_spool_query(values, remaining_keys, sort_keys):
+    # parses the filter and sort parameters of the spool list, returns None if the whole list is requested
+    parameters = ["material", "vendor", "sort", "limit", "offset"]
+    parameters += [prefix + key for key in remaining_keys for prefix in ("min_", "max_")]
+    if not any(key in values for key in parameters):
+        return None
+
+    query = dict(material=values.get("material"), vendor=values.get("vendor"), minimum=dict(), maximum=dict())
+    for key in remaining_keys:
+        for prefix, bounds in (("min_", query["minimum"]), ("max_", query["maximum"])):
+            if values.get(prefix + key):
+                try:
+                    bounds[key] = float(values[prefix + key])
+                except ValueError:
+                    raise ValueError("'{}' has to be a number".format(prefix + key))
+
+    sort = values.get("sort", "name")
+    query["descending"] = sort.startswith("-")
+    query["sort"] = sort.lstrip("-")
+    if query["sort"] not in sort_keys:
+        raise ValueError("Sort has to be one of {}, prefixed with '-' for descending order"
+                         .format(", ".join(sort_keys)))
+
+    try:
+        query["limit"] = int(values["limit"]) if values.get("limit") else None
+        query["offset"] = int(values.get("offset") or 0)
+    except ValueError:
+        raise ValueError("Limit and offset have to be numbers")
+    if (query["limit"] is not None and query["limit"] < 1) or query["offset"] < 0:
+        raise ValueError("Limit has to be positive and offset must not be negative")
+    return query
+
+
+def batch_operation_errors(operations, entity, mandatory_fields):
+    # validates the structure of batch operations, returns a list of errors with the index of the operation
+    errors = []
+    identifiers = set()
+    for index, op in enumerate(operations):
+        message = None
+        if not isinstance(op, dict) or op.get("action") not in ["create", "update", "delete"]:
+            message = "Operation does not contain a valid 'action' field"
+        elif op["action"] != "delete" and not isinstance(op.get(entity), dict):
+            message = "Operation does not contain a '{}' object".format(entity)
+        elif op["action"] == "create":
+            missing = [key for key in mandatory_fields if key not in op[entity]]
+            if missing:
+                message = "{} does not contain mandatory '{}' field".format(entity.capitalize(), missing[0])
+            elif entity == "spool" and "id" not in (op[entity]["profile"] if isinstance(op[entity]["profile"], dict)
+                                                    else dict()):
+                message = "Spool does not contain mandatory 'id (profile)' field"
+        elif not isinstance(op.get("id"), int):
+            message = "Operation does not contain a valid 'id' field"
+        elif op["id"] in identifiers:
+            message = "{} with id {} is modified more than once".format(entity.capitalize(), op["id"])
+        else:
+            identifiers.add(op["id"])
+
+        if message is None and not isinstance(op.get("version", 0), (int, type(None))):
+            message = "Operation does not contain a valid 'version' field"
+        if message is not None:
+            errors.append(dict(index=index, status=400, message=message))
+    return errors
@@ -4,21 +4,99 @@ __author__ = "Sven Lohrmann <malnvenshorn@gmail.com>"
 __license__ = "GNU Affero General Public License http://www.gnu.org/licenses/agpl.html"
 __copyright__ = "Copyright (C) 2017 Sven Lohrmann - Released under terms of the AGPLv3 License"
 
+import hashlib
 import io
+import json
+import logging
 import os
+import re
+import time
+from datetime import datetime
+from math import pi as PI
+from contextlib import contextmanager
+from functools import wraps
 from multiprocessing import Lock
+from threading import current_thread
 
-from backports import csv
-from uritools import urisplit
 from sqlalchemy.engine.url import URL
-from sqlalchemy import create_engine, event, text
-from sqlalchemy.schema import MetaData, Table, Column, ForeignKeyConstraint, DDL, PrimaryKeyConstraint
-from sqlalchemy.sql import insert, update, delete, select, label
-from sqlalchemy.types import INTEGER, VARCHAR, REAL, TIMESTAMP
-from sqlalchemy.dialects.postgresql import insert as pg_insert
+from sqlalchemy import create_engine, event, text, bindparam, and_, or_, case
+from sqlalchemy.exc import DBAPIError
+from sqlalchemy.schema import MetaData, Table, Column, ForeignKeyConstraint, DDL, PrimaryKeyConstraint, CreateTable
+from sqlalchemy.schema import Index
+from sqlalchemy.sql import insert, update, delete, select, label, literal_column
+from sqlalchemy.sql import table as table_clause, column as column_clause
+from sqlalchemy.sql.expression import Executable
+from sqlalchemy.types import INTEGER, VARCHAR, REAL, TIMESTAMP, TEXT, DATE
 import sqlalchemy.sql.functions as func
+from sqlalchemy.util import LRUCache
 
-from .listen import PGNotify
+from .writer import GroupCommitWriter, WriteFuture
+from ..metrics import timer, TimedLock, DB_CALL_SECONDS, DB_CALL_ERRORS, DB_LOCK_WAIT_SECONDS
+
+
+class VersionConflictError(Exception):
+    pass
+
+
+class BatchError(Exception):
+    # errors is a list of (index, reason) tuples of the operations which can't be applied
+    def __init__(self, errors):
+        Exception.__init__(self, "{count} operations of the batch can't be applied".format(count=len(errors)))
+        self.errors = errors
+
+
+class StatementCache(LRUCache):
+    """
+    Compiled cache which only keeps the compiled form of the registered, prebuilt statements. Dynamic statements are
+    built anew on every call, so their compiled form is never reused and would only evict the prebuilt ones.
+    """
+
+    def __init__(self, capacity):
+        LRUCache.__init__(self, capacity)
+        self.statements = set()
+
+    def register(self, statements):
+        # ids, statements can't be compared with ==, the prebuilt statements live as long as the manager
+        self.statements = set(id(statement) for statement in statements)
+
+    def __setitem__(self, key, value):
+        # the key consists of the dialect, the statement, the column keys and further compile options
+        if id(key[1]) in self.statements:
+            LRUCache.__setitem__(self, key, value)
+
+
+def instrumented(func):
+    # records the duration and failures of the decorated method
+    duration = DB_CALL_SECONDS.labels(func.__name__)
+    errors = DB_CALL_ERRORS.labels(func.__name__)
+
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        started = timer()
+        try:
+            return func(*args, **kwargs)
+        except Exception:
+            errors.inc()
+            raise
+        finally:
+            duration.observe(timer() - started)
+    return wrapper
+
+
+def write_operation(func):
+    # runs the decorated method in its own transaction, or as part of a group commit if the writer is enabled
+    @wraps(func)
+    def wrapper(self, *args, **kwargs):
+        return self._write(func, self, *args, **kwargs)
+    return instrumented(wrapper)
+
+
+def read_operation(func):
+    # runs the decorated method with a connection to the read replica if possible, otherwise with the primary
+    @wraps(func)
+    def wrapper(self, *args, **kwargs):
+        return self._read(lambda conn: func(self, conn, *args, **kwargs))
+    return instrumented(wrapper)
 
 
 class FilamentManager(object):
@@ -26,27 +104,82 @@ class FilamentManager(object):
     DIALECT_SQLITE = "sqlite"
     DIALECT_POSTGRESQL = "postgresql"
 
+    # columns which can be written through the API
+    PROFILE_FIELDS = ("vendor", "material", "density", "diameter")
+    SPOOL_FIELDS = ("name", "cost", "weight", "used", "temp_offset", "tag")
+
+    # reads go to the primary for this long after a write, so that we read our own writes despite replication lag
+    READ_YOUR_WRITES_WINDOW = 5  # s
+    # how long to wait before using the replica again after it failed
+    REPLICA_RETRY_DELAY = 30  # s
+
+    # amounts of filament left on a spool, computed by the database and appended to every spool
+    REMAINING_KEYS = ("remaining_weight", "remaining_length", "remaining_percent")
+    # spools can be ordered by these keys, besides name, material and vendor
+    SPOOL_SORT_KEYS = ("name", "material", "vendor") + REMAINING_KEYS
+
+    # profiles within this range of a requested diameter are considered as matching, in mm
+    DIAMETER_TOLERANCE = 0.01
+
+    # upper bound of compiled statements kept, the prebuilt statements only need a few dozen entries
+    COMPILED_CACHE_SIZE = 100
+
+    # bound parameters per statement supported by every SQLite version, multi-row inserts are split accordingly
+    SQLITE_MAX_VARIABLES = 999
+
     def __init__(self, config):
+        self._logger = logging.getLogger(__name__)
         self.notify = None
+        self.writer = None
+        self.replica = None
+        self.slow_queries = None
+        self.last_write = 0
+        self.replica_retry_at = 0
+        self.compiled_cache = StatementCache(self.COMPILED_CACHE_SIZE)
         self.conn = self.connect(config.get("uri", ""),
                                  database=config.get("name", ""),
                                  username=config.get("user", ""),
-                                 password=config.get("password", ""))
+                                 password=config.get("password", ""))\
+            .execution_options(compiled_cache=self.compiled_cache)
+
+        slow_query_threshold = float(config.get("slowQueryThreshold", 0)) / 1000
+        if slow_query_threshold > 0:
+            from .slowlog import SlowQueryLog
+
+            self.slow_queries = SlowQueryLog(slow_query_threshold)
+            self.slow_queries.attach(self.conn.engine)
 
         # QUESTION thread local connection (pool) vs sharing a serialized connection, pro/cons?
         # from sqlalchemy.orm import sessionmaker, scoped_session
         # Session = scoped_session(sessionmaker(bind=engine))
         # when using a connection pool how do we prevent notifiying ourself on database changes?
-        self.lock = Lock()
+        self.lock = TimedLock(Lock(), DB_LOCK_WAIT_SECONDS)
 
         if self.engine_dialect_is(self.DIALECT_SQLITE):
             # Enable foreign key constraints
             self.conn.execute(text("PRAGMA foreign_keys = ON").execution_options(autocommit=True))
         elif self.engine_dialect_is(self.DIALECT_POSTGRESQL):
+            from .listen import PGNotify
+
             # Create listener thread
             self.notify = PGNotify(self.conn.engine.url)
 
+            if config.get("replicaUri"):
+                # read-only methods use a connection pool to the replica
+                self.replica = self._create_engine(config["replicaUri"],
+                                                  database=config.get("name", ""),
+                                                  username=config.get("user", ""),
+                                                  password=config.get("password", ""))\
+                    .execution_options(compiled_cache=self.compiled_cache)
+                if self.slow_queries is not None:
+                    self.slow_queries.attach(self.replica)
+
     def connect(self, uri, database="", username="", password=""):
+        return self._create_engine(uri, database=database, username=username, password=password).connect()
+
+    def _create_engine(self, uri, database="", username="", password=""):
+        from uritools import urisplit
+
         uri_parts = urisplit(uri)
 
         if uri_parts.scheme == self.DIALECT_SQLITE:
@@ -62,15 +195,87 @@ class FilamentManager(object):
         else:
             raise ValueError("Engine '{engine}' not supported".format(engine=uri_parts.scheme))
 
-        return engine.connect()
+        return engine
 
     def close(self):
+        self.stop_writer()
+        if self.notify is not None:
+            self.notify.close()
         self.conn.close()
+        if self.replica is not None:
+            self.replica.dispose()
+
+    # transactions
+
+    @contextmanager
+    def transaction(self):
+        with self.lock, self.conn.begin():
+            yield
+
+    @contextmanager
+    def write_transaction(self):
+        try:
+            with self.transaction():
+                yield
+        finally:
+            self.mark_written()
+
+    def mark_written(self):
+        # also called if another client has modified the data, which the replica might not have received yet
+        self.last_write = time.time()
+
+    def start_writer(self, window):
+        if self.writer is None:
+            self.writer = GroupCommitWriter(self.write_transaction, window=window)
+
+    def stop_writer(self):
+        if self.writer is not None:
+            self.writer.stop()
+            self.writer = None
+
+    def submit(self, operation, *args, **kwargs):
+        # executes a write operation without waiting for its commit, returns a future for the result
+        if self.writer is not None:
+            return self.writer.submit(operation, *args, **kwargs)
+
+        future = WriteFuture()
+        try:
+            future.set_result(operation(*args, **kwargs))
+        except Exception as e:
+            future.set_exception(e)
+        return future
+
+    def _write(self, func, *args, **kwargs):
+        writer = self.writer
+        if writer is None:
+            with self.write_transaction():
+                return func(*args, **kwargs)
+        elif current_thread() is writer.thread:
+            # already running within the transaction of the current batch
+            return func(*args, **kwargs)
+        else:
+            return writer.submit(func, *args, **kwargs).result()
+
+    def _read(self, operation):
+        now = time.time()
+        if self.replica is not None and now - self.last_write > self.READ_YOUR_WRITES_WINDOW \
+                and now >= self.replica_retry_at:
+            try:
+                with self.replica.connect() as conn, conn.begin():
+                    return operation(conn)
+            except DBAPIError as e:
+                self._logger.warn("Read from replica failed, using primary for the next {delay}s: {message}"
+                                  .format(delay=self.REPLICA_RETRY_DELAY, message=str(e)))
+                self.replica_retry_at = now + self.REPLICA_RETRY_DELAY
+
+        with self.transaction():
+            return operation(self.conn)
 
     def engine_dialect_is(self, dialect):
         return self.conn.engine.dialect.name == dialect if self.conn is not None else False
 
-    def initialize(self):
+    @instrumented
+    def initialize(self, force=False):
         metadata = MetaData()
 
         self.profiles = Table("profiles", metadata,
@@ -78,7 +283,8 @@ class FilamentManager(object):
                               Column("vendor", VARCHAR(255), nullable=False, server_default=""),
                               Column("material", VARCHAR(255), nullable=False, server_default=""),
                               Column("density", REAL, nullable=False, server_default="0"),
-                              Column("diameter", REAL, nullable=False, server_default="0"))
+                              Column("diameter", REAL, nullable=False, server_default="0"),
+                              Column("version", INTEGER, nullable=False, server_default="1"))
 
         self.spools = Table("spools", metadata,
                             Column("id", INTEGER, primary_key=True, autoincrement=True),
@@ -88,7 +294,11 @@ class FilamentManager(object):
                             Column("weight", REAL, nullable=False, server_default="0"),
                             Column("used", REAL, nullable=False, server_default="0"),
                             Column("temp_offset", INTEGER, nullable=False, server_default="0"),
-                            ForeignKeyConstraint(["profile_id"], ["profiles.id"], ondelete="RESTRICT"))
+                            Column("version", INTEGER, nullable=False, server_default="1"),
+                            # external identifier, e.g. the content of a barcode, QR code or NFC tag
+                            Column("tag", VARCHAR(255)),
+                            ForeignKeyConstraint(["profile_id"], ["profiles.id"], ondelete="RESTRICT"),
+                            Index("spools_tag_idx", "tag", unique=True))
 
         self.selections = Table("selections", metadata,
                                 Column("tool", INTEGER,),
@@ -97,8 +307,19 @@ class FilamentManager(object):
                                 PrimaryKeyConstraint("tool", "client_id", name="selections_pkey"),
                                 ForeignKeyConstraint(["spool_id"], ["spools.id"], ondelete="CASCADE"))
 
+        # optional display names of the clients sharing the database
+        self.clients = Table("clients", metadata,
+                             Column("client_id", VARCHAR(36), primary_key=True),
+                             Column("name", VARCHAR(255), nullable=False, server_default=""))
+
         self.versioning = Table("versioning", metadata,
-                                Column("schema_id", INTEGER, primary_key=True, autoincrement=False))
+                                Column("schema_id", INTEGER, primary_key=True, autoincrement=False),
+                                Column("fingerprint", VARCHAR(40)))
+
+        # keys of journal entries which have already been applied, see journal.py
+        self.journal_applied = Table("journal_applied", metadata,
+                                     Column("key", VARCHAR(36), primary_key=True),
+                                     Column("applied_at", TIMESTAMP, nullable=False))
 
         self.modifications = Table("modifications", metadata,
                                    Column("table_name", VARCHAR(255), nullable=False, primary_key=True),
@@ -106,45 +327,111 @@ class FilamentManager(object):
                                    Column("changed_at", TIMESTAMP, nullable=False,
                                           server_default=text("CURRENT_TIMESTAMP")))
 
+        # filament usage of finished print jobs, extrusion, layers and features are stored as JSON
+        self.jobs = Table("jobs", metadata,
+                          Column("id", INTEGER, primary_key=True, autoincrement=True),
+                          Column("client_id", VARCHAR(36), nullable=False),
+                          Column("name", VARCHAR(255), nullable=False, server_default=""),
+                          Column("path", VARCHAR(1024), nullable=False, server_default=""),
+                          Column("status", VARCHAR(16), nullable=False),
+                          Column("finished_at", TIMESTAMP, nullable=False),
+                          Column("extrusion", TEXT, nullable=False),
+                          Column("layers", TEXT),
+                          Column("features", TEXT))
+
+        # Every debit of a spool at the end of a print is recorded, vendor and material are copied so that the
+        # history isn't affected by later changes of the profile. The rollups are updated together with each
+        # debit, reports only read the rollups.
+        self.debits = Table("debits", metadata,
+                            Column("id", INTEGER, primary_key=True, autoincrement=True),
+                            Column("client_id", VARCHAR(36), nullable=False),
+                            Column("tool", INTEGER, nullable=False),
+                            Column("spool_id", INTEGER, nullable=False),
+                            Column("vendor", VARCHAR(255), nullable=False),
+                            Column("material", VARCHAR(255), nullable=False),
+                            Column("length", REAL, nullable=False),
+                            Column("weight", REAL, nullable=False),
+                            Column("cost", REAL, nullable=False),
+                            Column("created_at", TIMESTAMP, nullable=False))
+
+        self.usage_rollups = Table("usage_rollups", metadata,
+                                   Column("day", DATE, nullable=False),
+                                   Column("client_id", VARCHAR(36), nullable=False),
+                                   Column("vendor", VARCHAR(255), nullable=False),
+                                   Column("material", VARCHAR(255), nullable=False),
+                                   Column("length", REAL, nullable=False),
+                                   Column("weight", REAL, nullable=False),
+                                   Column("cost", REAL, nullable=False),
+                                   Column("debits", INTEGER, nullable=False),
+                                   PrimaryKeyConstraint("day", "client_id", "vendor", "material",
+                                                        name="usage_rollups_pkey"))
+
+        # column names in select order, used to convert joined rows into nested dicts
+        self._profile_keys = tuple(self.profiles.columns.keys())
+        self._spool_keys = tuple(self.spools.columns.keys())
+        self._selection_keys = tuple(self.selections.columns.keys())
+
+        # the primary key of selections starts with the tool, this index serves the lookups by client
+        triggers = [DDL("CREATE INDEX IF NOT EXISTS selections_client_id_idx ON selections (client_id, tool)"),
+                    DDL("CREATE INDEX IF NOT EXISTS profiles_material_idx ON profiles (material, diameter)")]
+        # spool recommendations search the remaining weight per profile, see recommend_spools
+        if self.engine_dialect_is(self.DIALECT_SQLITE) and self.conn.engine.dialect.server_version_info < (3, 9, 0):
+            # indexes on expressions are only supported since SQLite 3.9
+            triggers.append(DDL("CREATE INDEX IF NOT EXISTS spools_profile_id_idx ON spools (profile_id)"))
+        else:
+            triggers.append(DDL("CREATE INDEX IF NOT EXISTS spools_remaining_idx "
+                                "ON spools (profile_id, (weight - used))"))
+            triggers.append(DDL("CREATE INDEX IF NOT EXISTS spools_remaining_weight_idx ON spools ((weight - used))"))
+            # has to match the expression of remaining_percent in _prepare_statements to be used
+            triggers.append(DDL("CREATE INDEX IF NOT EXISTS spools_remaining_percent_idx "
+                                "ON spools (((weight - used) * 100 / nullif(weight, 0)))"))
         if self.engine_dialect_is(self.DIALECT_POSTGRESQL):
-            def should_create_function(name):
-                row = self.conn.execute("select proname from pg_proc where proname = '%s'" % name).scalar()
-                return not bool(row)
-
-            def should_create_trigger(name):
-                row = self.conn.execute("select tgname from pg_trigger where tgname = '%s'" % name).scalar()
-                return not bool(row)
-
-            trigger_function = DDL("""
-                                   CREATE FUNCTION update_lastmodified()
-                                   RETURNS TRIGGER AS $func$
-                                   BEGIN
-                                       INSERT INTO modifications (table_name, action, changed_at)
-                                       VALUES(TG_TABLE_NAME, TG_OP, CURRENT_TIMESTAMP)
-                                       ON CONFLICT (table_name) DO UPDATE
-                                       SET action=TG_OP, changed_at=CURRENT_TIMESTAMP
-                                       WHERE modifications.table_name=TG_TABLE_NAME;
-                                       PERFORM pg_notify(TG_TABLE_NAME, TG_OP);
-                                       RETURN NULL;
-                                   END;
-                                   $func$ LANGUAGE plpgsql;
-                                   """)
-
-            if should_create_function("update_lastmodified"):
-                event.listen(metadata, "after_create", trigger_function)
-
-            for table in [self.profiles.name, self.spools.name]:
+            triggers.append(DDL("""
+                                CREATE OR REPLACE FUNCTION update_lastmodified()
+                                RETURNS TRIGGER AS $func$
+                                DECLARE
+                                    changed RECORD;
+                                    identifier TEXT;
+                                BEGIN
+                                    IF TG_OP = 'DELETE' THEN
+                                        changed := OLD;
+                                    ELSE
+                                        changed := NEW;
+                                    END IF;
+                                    INSERT INTO modifications (table_name, action, changed_at)
+                                    VALUES(TG_TABLE_NAME, TG_OP, CURRENT_TIMESTAMP)
+                                    ON CONFLICT (table_name) DO UPDATE
+                                    SET action=TG_OP, changed_at=CURRENT_TIMESTAMP
+                                    WHERE modifications.table_name=TG_TABLE_NAME;
+                                    -- the id of the row is appended if the table has one, e.g. UPDATE:1, selections
+                                    -- are identified by their client and tool instead, e.g. UPDATE:<client_id>/0
+                                    IF TG_TABLE_NAME = 'selections' THEN
+                                        identifier := (to_jsonb(changed)->>'client_id') || '/' ||
+                                                      (to_jsonb(changed)->>'tool');
+                                    ELSE
+                                        identifier := to_jsonb(changed)->>'id';
+                                    END IF;
+                                    PERFORM pg_notify(TG_TABLE_NAME, concat_ws(':', TG_OP, identifier));
+                                    RETURN NULL;
+                                END;
+                                $func$ LANGUAGE plpgsql;
+                                """))
+
+            for table in [self.profiles.name, self.spools.name, self.selections.name, self.clients.name]:
                 for action in ["INSERT", "UPDATE", "DELETE"]:
                     name = "{table}_on_{action}".format(table=table, action=action.lower())
                     trigger = DDL("""
+                                  DROP TRIGGER IF EXISTS {name} ON {table};
                                   CREATE TRIGGER {name} AFTER {action} on {table}
                                   FOR EACH ROW EXECUTE PROCEDURE update_lastmodified()
                                   """.format(name=name, table=table, action=action))
-                    if should_create_trigger(name):
-                        event.listen(metadata, "after_create", trigger)
+                    triggers.append(trigger)
+
+            self.supports_search_index = True
+            triggers.extend(self._search_index_ddl())
 
         elif self.engine_dialect_is(self.DIALECT_SQLITE):
-            for table in [self.profiles.name, self.spools.name]:
+            for table in [self.profiles.name, self.spools.name, self.selections.name, self.clients.name]:
                 for action in ["INSERT", "UPDATE", "DELETE"]:
                     name = "{table}_on_{action}".format(table=table, action=action.lower())
                     trigger = DDL("""
@@ -153,172 +440,783 @@ class FilamentManager(object):
                                       REPLACE INTO modifications (table_name, action) VALUES ('{table}','{action}');
                                   END
                                   """.format(name=name, table=table, action=action))
-                    event.listen(metadata, "after_create", trigger)
+                    triggers.append(trigger)
+
+            # the search falls back to LIKE if SQLite has been compiled without FTS5
+            self.supports_search_index = self._sqlite_has_fts5()
+            if self.supports_search_index:
+                triggers.extend(self._search_index_ddl())
+
+        # The schema is only created if its fingerprint differs from the one stored with the schema version,
+        # which saves the existence checks of create_all on every start.
+        self.schema_fingerprint = self._schema_fingerprint(metadata, triggers)
+        if force or self.get_schema_fingerprint() != self.schema_fingerprint:
+            for trigger in triggers:
+                event.listen(metadata, "after_create", trigger)
+            metadata.create_all(self.conn, checkfirst=True)
 
-        metadata.create_all(self.conn, checkfirst=True)
+        self._prepare_statements()
+        self.compiled_cache.register(self._prebuilt_statements())
 
+    @instrumented
     def execute_script(self, script):
-        with self.lock, self.conn.begin():
+        with self.write_transaction():
             for stmt in script.split(";"):
                 self.conn.execute(text(stmt))
 
     # versioning
 
+    @instrumented
     def get_schema_version(self):
         with self.lock, self.conn.begin():
             return self.conn.execute(select([func.max(self.versioning.c.schema_id)])).scalar()
 
+    @instrumented
     def set_schema_version(self, version):
         with self.lock, self.conn.begin():
-            self.conn.execute(insert(self.versioning).values((version,)))
+            self.conn.execute(insert(self.versioning).values(schema_id=version))
             self.conn.execute(delete(self.versioning).where(self.versioning.c.schema_id < version))
 
-    # profiles
+    @instrumented
+    def get_schema_fingerprint(self):
+        try:
+            with self.lock, self.conn.begin():
+                stmt = select([self.versioning.c.fingerprint]).order_by(self.versioning.c.schema_id.desc()).limit(1)
+                return self.conn.execute(stmt).scalar()
+        except DBAPIError:
+            # the database is empty or its schema predates the fingerprint column
+            return None
 
-    def get_all_profiles(self):
+    @instrumented
+    def set_schema_fingerprint(self):
+        # should only be called after the schema has been migrated to the current version
         with self.lock, self.conn.begin():
-            stmt = select([self.profiles]).order_by(self.profiles.c.material, self.profiles.c.vendor)
-            result = self.conn.execute(stmt)
+            self.conn.execute(update(self.versioning).values(fingerprint=self.schema_fingerprint))
+
+    def _schema_fingerprint(self, metadata, triggers):
+        dialect = self.conn.engine.dialect
+        sha1 = hashlib.sha1()
+        for table in metadata.sorted_tables:
+            sha1.update(str(CreateTable(table).compile(dialect=dialect)).encode("utf-8"))
+        for trigger in triggers:
+            sha1.update(trigger.statement.encode("utf-8"))
+        return sha1.hexdigest()
+
+    def _sqlite_has_fts5(self):
+        options = self.conn.execute(text("PRAGMA compile_options")).fetchall()
+        return any(row[0] == "ENABLE_FTS5" for row in options)
+
+    def _search_index_ddl(self):
+        # The search index covers the spool name and the vendor and material of its profile. It is maintained by
+        # triggers and filled with the existing spools whenever the schema is (re)created.
+        if self.engine_dialect_is(self.DIALECT_POSTGRESQL):
+            document = "setweight(to_tsvector('simple', {name}), 'A') || " \
+                       "setweight(to_tsvector('simple', {vendor} || ' ' || {material}), 'B')"
+            return [
+                DDL("""
+                    CREATE TABLE IF NOT EXISTS spool_search (
+                        spool_id INTEGER PRIMARY KEY REFERENCES spools (id) ON DELETE CASCADE,
+                        document TSVECTOR NOT NULL
+                    );
+                    CREATE INDEX IF NOT EXISTS spool_search_document_idx ON spool_search USING GIN (document);
+                    """),
+                DDL("""
+                    CREATE OR REPLACE FUNCTION update_spool_search()
+                    RETURNS TRIGGER AS $func$
+                    BEGIN
+                        IF TG_TABLE_NAME = 'spools' THEN
+                            INSERT INTO spool_search (spool_id, document)
+                            SELECT NEW.id, {spool_document} FROM profiles WHERE profiles.id = NEW.profile_id
+                            ON CONFLICT (spool_id) DO UPDATE SET document = EXCLUDED.document;
+                        ELSE
+                            UPDATE spool_search SET document = {profile_document}
+                            FROM spools WHERE spools.profile_id = NEW.id AND spool_search.spool_id = spools.id;
+                        END IF;
+                        RETURN NULL;
+                    END;
+                    $func$ LANGUAGE plpgsql;
+                    """.format(spool_document=document.format(name="NEW.name", vendor="profiles.vendor",
+                                                                 material="profiles.material"),
+                               profile_document=document.format(name="spools.name", vendor="NEW.vendor",
+                                                                material="NEW.material"))),
+                DDL("""
+                    DROP TRIGGER IF EXISTS spools_search_on_write ON spools;
+                    CREATE TRIGGER spools_search_on_write AFTER INSERT OR UPDATE OF name, profile_id ON spools
+                    FOR EACH ROW EXECUTE PROCEDURE update_spool_search();
+                    DROP TRIGGER IF EXISTS profiles_search_on_update ON profiles;
+                    CREATE TRIGGER profiles_search_on_update AFTER UPDATE OF vendor, material ON profiles
+                    FOR EACH ROW EXECUTE PROCEDURE update_spool_search();
+                    """),
+                DDL("""
+                    INSERT INTO spool_search (spool_id, document)
+                    SELECT spools.id, {document} FROM spools JOIN profiles ON profiles.id = spools.profile_id
+                    ON CONFLICT (spool_id) DO UPDATE SET document = EXCLUDED.document
+                    """.format(document=document.format(name="spools.name", vendor="profiles.vendor",
+                                                           material="profiles.material"))),
+            ]
+        else:
+            # SQLite executes a single statement per DDL
+            insert_spool = "INSERT INTO spools_fts (rowid, name, vendor, material) " \
+                           "SELECT new.id, new.name, vendor, material FROM profiles WHERE id = new.profile_id;"
+            return [
+                DDL("CREATE VIRTUAL TABLE IF NOT EXISTS spools_fts USING fts5(name, vendor, material, prefix='2 3')"),
+                DDL("""
+                    CREATE TRIGGER IF NOT EXISTS spools_fts_on_insert AFTER INSERT ON spools
+                    FOR EACH ROW BEGIN
+                        {insert_spool}
+                    END
+                    """.format(insert_spool=insert_spool)),
+                DDL("""
+                    CREATE TRIGGER IF NOT EXISTS spools_fts_on_update AFTER UPDATE OF name, profile_id ON spools
+                    FOR EACH ROW BEGIN
+                        DELETE FROM spools_fts WHERE rowid = old.id;
+                        {insert_spool}
+                    END
+                    """.format(insert_spool=insert_spool)),
+                DDL("""
+                    CREATE TRIGGER IF NOT EXISTS spools_fts_on_delete AFTER DELETE ON spools
+                    FOR EACH ROW BEGIN
+                        DELETE FROM spools_fts WHERE rowid = old.id;
+                    END
+                    """),
+                DDL("""
+                    CREATE TRIGGER IF NOT EXISTS profiles_fts_on_update AFTER UPDATE OF vendor, material ON profiles
+                    FOR EACH ROW BEGIN
+                        DELETE FROM spools_fts WHERE rowid IN (SELECT id FROM spools WHERE profile_id = new.id);
+                        INSERT INTO spools_fts (rowid, name, vendor, material)
+                        SELECT id, name, new.vendor, new.material FROM spools WHERE profile_id = new.id;
+                    END
+                    """),
+                DDL("DELETE FROM spools_fts"),
+                DDL("""
+                    INSERT INTO spools_fts (rowid, name, vendor, material)
+                    SELECT spools.id, spools.name, profiles.vendor, profiles.material
+                    FROM spools JOIN profiles ON profiles.id = spools.profile_id
+                    """),
+            ]
+
+    # prebuilt statements
+
+    def _prebuilt_statements(self):
+        for value in vars(self).values():
+            for statement in (value.values() if isinstance(value, dict) else [value]):
+                if isinstance(statement, Executable):
+                    yield statement
+
+    def _prepare_statements(self):
+        # RETURNING is only available for PostgreSQL, on SQLite the written row is read back within the same
+        # transaction instead
+        self.supports_returning = self.engine_dialect_is(self.DIALECT_POSTGRESQL)
+
+        # Statements are built once with bind parameters, so that the compiled form can be reused from the
+        # compiled cache instead of rebuilding and recompiling the expression tree on every call.
+        spools_with_profile = self.spools.join(self.profiles, self.spools.c.profile_id == self.profiles.c.id)
+        selections_with_spool = self.selections\
+            .join(self.spools, self.selections.c.spool_id == self.spools.c.id)\
+            .join(self.profiles, self.spools.c.profile_id == self.profiles.c.id)
+
+        self._select_all_profiles = select([self.profiles])\
+            .order_by(self.profiles.c.material, self.profiles.c.vendor)
+        self._select_profile = select([self.profiles]).where(self.profiles.c.id == bindparam("profile_id"))
+        self._select_profiles_lastmodified = select([self.modifications.c.changed_at])\
+            .where(self.modifications.c.table_name == "profiles")
+        self._insert_profile = insert(self.profiles)
+        # every update increments the row version, the update is conditional if an expected version is given
+        self._update_profile = update(self.profiles)\
+            .where(self.profiles.c.id == bindparam("profile_id"))\
+            .where(or_(bindparam("profile_version").is_(None),
+                       self.profiles.c.version == bindparam("profile_version")))\
+            .values(version=self.profiles.c.version + 1)
+        self._select_profile_exists = select([self.profiles.c.id])\
+            .where(self.profiles.c.id == bindparam("profile_id"))
+        if self.supports_returning:
+            self._insert_profile_returning = self._insert_profile.returning(*self.profiles.c)
+            self._update_profile_returning = self._update_profile.returning(*self.profiles.c)
+        self._delete_profile = delete(self.profiles).where(self.profiles.c.id == bindparam("profile_id"))
+
+        # Remaining amount of filament on the spool, the length in mm is unknown without density and diameter. The
+        # expressions on the spool columns alone are backed by the expression indexes, see REMAINING_KEYS.
+        remaining_weight = self.spools.c.weight - self.spools.c.used
+        weight_per_mm = PI * self.profiles.c.diameter * self.profiles.c.diameter / 4000 * self.profiles.c.density
+        remaining_length = case([(weight_per_mm > 0, remaining_weight / weight_per_mm)], else_=None)
+        remaining_percent = remaining_weight * literal_column("100") /\
+            func.Function("nullif", self.spools.c.weight, literal_column("0"))
+        self._remaining_columns = [remaining_weight.label("remaining_weight"),
+                                   remaining_length.label("remaining_length"),
+                                   remaining_percent.label("remaining_percent")]
+        self._remaining_expressions = dict(remaining_weight=remaining_weight, remaining_length=remaining_length,
+                                           remaining_percent=remaining_percent)
+        spool_columns = [self.spools, self.profiles] + self._remaining_columns
+
+        self._select_all_spools = select(spool_columns).select_from(spools_with_profile)\
+            .order_by(self.spools.c.name)
+        self._select_spool = select(spool_columns).select_from(spools_with_profile)\
+            .where(self.spools.c.id == bindparam("spool_id"))
+        self._select_spools_lastmodified = select([func.max(self.modifications.c.changed_at)])\
+            .where(self.modifications.c.table_name.in_(["spools", "profiles"]))
+        # normalized spools carry the remaining amounts like the nested ones, the inventory only the stored columns
+        self._normalized_spool_keys = self._spool_keys + self.REMAINING_KEYS
+        self._select_all_spools_normalized = select([self.spools] + self._remaining_columns)\
+            .select_from(spools_with_profile).order_by(self.spools.c.name)
+        self._select_inventory_spools = select([self.spools]).order_by(self.spools.c.name)
+        self._select_spool_profiles_normalized = select([self.profiles])\
+            .where(self.profiles.c.id.in_(select([self.spools.c.profile_id]))).order_by(self.profiles.c.id)
+        self._insert_spool = insert(self.spools)
+        self._update_spool = update(self.spools)\
+            .where(self.spools.c.id == bindparam("spool_id"))\
+            .where(or_(bindparam("spool_version").is_(None), self.spools.c.version == bindparam("spool_version")))\
+            .values(version=self.spools.c.version + 1)
+        self._select_spool_exists = select([self.spools.c.id]).where(self.spools.c.id == bindparam("spool_id"))
+        self._select_spool_by_tag = select(spool_columns).select_from(spools_with_profile)\
+            .where(self.spools.c.tag == bindparam("spool_tag"))
+        if self.supports_returning:
+            returned_columns = list(self.spools.c) + list(self.profiles.c) + self._remaining_columns
+            self._insert_spool_returning = self._insert_spool.returning(self.spools.c.id)
+            # the joined profile has to be taken from the new profile_id if the update changes it
+            self._update_spool_returning = self._update_spool\
+                .where(self.profiles.c.id == self.spools.c.profile_id).returning(*returned_columns)
+            self._update_spool_profile_returning = self._update_spool\
+                .where(self.profiles.c.id == bindparam("spool_profile_id")).returning(*returned_columns)
+        self._delete_spool = delete(self.spools).where(self.spools.c.id == bindparam("spool_id"))
+
+        self._select_all_selections = select([self.selections] + spool_columns)\
+            .select_from(selections_with_spool)\
+            .where(self.selections.c.client_id == bindparam("selection_client_id"))\
+            .order_by(self.selections.c.tool)
+        self._select_selection = select([self.selections] + spool_columns)\
+            .select_from(selections_with_spool)\
+            .where((self.selections.c.tool == bindparam("selection_tool")) &
+                   (self.selections.c.client_id == bindparam("selection_client_id")))
+        selected_spool_ids = select([self.selections.c.spool_id])\
+            .where(self.selections.c.client_id == bindparam("selection_client_id"))
+        self._select_all_selections_normalized = select([self.selections.c.tool, self.selections.c.spool_id])\
+            .where(self.selections.c.client_id == bindparam("selection_client_id"))\
+            .order_by(self.selections.c.tool)
+        self._select_selection_spools_normalized = select([self.spools] + self._remaining_columns)\
+            .select_from(spools_with_profile).where(self.spools.c.id.in_(selected_spool_ids)).order_by(self.spools.c.id)
+        self._select_selection_profiles_normalized = select([self.profiles])\
+            .where(self.profiles.c.id.in_(select([self.spools.c.profile_id])
+                                          .where(self.spools.c.id.in_(selected_spool_ids))))\
+            .order_by(self.profiles.c.id)
+
+        # Spools of which the remaining amount covers the demand, smallest first. A demanded length is converted
+        # into the weight per profile, so that both kinds of demand compare against the indexed remaining weight.
+        self._select_spool_recommendations = dict()
+        for demand in ["length", "weight"]:
+            required = bindparam("recommend_amount")
+            if demand == "length":
+                required = required * weight_per_mm
+            for by_material in [False, True]:
+                for by_diameter in [False, True]:
+                    stmt = select(spool_columns)\
+                        .select_from(spools_with_profile).where(remaining_weight >= required)
+                    if by_material:
+                        stmt = stmt.where(self.profiles.c.material == bindparam("recommend_material"))
+                    if by_diameter:
+                        stmt = stmt.where(self.profiles.c.diameter.between(bindparam("recommend_diameter_min"),
+                                                                           bindparam("recommend_diameter_max")))
+                    order = remaining_weight if demand == "weight" else remaining_length
+                    self._select_spool_recommendations[(demand, by_material, by_diameter)] = stmt\
+                        .order_by(order, self.spools.c.id).limit(bindparam("recommend_limit"))
+
+        # selections of all clients, the rows are already ordered by the index on client_id and tool
+        self._select_all_client_selections = \
+            select([self.selections] + spool_columns + [self.clients.c.name])\
+            .select_from(selections_with_spool.outerjoin(self.clients,
+                                                         self.clients.c.client_id == self.selections.c.client_id))\
+            .order_by(self.selections.c.client_id, self.selections.c.tool)
+        self._select_all_client_selections_lastmodified = select([func.max(self.modifications.c.changed_at)])\
+            .where(self.modifications.c.table_name.in_(["selections", "spools", "profiles", "clients"]))
+        self._update_client = update(self.clients).where(self.clients.c.client_id == bindparam("client_client_id"))
+        self._insert_client = insert(self.clients)
+
+        if self.engine_dialect_is(self.DIALECT_SQLITE):
+            self._upsert_selection = insert(self.selections).prefix_with("OR REPLACE")
+            self._insert_journal_key = insert(self.journal_applied).prefix_with("OR IGNORE")
+            # the rollup is updated first and only inserted if it doesn't exist yet, see _record_debit
+            self._upsert_rollup = None
+        elif self.engine_dialect_is(self.DIALECT_POSTGRESQL):
+            from sqlalchemy.dialects.postgresql import insert as pg_insert
+
+            stmt = pg_insert(self.selections)
+            self._upsert_selection = stmt.on_conflict_do_update(constraint="selections_pkey",
+                                                                set_=dict(spool_id=stmt.excluded.spool_id))
+            self._insert_journal_key = pg_insert(self.journal_applied).on_conflict_do_nothing()
+            stmt = pg_insert(self.usage_rollups)
+            self._upsert_rollup = stmt.on_conflict_do_update(
+                constraint="usage_rollups_pkey",
+                set_=dict((key, self.usage_rollups.c[key] + stmt.excluded[key])
+                          for key in ["length", "weight", "cost", "debits"]))
+
+        # adds the weight of the given length of filament to the spool selected for the tool
+        used_weight = select([bindparam("usage_length") * PI * self.profiles.c.diameter * self.profiles.c.diameter /
+                              4000 * self.profiles.c.density])\
+            .where(self.profiles.c.id == self.spools.c.profile_id).as_scalar()
+        selected_spool_id = select([self.selections.c.spool_id])\
+            .where((self.selections.c.tool == bindparam("selection_tool")) &
+                   (self.selections.c.client_id == bindparam("selection_client_id"))).as_scalar()
+        self._update_spool_usage = update(self.spools).where(self.spools.c.id == selected_spool_id)\
+            .values(used=self.spools.c.used + used_weight, version=self.spools.c.version + 1)
+        self._delete_journal_keys = delete(self.journal_applied)\
+            .where(self.journal_applied.c.applied_at < bindparam("applied_before"))
+
+        self._insert_debit = insert(self.debits)
+        self._insert_rollup = insert(self.usage_rollups)
+        self._update_rollup = update(self.usage_rollups)\
+            .where((self.usage_rollups.c.day == bindparam("rollup_day")) &
+                   (self.usage_rollups.c.client_id == bindparam("rollup_client_id")) &
+                   (self.usage_rollups.c.vendor == bindparam("rollup_vendor")) &
+                   (self.usage_rollups.c.material == bindparam("rollup_material")))\
+            .values(length=self.usage_rollups.c.length + bindparam("rollup_length"),
+                    weight=self.usage_rollups.c.weight + bindparam("rollup_weight"),
+                    cost=self.usage_rollups.c.cost + bindparam("rollup_cost"),
+                    debits=self.usage_rollups.c.debits + 1)
+
+        job_summary_columns = [c for c in self.jobs.c if c.name not in ("layers", "features")]
+        self._select_all_jobs = select(job_summary_columns)\
+            .where(self.jobs.c.client_id == bindparam("job_client_id"))\
+            .order_by(self.jobs.c.finished_at.desc()).limit(bindparam("job_limit"))
+        self._select_job = select([self.jobs]).where(self.jobs.c.id == bindparam("job_id"))
+        self._insert_job = insert(self.jobs)
+
+        if self.supports_search_index:
+            if self.engine_dialect_is(self.DIALECT_POSTGRESQL):
+                search = table_clause("spool_search", column_clause("spool_id"), column_clause("document"))
+                query = func.to_tsquery("simple", bindparam("search_query"))
+                match = search.c.document.op("@@")(query)
+                rank = func.ts_rank(search.c.document, query).desc()
+                spools_searched = spools_with_profile.join(search, search.c.spool_id == self.spools.c.id)
+            else:
+                search = table_clause("spools_fts", column_clause("rowid"))
+                match = literal_column("spools_fts").match(bindparam("search_query"))
+                # matches of the name rank higher than matches of vendor and material
+                rank = literal_column("bm25(spools_fts, 2.0, 1.0, 1.0)")
+                spools_searched = spools_with_profile.join(search, search.c.rowid == self.spools.c.id)
+            self._select_spools_search = select([self.spools, self.profiles] + self._remaining_columns)\
+                .select_from(spools_searched)\
+                .where(match).order_by(rank, self.spools.c.name)\
+                .limit(bindparam("search_limit")).offset(bindparam("search_offset"))
+            self._count_spools_search = select([func.count()]).select_from(spools_searched).where(match)
+
+    # profiles
+
+    @read_operation
+    def get_all_profiles(self, conn):
+        result = conn.execute(self._select_all_profiles)
         return self._result_to_dict(result)
 
-    def get_profiles_lastmodified(self):
-        with self.lock, self.conn.begin():
-            stmt = select([self.modifications.c.changed_at]).where(self.modifications.c.table_name == "profiles")
-            return self.conn.execute(stmt).scalar()
+    @read_operation
+    def get_profiles_lastmodified(self, conn):
+        return conn.execute(self._select_profiles_lastmodified).scalar()
 
-    def get_profile(self, identifier):
-        with self.lock, self.conn.begin():
-            stmt = select([self.profiles]).where(self.profiles.c.id == identifier)\
-                .order_by(self.profiles.c.material, self.profiles.c.vendor)
-            result = self.conn.execute(stmt)
+    @read_operation
+    def get_profile(self, conn, identifier):
+        result = conn.execute(self._select_profile, profile_id=identifier)
         return self._result_to_dict(result, one=True)
 
+    def _profile_values(self, data):
+        return dict((key, data[key]) for key in self.PROFILE_FIELDS if key in data)
+
+    @write_operation
     def create_profile(self, data):
-        with self.lock, self.conn.begin():
-            stmt = insert(self.profiles)\
-                .values(vendor=data["vendor"], material=data["material"], density=data["density"],
-                        diameter=data["diameter"])
-            result = self.conn.execute(stmt)
-        data["id"] = result.lastrowid
-        return data
-
-    def update_profile(self, identifier, data):
-        with self.lock, self.conn.begin():
-            stmt = update(self.profiles).where(self.profiles.c.id == identifier)\
-                .values(vendor=data["vendor"], material=data["material"], density=data["density"],
-                        diameter=data["diameter"])
-            self.conn.execute(stmt)
-        return data
+        values = self._profile_values(data)
+        if self.supports_returning:
+            result = self.conn.execute(self._insert_profile_returning, **values)
+        else:
+            identifier = self.conn.execute(self._insert_profile, **values).lastrowid
+            result = self.conn.execute(self._select_profile, profile_id=identifier)
+        return self._result_to_dict(result, one=True)
 
+    @write_operation
+    def update_profile(self, identifier, data, version=None):
+        values = self._profile_values(data)
+        if self.supports_returning:
+            result = self.conn.execute(self._update_profile_returning, profile_id=identifier,
+                                       profile_version=version, **values)
+            row = result.fetchone()
+        else:
+            result = self.conn.execute(self._update_profile, profile_id=identifier, profile_version=version,
+                                       **values)
+            row = None
+            if result.rowcount > 0:
+                row = self.conn.execute(self._select_profile, profile_id=identifier).fetchone()
+        if row is None and version is not None:
+            self._check_version_conflict(self._select_profile_exists, profile_id=identifier)
+        return dict(row) if row is not None else None
+
+    @write_operation
     def delete_profile(self, identifier):
-        with self.lock, self.conn.begin():
-            stmt = delete(self.profiles).where(self.profiles.c.id == identifier)
-            self.conn.execute(stmt)
+        self.conn.execute(self._delete_profile, profile_id=identifier)
 
     # spools
 
-    def _build_spool_dict(self, row, column_names):
-        spool = dict(profile=dict())
-        for i, value in enumerate(row):
-            if i < len(self.spools.columns):
-                spool[column_names[i]] = value
-            else:
-                spool["profile"][column_names[i]] = value
+    def _build_spool_dict(self, row):
+        num_spool_columns = len(self._spool_keys)
+        num_columns = num_spool_columns + len(self._profile_keys)
+        spool = dict(zip(self._spool_keys, row[:num_spool_columns]))
+        spool["profile"] = dict(zip(self._profile_keys, row[num_spool_columns:num_columns]))
+        spool.update(zip(self.REMAINING_KEYS, row[num_columns:]))
         del spool["profile_id"]
         return spool
 
-    def get_all_spools(self):
-        with self.lock, self.conn.begin():
-            j = self.spools.join(self.profiles, self.spools.c.profile_id == self.profiles.c.id)
-            stmt = select([self.spools, self.profiles]).select_from(j).order_by(self.spools.c.name)
-            result = self.conn.execute(stmt)
-        return [self._build_spool_dict(row, row.keys()) for row in result.fetchall()]
+    @read_operation
+    def get_all_spools(self, conn):
+        result = conn.execute(self._select_all_spools)
+        return [self._build_spool_dict(row) for row in result.fetchall()]
 
-    def get_spools_lastmodified(self):
-        with self.lock, self.conn.begin():
-            stmt = select([func.max(self.modifications.c.changed_at)])\
-                .where(self.modifications.c.table_name.in_(["spools", "profiles"]))
-            return self.conn.execute(stmt).scalar()
+    @read_operation
+    def get_all_spools_normalized(self, conn):
+        spools = conn.execute(self._select_all_spools_normalized).fetchall()
+        profiles = conn.execute(self._select_spool_profiles_normalized).fetchall()
+        return dict(profiles=[dict(zip(self._profile_keys, row)) for row in profiles],
+                    spools=self._rows_to_columns(self._normalized_spool_keys, spools))
 
-    def get_spool(self, identifier):
-        with self.lock, self.conn.begin():
-            j = self.spools.join(self.profiles, self.spools.c.profile_id == self.profiles.c.id)
-            stmt = select([self.spools, self.profiles]).select_from(j)\
-                .where(self.spools.c.id == identifier).order_by(self.spools.c.name)
-            result = self.conn.execute(stmt)
+    @read_operation
+    def get_spools_lastmodified(self, conn):
+        return conn.execute(self._select_spools_lastmodified).scalar()
+
+    @read_operation
+    def get_spool(self, conn, identifier):
+        result = conn.execute(self._select_spool, spool_id=identifier)
         row = result.fetchone()
-        return self._build_spool_dict(row, row.keys()) if row is not None else None
+        return self._build_spool_dict(row) if row is not None else None
+
+    @read_operation
+    def search_spools(self, conn, query, limit=20, offset=0):
+        # every term has to match the beginning of a word in either the spool name, vendor or material
+        terms = re.findall(r"\w+", query, re.UNICODE)
+        if not terms:
+            return dict(spools=[], total=0)
+
+        if not self.supports_search_index:
+            return self._search_spools_like(conn, terms, limit, offset)
+
+        if self.engine_dialect_is(self.DIALECT_POSTGRESQL):
+            search_query = " & ".join(term + ":*" for term in terms)
+        else:
+            search_query = " ".join('"{term}"*'.format(term=term) for term in terms)
+        total = conn.execute(self._count_spools_search, search_query=search_query).scalar()
+        result = conn.execute(self._select_spools_search, search_query=search_query, search_limit=limit,
+                              search_offset=offset)
+        return dict(spools=[self._build_spool_dict(row) for row in result.fetchall()], total=total)
 
+    def _search_spools_like(self, conn, terms, limit, offset):
+        # unranked and without index, only used if SQLite doesn't provide FTS5
+        columns = [self.spools.c.name, self.profiles.c.vendor, self.profiles.c.material]
+        patterns = ["%" + term.replace("_", "\\_") + "%" for term in terms]
+        match = and_(*[or_(*[col.ilike(pattern, escape="\\") for col in columns]) for pattern in patterns])
+        spools_with_profile = self.spools.join(self.profiles, self.spools.c.profile_id == self.profiles.c.id)
+        total = conn.execute(select([func.count()]).select_from(spools_with_profile).where(match)).scalar()
+        result = conn.execute(select([self.spools, self.profiles] + self._remaining_columns)
+                              .select_from(spools_with_profile).where(match)
+                              .order_by(self.spools.c.name).limit(limit).offset(offset))
+        return dict(spools=[self._build_spool_dict(row) for row in result.fetchall()], total=total)
+
+    @read_operation
+    def get_spools(self, conn, material=None, vendor=None, minimum=None, maximum=None, sort="name",
+                   descending=False, limit=None, offset=0):
+        """
+        Returns the spools matching the given profile attributes and ranges of the remaining amounts, which are
+        dicts with any of REMAINING_KEYS. Spools without known remaining length never match a length range.
+        """
+        conditions = []
+        if material is not None:
+            conditions.append(self.profiles.c.material == material)
+        if vendor is not None:
+            conditions.append(self.profiles.c.vendor == vendor)
+        for key, value in (minimum or dict()).items():
+            conditions.append(self._remaining_expressions[key] >= value)
+        for key, value in (maximum or dict()).items():
+            conditions.append(self._remaining_expressions[key] <= value)
+
+        order = self._remaining_expressions.get(sort)
+        if order is None:
+            order = self.spools.c.name if sort == "name" else self.profiles.c[sort]
+        # unknown amounts are ordered last in both directions
+        order = [order.is_(None), order.desc() if descending else order.asc()]
+
+        spools_with_profile = self.spools.join(self.profiles, self.spools.c.profile_id == self.profiles.c.id)
+        total = conn.execute(select([func.count()]).select_from(spools_with_profile)
+                             .where(and_(*conditions))).scalar()
+        stmt = select([self.spools, self.profiles] + self._remaining_columns).select_from(spools_with_profile)\
+            .where(and_(*conditions)).order_by(*(order + [self.spools.c.id])).offset(offset)
+        if limit is not None:
+            stmt = stmt.limit(limit)
+        return dict(spools=[self._build_spool_dict(row) for row in conn.execute(stmt)], total=total)
+
+    @read_operation
+    def recommend_spools(self, conn, demands, limit=3):
+        """
+        Returns the best fitting spools for each demand, a dict with either length (mm) or weight (g) and optionally
+        material and diameter. The amounts are expected to include any margin.
+        """
+        recommendations = []
+        for demand in demands:
+            kind = "length" if demand.get("length") is not None else "weight"
+            material = demand.get("material")
+            diameter = demand.get("diameter")
+            stmt = self._select_spool_recommendations[(kind, material is not None, diameter is not None)]
+            params = dict(recommend_amount=demand[kind], recommend_limit=limit)
+            if material is not None:
+                params["recommend_material"] = material
+            if diameter is not None:
+                params["recommend_diameter_min"] = diameter - self.DIAMETER_TOLERANCE
+                params["recommend_diameter_max"] = diameter + self.DIAMETER_TOLERANCE
+            recommendations.append([self._build_spool_dict(row) for row in conn.execute(stmt, **params)])
+        return recommendations
+
+    @read_operation
+    def get_spool_by_tag(self, conn, tag):
+        row = conn.execute(self._select_spool_by_tag, spool_tag=tag).fetchone()
+        return self._build_spool_dict(row) if row is not None else None
+
+    def _spool_values(self, data):
+        values = dict((key, data[key]) for key in self.SPOOL_FIELDS if key in data)
+        if "tag" in values and not values["tag"]:
+            # spools without tag are stored as NULL, which the unique index doesn't compare
+            values["tag"] = None
+        if "id" in (data.get("profile") or dict()):
+            values["profile_id"] = data["profile"]["id"]
+        return values
+
+    @write_operation
     def create_spool(self, data):
-        with self.lock, self.conn.begin():
-            stmt = insert(self.spools)\
-                .values(name=data["name"], cost=data["cost"], weight=data["weight"], used=data["used"],
-                        temp_offset=data["temp_offset"], profile_id=data["profile"]["id"])
-            result = self.conn.execute(stmt)
-        data["id"] = result.lastrowid
-        return data
-
-    def update_spool(self, identifier, data):
-        with self.lock, self.conn.begin():
-            stmt = update(self.spools).where(self.spools.c.id == identifier)\
-                .values(name=data["name"], cost=data["cost"], weight=data["weight"], used=data["used"],
-                        temp_offset=data["temp_offset"], profile_id=data["profile"]["id"])
-            self.conn.execute(stmt)
-        return data
+        values = self._spool_values(data)
+        if self.supports_returning:
+            identifier = self.conn.execute(self._insert_spool_returning, **values).scalar()
+        else:
+            identifier = self.conn.execute(self._insert_spool, **values).lastrowid
+        row = self.conn.execute(self._select_spool, spool_id=identifier).fetchone()
+        return self._build_spool_dict(row)
 
+    @write_operation
+    def update_spool(self, identifier, data, version=None):
+        values = self._spool_values(data)
+        if self.supports_returning:
+            if "profile_id" in values:
+                result = self.conn.execute(self._update_spool_profile_returning, spool_id=identifier,
+                                           spool_version=version, spool_profile_id=values["profile_id"],
+                                           **values)
+            else:
+                result = self.conn.execute(self._update_spool_returning, spool_id=identifier,
+                                           spool_version=version, **values)
+            row = result.fetchone()
+        else:
+            result = self.conn.execute(self._update_spool, spool_id=identifier, spool_version=version, **values)
+            row = None
+            if result.rowcount > 0:
+                row = self.conn.execute(self._select_spool, spool_id=identifier).fetchone()
+        if row is None and version is not None:
+            self._check_version_conflict(self._select_spool_exists, spool_id=identifier)
+        return self._build_spool_dict(row) if row is not None else None
+
+    @write_operation
     def delete_spool(self, identifier):
-        with self.lock, self.conn.begin():
-            stmt = delete(self.spools).where(self.spools.c.id == identifier)
-            self.conn.execute(stmt)
+        self.conn.execute(self._delete_spool, spool_id=identifier)
 
     # selections
 
-    def _build_selection_dict(self, row, column_names):
-        sel = dict(spool=dict(profile=dict()))
-        for i, value in enumerate(row):
-            if i < len(self.selections.columns):
-                sel[column_names[i]] = value
-            elif i < len(self.selections.columns)+len(self.spools.columns):
-                sel["spool"][column_names[i]] = value
-            else:
-                sel["spool"]["profile"][column_names[i]] = value
+    def _build_selection_dict(self, row):
+        num_selection_columns = len(self._selection_keys)
+        sel = dict(zip(self._selection_keys, row[:num_selection_columns]))
+        sel["spool"] = self._build_spool_dict(row[num_selection_columns:])
         del sel["spool_id"]
-        del sel["spool"]["profile_id"]
         return sel
 
-    def get_all_selections(self, client_id):
-        with self.lock, self.conn.begin():
-            j1 = self.selections.join(self.spools, self.selections.c.spool_id == self.spools.c.id)
-            j2 = j1.join(self.profiles, self.spools.c.profile_id == self.profiles.c.id)
-            stmt = select([self.selections, self.spools, self.profiles]).select_from(j2)\
-                .where(self.selections.c.client_id == client_id).order_by(self.selections.c.tool)
-        result = self.conn.execute(stmt)
-        return [self._build_selection_dict(row, row.keys()) for row in result.fetchall()]
-
-    def get_selection(self, identifier, client_id):
-        with self.lock, self.conn.begin():
-            j1 = self.selections.join(self.spools, self.selections.c.spool_id == self.spools.c.id)
-            j2 = j1.join(self.profiles, self.spools.c.profile_id == self.profiles.c.id)
-            stmt = select([self.selections, self.spools, self.profiles]).select_from(j2)\
-                .where((self.selections.c.tool == identifier) & (self.selections.c.client_id == client_id))
-        result = self.conn.execute(stmt)
+    @read_operation
+    def get_all_selections(self, conn, client_id):
+        result = conn.execute(self._select_all_selections, selection_client_id=client_id)
+        return [self._build_selection_dict(row) for row in result.fetchall()]
+
+    @read_operation
+    def get_all_selections_normalized(self, conn, client_id):
+        selections = conn.execute(self._select_all_selections_normalized,
+                                  selection_client_id=client_id).fetchall()
+        spools = conn.execute(self._select_selection_spools_normalized,
+                              selection_client_id=client_id).fetchall()
+        profiles = conn.execute(self._select_selection_profiles_normalized,
+                                selection_client_id=client_id).fetchall()
+        return dict(profiles=[dict(zip(self._profile_keys, row)) for row in profiles],
+                    spools=self._rows_to_columns(self._normalized_spool_keys, spools),
+                    selections=self._rows_to_columns(["tool", "spool_id"], selections))
+
+    @read_operation
+    def get_selection(self, conn, identifier, client_id):
+        result = conn.execute(self._select_selection, selection_tool=identifier,
+                              selection_client_id=client_id)
         row = result.fetchone()
-        return self._build_selection_dict(row, row.keys()) if row is not None else dict(tool=identifier, spool=None)
+        return self._build_selection_dict(row) if row is not None else dict(tool=identifier, spool=None)
 
+    @write_operation
     def update_selection(self, identifier, client_id, data):
-        with self.lock, self.conn.begin():
-            values = dict()
-            if self.engine_dialect_is(self.DIALECT_SQLITE):
-                stmt = insert(self.selections).prefix_with("OR REPLACE")\
-                    .values(tool=identifier, client_id=client_id, spool_id=data["spool"]["id"])
-            elif self.engine_dialect_is(self.DIALECT_POSTGRESQL):
-                stmt = pg_insert(self.selections)\
-                    .values(tool=identifier, client_id=client_id, spool_id=data["spool"]["id"])\
-                    .on_conflict_do_update(constraint="selections_pkey", set_=dict(spool_id=data["spool"]["id"]))
-            self.conn.execute(stmt)
-        return self.get_selection(identifier, client_id)
+        self.conn.execute(self._upsert_selection, tool=identifier, client_id=client_id,
+                          spool_id=data["spool"]["id"])
+        row = self.conn.execute(self._select_selection, selection_tool=identifier,
+                                selection_client_id=client_id).fetchone()
+        return self._build_selection_dict(row) if row is not None else dict(tool=identifier, spool=None)
 
+    @read_operation
+    def get_all_client_selections(self, conn):
+        clients = []
+        for row in conn.execute(self._select_all_client_selections):
+            selection = self._build_selection_dict(row)
+            del selection["client_id"]
+            client_id = row[self.selections.c.client_id]
+            if not clients or clients[-1]["client_id"] != client_id:
+                clients.append(dict(client_id=client_id, name=row[self.clients.c.name], selections=[]))
+            clients[-1]["selections"].append(selection)
+        return clients
+
+    @read_operation
+    def get_all_client_selections_lastmodified(self, conn):
+        return conn.execute(self._select_all_client_selections_lastmodified).scalar()
+
+    @write_operation
+    def set_client_name(self, client_id, name):
+        if self.conn.execute(self._update_client, client_client_id=client_id, name=name).rowcount == 0:
+            self.conn.execute(self._insert_client, client_id=client_id, name=name)
+
+    @read_operation
+    def get_inventory(self, conn, client_id):
+        # profiles, spools and selections read within one transaction, spools and selections column-wise
+        profiles = conn.execute(self._select_all_profiles).fetchall()
+        spools = conn.execute(self._select_inventory_spools).fetchall()
+        selections = conn.execute(self._select_all_selections_normalized,
+                                  selection_client_id=client_id).fetchall()
+        return dict(profiles=[dict(zip(self._profile_keys, row)) for row in profiles],
+                    spools=self._rows_to_columns(self._spool_keys, spools),
+                    selections=self._rows_to_columns(["tool", "spool_id"], selections))
+
+    # journal
+
+    @write_operation
+    def apply_journal_entry(self, key, operation, payload):
+        result = self.conn.execute(self._insert_journal_key, key=key, applied_at=datetime.utcnow())
+        if result.rowcount == 0:
+            # entry has already been applied
+            return None
+
+        if operation == "usage":
+            # entries written before recorded_at was added are accounted to the time they are applied
+            recorded_at = payload.get("recorded_at")
+            created_at = datetime.utcfromtimestamp(recorded_at) if recorded_at is not None else datetime.utcnow()
+            return self._debit_selected_spool(payload["client_id"], payload["tool"], payload["length"], created_at)
+        elif operation == "selection":
+            self.conn.execute(self._upsert_selection, tool=payload["tool"], client_id=payload["client_id"],
+                              spool_id=payload["spool_id"])
+        else:
+            raise ValueError("Unknown journal operation '{operation}'".format(operation=operation))
+
+        row = self.conn.execute(self._select_selection, selection_tool=payload["tool"],
+                                selection_client_id=payload["client_id"]).fetchone()
+        if row is None:
+            return dict(tool=payload["tool"], spool=None)
+        return self._build_selection_dict(row)
+
+    @write_operation
+    def prune_journal_keys(self, max_age):
+        self.conn.execute(self._delete_journal_keys, applied_before=datetime.utcnow() - max_age)
+
+    # usage statistics
+
+    @write_operation
+    def debit_spool(self, client_id, tool, length):
+        """
+        Adds the weight of the given length of filament to the spool selected for the tool and records the debit.
+        Returns the selection with the updated spool.
+        """
+        return self._debit_selected_spool(client_id, tool, length, datetime.utcnow())
+
+    def _debit_selected_spool(self, client_id, tool, length, created_at):
+        # the used weight is incremented by the database, concurrent writes to the spool are not overwritten
+        self.conn.execute(self._update_spool_usage, usage_length=length, selection_tool=tool,
+                          selection_client_id=client_id)
+        row = self.conn.execute(self._select_selection, selection_tool=tool,
+                                selection_client_id=client_id).fetchone()
+        if row is None:
+            return dict(tool=tool, spool=None)
+
+        selection = self._build_selection_dict(row)
+        if length > 0:
+            self._record_debit(client_id, tool, selection["spool"], length, created_at)
+        return selection
+
+    def _record_debit(self, client_id, tool, spool, length, created_at):
+        profile = spool["profile"]
+        weight = length * PI * profile["diameter"] * profile["diameter"] / 4000 * profile["density"]
+        cost = spool["cost"] * weight / spool["weight"] if spool["weight"] > 0 else 0
+        self.conn.execute(self._insert_debit, client_id=client_id, tool=tool, spool_id=spool["id"],
+                          vendor=profile["vendor"], material=profile["material"], length=length, weight=weight,
+                          cost=cost, created_at=created_at)
+
+        if self._upsert_rollup is not None:
+            self.conn.execute(self._upsert_rollup, day=created_at.date(), client_id=client_id,
+                              vendor=profile["vendor"], material=profile["material"], length=length,
+                              weight=weight, cost=cost, debits=1)
+        else:
+            result = self.conn.execute(self._update_rollup, rollup_day=created_at.date(), rollup_client_id=client_id,
+                                       rollup_vendor=profile["vendor"], rollup_material=profile["material"],
+                                       rollup_length=length, rollup_weight=weight, rollup_cost=cost)
+            if result.rowcount == 0:
+                self.conn.execute(self._insert_rollup, day=created_at.date(), client_id=client_id,
+                                  vendor=profile["vendor"], material=profile["material"], length=length,
+                                  weight=weight, cost=cost, debits=1)
+
+    @read_operation
+    def get_usage_stats(self, conn, start, end, group_by=(), period="day"):
+        # sums the daily rollups within the date range, the number of rows read only depends on the range
+        rollups = self.usage_rollups
+        dimensions = [rollups.c[key] for key in group_by]
+        sums = [func.sum(rollups.c[key]).label(key) for key in ["length", "weight", "cost", "debits"]]
+        keys = list(dimensions)
+        if period != "total":
+            keys.insert(0, rollups.c.day)
+        stmt = select(keys + sums).where((rollups.c.day >= start) & (rollups.c.day <= end))
+        if keys:
+            stmt = stmt.group_by(*keys)
+
+        stats = dict()
+        for row in conn.execute(stmt):
+            key = tuple(row[column] for column in dimensions)
+            if period == "day":
+                key = (row["day"].isoformat(),) + key
+            elif period == "month":
+                key = (row["day"].strftime("%Y-%m"),) + key
+            entry = stats.get(key)
+            if entry is None:
+                entry = stats[key] = dict(zip(group_by, key[-len(group_by):] if group_by else ()))
+                if period != "total":
+                    entry["period"] = key[0]
+                entry.update(length=0.0, weight=0.0, cost=0.0, debits=0)
+            for name in ["length", "weight", "cost", "debits"]:
+                entry[name] += row[name] or 0
+        return [stats[key] for key in sorted(stats)]
+
+    # jobs
+
+    @read_operation
+    def get_all_jobs(self, conn, client_id, limit=100):
+        result = conn.execute(self._select_all_jobs, job_client_id=client_id, job_limit=limit)
+        return [self._build_job_dict(row) for row in result.fetchall()]
+
+    @read_operation
+    def get_job(self, conn, identifier):
+        row = conn.execute(self._select_job, job_id=identifier).fetchone()
+        return self._build_job_dict(row) if row is not None else None
+
+    @write_operation
+    def create_job(self, data):
+        values = dict(client_id=data["client_id"], name=data.get("name", ""), path=data.get("path", ""),
+                      status=data["status"], finished_at=data.get("finished_at", datetime.utcnow()),
+                      extrusion=json.dumps(data["extrusion"]))
+        for key in ["layers", "features"]:
+            values[key] = json.dumps(data[key]) if data.get(key) is not None else None
+        return self.conn.execute(self._insert_job, **values).inserted_primary_key[0]
+
+    @instrumented
     def export_data(self, dirpath):
+        from backports import csv
+
         def to_csv(table):
             with self.lock, self.conn.begin():
                 result = self.conn.execute(select([table]))
@@ -332,7 +1230,11 @@ class FilamentManager(object):
         for t in tables:
             to_csv(t)
 
+    @instrumented
     def import_data(self, dirpath):
+        from backports import csv
+        from sqlalchemy.dialects.postgresql import insert as pg_insert
+
         def from_csv(table):
             filepath = os.path.join(dirpath, table.name + ".csv")
             with io.open(filepath, mode="r", encoding="utf-8") as csv_file:
@@ -341,18 +1243,26 @@ class FilamentManager(object):
                 with self.lock, self.conn.begin():
                     for row in csv_reader:
                         values = dict(zip(header, row))
+                        if values.get("tag") == "":
+                            # CSV has no NULL, spools without tag are exported as empty string
+                            values["tag"] = None
+                        # Imported rows get a new version instead of the exported one, so that updates conditional on
+                        # a version read before the import fail instead of overwriting the imported data.
+                        values.pop("version", None)
 
                         if self.engine_dialect_is(self.DIALECT_SQLITE):
                             identifier = values[table.c.id.name]
                             # try to update entry
-                            stmt = update(table).values(values).where(table.c.id == identifier)
+                            stmt = update(table).values(values).values(version=table.c.version + 1)\
+                                .where(table.c.id == identifier)
                             if self.conn.execute(stmt).rowcount == 0:
                                 # identifier doesn't match any => insert new entry
                                 stmt = insert(table).values(values)
                                 self.conn.execute(stmt)
                         elif self.engine_dialect_is(self.DIALECT_POSTGRESQL):
                             stmt = pg_insert(table).values(values)\
-                                .on_conflict_do_update(index_elements=[table.c.id], set_=values)
+                                .on_conflict_do_update(index_elements=[table.c.id],
+                                                       set_=dict(values, version=table.c.version + 1))
                             self.conn.execute(stmt)
 
                     if self.engine_dialect_is(self.DIALECT_POSTGRESQL):
@@ -364,11 +1274,142 @@ class FilamentManager(object):
         for t in tables:
             from_csv(t)
 
+    # batches
+
+    @write_operation
+    def apply_profile_batch(self, operations):
+        errors = self._check_batch(self.profiles, operations)
+        deleted = [op["id"] for op in operations if op["action"] == "delete"]
+        if deleted:
+            stmt = select([self.spools.c.profile_id]).where(self.spools.c.profile_id.in_(deleted)).distinct()
+            in_use = set(row[0] for row in self.conn.execute(stmt))
+            errors.extend((index, "in_use") for index, op in enumerate(operations)
+                          if op["action"] == "delete" and op["id"] in in_use)
+        if errors:
+            raise BatchError(sorted(errors))
+
+        identifiers = self._apply_batch(self.profiles, self._update_profile, "profile", self._profile_values,
+                                        operations)
+        profiles = dict()
+        written = [identifier for identifier in identifiers if identifier is not None]
+        if written:
+            for row in self.conn.execute(select([self.profiles]).where(self.profiles.c.id.in_(written))):
+                profiles[row[self.profiles.c.id]] = dict(row)
+        return [profiles.get(identifier) for identifier in identifiers]
+
+    @write_operation
+    def apply_spool_batch(self, operations):
+        errors = self._check_batch(self.spools, operations)
+        referenced = set(op["spool"]["profile"]["id"] for op in operations
+                         if op["action"] != "delete" and "id" in (op["spool"].get("profile") or dict()))
+        if referenced:
+            stmt = select([self.profiles.c.id]).where(self.profiles.c.id.in_(referenced))
+            unknown = referenced - set(row[0] for row in self.conn.execute(stmt))
+            errors.extend((index, "unknown_profile") for index, op in enumerate(operations)
+                          if op["action"] != "delete" and self._spool_values(op["spool"]).get("profile_id") in unknown)
+        if errors:
+            raise BatchError(sorted(errors))
+
+        identifiers = self._apply_batch(self.spools, self._update_spool, "spool", self._spool_values,
+                                        operations)
+        spools = dict()
+        written = [identifier for identifier in identifiers if identifier is not None]
+        if written:
+            stmt = select([self.spools, self.profiles] + self._remaining_columns)\
+                .select_from(self.spools.join(self.profiles, self.spools.c.profile_id == self.profiles.c.id))\
+                .where(self.spools.c.id.in_(written))
+            for row in self.conn.execute(stmt):
+                spools[row[self.spools.c.id]] = self._build_spool_dict(row)
+        return [spools.get(identifier) for identifier in identifiers]
+
+    def _check_batch(self, table, operations):
+        # the rows are locked until the end of the transaction, so their versions can't change after the check
+        identifiers = [op["id"] for op in operations if op["action"] != "create"]
+        versions = dict()
+        if identifiers:
+            stmt = select([table.c.id, table.c.version]).where(table.c.id.in_(identifiers)).with_for_update()
+            versions = dict((row[0], row[1]) for row in self.conn.execute(stmt))
+
+        errors = []
+        for index, op in enumerate(operations):
+            if op["action"] == "create":
+                continue
+            if op["id"] not in versions:
+                # deleting an unknown row is not an error, same as for a single delete
+                if op["action"] == "update":
+                    errors.append((index, "unknown"))
+            elif op.get("version") is not None and op["version"] != versions[op["id"]]:
+                errors.append((index, "conflict"))
+        return errors
+
+    def _apply_batch(self, table, update_stmt, key, values_of, operations):
+        # returns the ids of the written rows in the order of the operations, None for deletions
+        identifiers = [op.get("id") if op["action"] == "update" else None for op in operations]
+
+        creates = [index for index, op in enumerate(operations) if op["action"] == "create"]
+        if creates:
+            rows = [values_of(operations[index][key]) for index in creates]
+            # All rows of a multi-row insert need the same columns, the columns of the first row are used otherwise.
+            # Only optional columns like the tag can be missing, the mandatory fields are validated by the API.
+            columns = set().union(*rows)
+            for values in rows:
+                for column in columns.difference(values):
+                    values[column] = None
+            if self.supports_returning:
+                # a single multi-row insert, PostgreSQL returns the ids in the order of the values
+                result = self.conn.execute(insert(table).values(rows).returning(table.c.id))
+                new_identifiers = [row[0] for row in result]
+            else:
+                # SQLite has no RETURNING, but assigns consecutive rowids to the rows of a multi-row insert, as the
+                # transaction holds the write lock. So the ids are derived from the rowid of the last row.
+                new_identifiers = []
+                chunk_size = max(1, self.SQLITE_MAX_VARIABLES // len(columns))
+                for start in range(0, len(rows), chunk_size):
+                    chunk = rows[start:start + chunk_size]
+                    last_identifier = self.conn.execute(insert(table).values(chunk)).lastrowid
+                    new_identifiers.extend(range(last_identifier - len(chunk) + 1, last_identifier + 1))
+            for index, identifier in zip(creates, new_identifiers):
+                identifiers[index] = identifier
+
+        # updates which write the same columns are executed together with executemany
+        updates = dict()
+        for op in operations:
+            if op["action"] == "update":
+                params = values_of(op[key])
+                columns = tuple(sorted(params))
+                params[key + "_id"] = op["id"]
+                params[key + "_version"] = None  # already checked
+                updates.setdefault(columns, []).append(params)
+        for params in updates.values():
+            self.conn.execute(update_stmt, params)
+
+        deleted = [op["id"] for op in operations if op["action"] == "delete"]
+        if deleted:
+            self.conn.execute(delete(table).where(table.c.id.in_(deleted)))
+
+        return identifiers
+
     # helper
 
+    def _check_version_conflict(self, exists_stmt, **params):
+        # a conditional update didn't match any row, either the row doesn't exist or its version has changed
+        if self.conn.execute(exists_stmt, **params).scalar() is not None:
+            raise VersionConflictError("Row has been modified concurrently")
+
+    def _build_job_dict(self, row):
+        job = dict(row)
+        for key in ["extrusion", "layers", "features"]:
+            if job.get(key) is not None:
+                job[key] = json.loads(job[key])
+        return job
+
     def _result_to_dict(self, result, one=False):
         if one:
             row = result.fetchone()
             return dict(row) if row is not None else None
         else:
             return [dict(row) for row in result.fetchall()]
+
+    def _rows_to_columns(self, keys, rows):
+        columns = zip(*rows) if rows else [()] * len(keys)
+        return dict((key, list(values)) for key, values in zip(keys, columns))
@@ -0,0 +1,126 @@
+# coding=utf-8
+
+__author__ = "Sven Lohrmann <malnvenshorn@gmail.com>"
+__license__ = "GNU Affero General Public License http://www.gnu.org/licenses/agpl.html"
+__copyright__ = "Copyright (C) 2017 Sven Lohrmann - Released under terms of the AGPLv3 License"
+
+import json
+import logging
+from datetime import datetime
+from multiprocessing import Lock
+from threading import Thread, Event
+from uuid import uuid4
+
+from sqlalchemy import create_engine
+from sqlalchemy.exc import IntegrityError, DataError
+from sqlalchemy.schema import MetaData, Table, Column
+from sqlalchemy.sql import insert, delete, select
+from sqlalchemy.types import INTEGER, VARCHAR, TEXT, TIMESTAMP
+
+from .writer import WriteFuture
+
+
+class Journal(object):
+    """
+    Durable local write-behind queue. Entries are appended to a SQLite file and replayed in order by a background
+    thread until the apply function succeeds. Every entry carries a unique key, which the apply function has to
+    record within its transaction to make the replay idempotent.
+    """
+
+    MIN_RETRY_DELAY = 1  # s
+    MAX_RETRY_DELAY = 60  # s
+
+    # errors which won't go away by retrying (constraint violations, malformed entries), the entry is discarded
+    PERMANENT_ERRORS = (IntegrityError, DataError, KeyError, ValueError)
+
+    def __init__(self, path, apply, on_applied=None):
+        self._logger = logging.getLogger(__name__)
+        self.apply = apply
+        self.on_applied = on_applied
+
+        metadata = MetaData()
+        self.entries = Table("journal", metadata,
+                             Column("id", INTEGER, primary_key=True, autoincrement=True),
+                             Column("key", VARCHAR(36), nullable=False, unique=True),
+                             Column("operation", VARCHAR(255), nullable=False),
+                             Column("payload", TEXT, nullable=False),
+                             Column("created_at", TIMESTAMP, nullable=False))
+
+        engine = create_engine("sqlite:///" + path, connect_args={"check_same_thread": False})
+        self.conn = engine.connect()
+        self.lock = Lock()
+        metadata.create_all(self.conn, checkfirst=True)
+
+        self._futures = dict()
+        self._stopped = False
+        self._wakeup = Event()
+        self.thread = Thread(target=self._run, name="FilamentManagerJournal")
+        self.thread.daemon = True
+        self.thread.start()
+
+    def append(self, operation, **payload):
+        key = str(uuid4())
+        future = WriteFuture()
+        with self.lock, self.conn.begin():
+            self.conn.execute(insert(self.entries).values(key=key, operation=operation, payload=json.dumps(payload),
+                                                          created_at=datetime.utcnow()))
+            self._futures[key] = future
+        self._wakeup.set()
+        return future
+
+    def pending(self):
+        with self.lock, self.conn.begin():
+            stmt = select([self.entries]).order_by(self.entries.c.id)
+            return self.conn.execute(stmt).fetchall()
+
+    def stop(self, timeout=None):
+        self._stopped = True
+        self._wakeup.set()
+        self.thread.join(timeout)
+        self.conn.close()
+
+    def _remove(self, entry):
+        with self.lock, self.conn.begin():
+            self.conn.execute(delete(self.entries).where(self.entries.c.id == entry["id"]))
+            return self._futures.pop(entry["key"], None)
+
+    def _run(self):
+        delay = self.MIN_RETRY_DELAY
+        while not self._stopped:
+            self._wakeup.clear()
+            try:
+                for entry in self.pending():
+                    if self._stopped:
+                        return
+                    self._replay(entry)
+            except Exception as e:
+                self._logger.warn("Failed to replay journal, retrying in {delay}s: {message}"
+                                  .format(delay=delay, message=str(e)))
+                self._wakeup.wait(delay)
+                delay = min(delay * 2, self.MAX_RETRY_DELAY)
+            else:
+                delay = self.MIN_RETRY_DELAY
+                self._wakeup.wait()
+
+    def _replay(self, entry):
+        payload = json.loads(entry["payload"])
+        try:
+            result = self.apply(entry["key"], entry["operation"], payload)
+        except self.PERMANENT_ERRORS as e:
+            self._logger.error("Discarding journal entry {key} ({operation}): {message}"
+                               .format(key=entry["key"], operation=entry["operation"], message=str(e)))
+            future = self._remove(entry)
+            if future is not None:
+                future.set_exception(e)
+            return
+
+        future = self._remove(entry)
+        if future is not None:
+            future.set_result(result)
+
+        if self.on_applied is not None:
+            try:
+                self.on_applied(entry["operation"], payload, result)
+            except Exception as e:
+                self._logger.error("Error while processing replayed journal entry {key}: {message}"
+                                   .format(key=entry["key"], message=str(e)))
@@ -4,32 +4,60 @@ __author__ = "Sven Lohrmann <malnvenshorn@gmail.com>"
 __license__ = "GNU Affero General Public License http://www.gnu.org/licenses/agpl.html"
 __copyright__ = "Copyright (C) 2017 Sven Lohrmann - Released under terms of the AGPLv3 License"
 
+from collections import OrderedDict
 from threading import Thread
 from select import select as wait_ready
 from sqlalchemy import create_engine, text
 
+from ..metrics import timer, NOTIFY_DISPATCH_SECONDS
+
 
 class PGNotify(object):
 
     def __init__(self, uri):
         self.subscriber = list()
+        self.running = True
 
         engine = create_engine(uri)
         conn = engine.connect()
-        conn.execute(text("LISTEN profiles; LISTEN spools;").execution_options(autocommit=True))
+        conn.execute(text("LISTEN profiles; LISTEN spools; LISTEN selections;").execution_options(autocommit=True))
 
         notify_thread = Thread(target=self.notify, args=(conn,))
         notify_thread.daemon = True
         notify_thread.start()
 
     def notify(self, conn):
-        while True:
+        while self.running:
             if wait_ready([conn.connection], [], [], 5) != ([], [], []):
                 conn.connection.poll()
-                while conn.connection.notifies:
-                    notify = conn.connection.notifies.pop()
+                received = timer()
+                for (pid, channel, action), identifiers in self.coalesce(conn.connection.notifies).items():
+                    payload = action if identifiers is None else action + ":" + ",".join(identifiers)
                     for func in self.subscriber:
-                        func(pid=notify.pid, channel=notify.channel, payload=notify.payload)
+                        func(pid=pid, channel=channel, payload=payload)
+                    # includes the time spent on handling the preceding notifications of the same poll
+                    NOTIFY_DISPATCH_SECONDS.observe(timer() - received)
+        conn.close()
+
+    @staticmethod
+    def coalesce(notifies):
+        # Every modified row is notified with its id, e.g. UPDATE:1. The notifications of one poll are merged per
+        # action, so that a transaction modifying many rows is dispatched once. None if any id is unknown.
+        coalesced = OrderedDict()
+        while notifies:
+            notify = notifies.pop(0)
+            action, _, identifier = notify.payload.partition(":")
+            key = (notify.pid, notify.channel, action)
+            identifiers = coalesced.setdefault(key, [])
+            if identifiers is not None and identifier:
+                identifiers.append(identifier)
+            else:
+                coalesced[key] = None
+        return coalesced
+
+    def close(self):
+        # the listener thread stops within the poll timeout
+        self.running = False
 
     def subscribe(self, func):
         self.subscriber.append(func)
@@ -0,0 +1,113 @@
+# coding=utf-8
+
+__author__ = "Sven Lohrmann <malnvenshorn@gmail.com>"
+__license__ = "GNU Affero General Public License http://www.gnu.org/licenses/agpl.html"
+__copyright__ = "Copyright (C) 2017 Sven Lohrmann - Released under terms of the AGPLv3 License"
+
+import logging
+from collections import deque
+from datetime import datetime
+from threading import Lock
+
+from sqlalchemy import event
+
+from ..metrics import timer
+
+
+class SlowQueryLog(object):
+    """
+    Records statements which take longer than the threshold, together with the shape of their bound parameters
+    and the query plan. Plans are captured at most once per statement within the explain interval, since
+    explaining is another round trip to the database.
+    """
+
+    EXPLAINABLE = ("SELECT", "INSERT", "UPDATE", "DELETE", "WITH")
+
+    def __init__(self, threshold, max_entries=50, explain_interval=60):
+        self._logger = logging.getLogger(__name__)
+        self.threshold = threshold  # s
+        self.explain_interval = explain_interval  # s
+        self.entries = deque(maxlen=max_entries)
+        self._explained_at = dict()
+        self._lock = Lock()
+
+    def attach(self, engine):
+        event.listen(engine, "before_cursor_execute", self._before_cursor_execute)
+        event.listen(engine, "after_cursor_execute", self._after_cursor_execute)
+
+    def recent(self):
+        with self._lock:
+            return list(reversed(self.entries))
+
+    def _before_cursor_execute(self, conn, cursor, statement, parameters, context, executemany):
+        conn.info["query_started"] = timer()
+
+    def _after_cursor_execute(self, conn, cursor, statement, parameters, context, executemany):
+        duration = timer() - conn.info.pop("query_started", timer())
+        if duration < self.threshold:
+            return
+
+        shape = self._parameter_shape(parameters, executemany)
+        self._logger.warn("Slow query ({duration:.0f}ms): {statement} {shape}"
+                          .format(duration=duration * 1000, statement=" ".join(statement.split()), shape=shape))
+
+        plan = None
+        if not executemany and self._should_explain(statement):
+            plan = self._explain(conn, cursor, statement, parameters)
+
+        with self._lock:
+            self.entries.append(dict(timestamp=datetime.utcnow().isoformat() + "Z", duration=duration * 1000,
+                                     statement=statement, parameters=shape, plan=plan))
+
+    def _should_explain(self, statement):
+        words = statement.split(None, 1)
+        if not words or words[0].upper() not in self.EXPLAINABLE:
+            return False
+        now = timer()
+        with self._lock:
+            if now - self._explained_at.get(statement, -self.explain_interval) < self.explain_interval:
+                return False
+            self._explained_at[statement] = now
+        return True
+
+    def _explain(self, conn, cursor, statement, parameters):
+        prefix = "EXPLAIN QUERY PLAN " if conn.dialect.name == "sqlite" else "EXPLAIN "
+        # The plan is explained within the transaction of the caller. On PostgreSQL a failing statement aborts the
+        # whole transaction, so the failure is rolled back to a savepoint.
+        savepoint = conn.dialect.name == "postgresql"
+        explain_cursor = cursor.connection.cursor()
+        try:
+            if savepoint:
+                explain_cursor.execute("SAVEPOINT slow_query_explain")
+            explain_cursor.execute(prefix + statement, parameters)
+            plan = [" ".join(str(column) for column in row) for row in explain_cursor.fetchall()]
+            if savepoint:
+                explain_cursor.execute("RELEASE SAVEPOINT slow_query_explain")
+            return plan
+        except Exception as e:
+            self._logger.debug("Failed to explain slow query: {message}".format(message=str(e)))
+            if savepoint:
+                self._rollback_explain(explain_cursor)
+            return None
+        finally:
+            explain_cursor.close()
+
+    def _rollback_explain(self, cursor):
+        try:
+            cursor.execute("ROLLBACK TO SAVEPOINT slow_query_explain")
+            cursor.execute("RELEASE SAVEPOINT slow_query_explain")
+        except Exception as e:
+            # the savepoint doesn't exist if the connection isn't within a transaction, nothing has been aborted then
+            self._logger.debug("Failed to roll back slow query explain: {message}".format(message=str(e)))
+
+    @staticmethod
+    def _parameter_shape(parameters, executemany):
+        # only the types of the bound parameters are recorded, their values may contain user data
+        def shape(params):
+            if isinstance(params, dict):
+                return dict((key, type(value).__name__) for key, value in params.items())
+            return [type(value).__name__ for value in params]
+
+        if executemany:
+            return dict(rows=len(parameters), row=shape(parameters[0]) if parameters else None)
+        return shape(parameters)
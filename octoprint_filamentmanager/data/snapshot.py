@@ -0,0 +1,207 @@
+# coding=utf-8
+
+__author__ = "Sven Lohrmann <malnvenshorn@gmail.com>"
+__license__ = "GNU Affero General Public License http://www.gnu.org/licenses/agpl.html"
+__copyright__ = "Copyright (C) 2017 Sven Lohrmann - Released under terms of the AGPLv3 License"
+
+import copy
+import json
+import os
+import zlib
+from math import pi as PI
+
+REMAINING_KEYS = ("remaining_weight", "remaining_length", "remaining_percent")
+
+
+class InventorySnapshot(object):
+    """
+    Compact copy of profiles, spools and the selections of this client, persisted as zlib compressed JSON with
+    spools and selections stored column-wise. Provides the same read methods as FilamentManager, so that reads can
+    be served from the snapshot while the database is not available.
+    """
+
+    FORMAT_VERSION = 1
+
+    def __init__(self, profiles, spools, selections):
+        self.profiles = profiles
+        self.spools = spools
+        self.selections = selections
+
+    @classmethod
+    def from_inventory(cls, inventory):
+        return cls(inventory["profiles"], inventory["spools"], inventory["selections"])
+
+    @classmethod
+    def load(cls, path):
+        if not os.path.isfile(path):
+            return None
+        with open(path, "rb") as f:
+            data = json.loads(zlib.decompress(f.read()).decode("utf-8"))
+        if data.get("version") != cls.FORMAT_VERSION:
+            return None
+        return cls(data["profiles"], data["spools"], data["selections"])
+
+    def save(self, path):
+        data = dict(version=self.FORMAT_VERSION, profiles=self.profiles, spools=self.spools,
+                    selections=self.selections)
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(zlib.compress(json.dumps(data, separators=(",", ":")).encode("utf-8")))
+        try:
+            os.rename(tmp_path, path)
+        except OSError:
+            # windows doesn't allow to rename to an existing file
+            os.remove(path)
+            os.rename(tmp_path, path)
+
+    # FilamentManager compatible read methods
+
+    def get_all_profiles(self):
+        return [dict(profile) for profile in self.profiles]
+
+    def get_profile(self, identifier):
+        for profile in self.profiles:
+            if profile["id"] == identifier:
+                return dict(profile)
+        return None
+
+    def get_all_spools(self):
+        profiles = dict((profile["id"], profile) for profile in self.profiles)
+        keys = list(self.spools.keys())
+        spools = []
+        for row in zip(*[self.spools[key] for key in keys]):
+            spool = dict(zip(keys, row))
+            spool["profile"] = dict(profiles.get(spool.pop("profile_id"), dict()))
+            spools.append(with_remaining(spool))
+        return sorted(spools, key=lambda s: s["name"])
+
+    def get_spools(self, material=None, vendor=None, minimum=None, maximum=None, sort="name", descending=False,
+                   limit=None, offset=0):
+        def matches(spool):
+            if material is not None and spool["profile"].get("material") != material:
+                return False
+            if vendor is not None and spool["profile"].get("vendor") != vendor:
+                return False
+            for key, value in (minimum or dict()).items():
+                if spool[key] is None or spool[key] < value:
+                    return False
+            for key, value in (maximum or dict()).items():
+                if spool[key] is None or spool[key] > value:
+                    return False
+            return True
+
+        def sort_key(spool):
+            value = spool[sort] if sort in spool else spool["profile"].get(sort)
+            # unknown amounts are ordered last in both directions, like in FilamentManager.get_spools
+            return (value is None) != descending, value if value is not None else 0
+
+        # the sort is stable also in reverse, spools with the same value stay ordered by id
+        spools = sorted(filter(matches, self.get_all_spools()), key=lambda spool: spool["id"])
+        spools.sort(key=sort_key, reverse=descending)
+        end = offset + limit if limit is not None else None
+        return dict(spools=spools[offset:end], total=len(spools))
+
+    def get_all_spools_normalized(self):
+        profile_ids = set(self.spools["profile_id"])
+        return dict(profiles=self._profiles_by_id(profile_ids), spools=self._with_remaining_columns(self.spools))
+
+    def get_spool(self, identifier):
+        for spool in self.get_all_spools():
+            if spool["id"] == identifier:
+                return spool
+        return None
+
+    def get_spool_by_tag(self, tag):
+        for spool in self.get_all_spools():
+            if spool.get("tag") == tag:
+                return spool
+        return None
+
+    def get_all_selections(self, client_id=None):
+        spools = dict((spool["id"], spool) for spool in self.get_all_spools())
+        selections = []
+        for tool, spool_id in zip(self.selections["tool"], self.selections["spool_id"]):
+            if spool_id in spools:
+                selections.append(dict(tool=tool, client_id=client_id, spool=spools[spool_id]))
+        return selections
+
+    def get_selection(self, identifier, client_id=None):
+        for selection in self.get_all_selections(client_id):
+            if selection["tool"] == identifier:
+                return selection
+        return dict(tool=identifier, spool=None)
+
+    def get_all_selections_normalized(self, client_id=None):
+        spool_ids = set(self.selections["spool_id"])
+        selected = [i for i, spool_id in enumerate(self.spools["id"]) if spool_id in spool_ids]
+        spools = dict((key, [values[i] for i in selected]) for key, values in self.spools.items())
+        return dict(profiles=self._profiles_by_id(set(spools["profile_id"])),
+                    spools=self._with_remaining_columns(spools), selections=self.selections)
+
+    def _with_remaining_columns(self, spools):
+        # the snapshot stores only the spool columns, the remaining amounts are added like in get_all_spools
+        profiles = dict((profile["id"], profile) for profile in self.profiles)
+        columns = dict((key, list(values)) for key, values in spools.items())
+        for key in REMAINING_KEYS:
+            columns[key] = []
+        for i, profile_id in enumerate(spools["profile_id"]):
+            spool = with_remaining(dict(weight=spools["weight"][i], used=spools["used"][i],
+                                        profile=profiles.get(profile_id, dict())))
+            for key in REMAINING_KEYS:
+                columns[key].append(spool[key])
+        return columns
+
+    def _profiles_by_id(self, identifiers):
+        profiles = [dict(profile) for profile in self.profiles if profile["id"] in identifiers]
+        return sorted(profiles, key=lambda p: p["id"])
+
+
+def with_remaining(spool):
+    # same as the remaining amounts calculated by the database
+    profile = spool["profile"]
+    spool["remaining_weight"] = spool["weight"] - spool["used"]
+    weight_per_mm = PI * profile.get("diameter", 0) ** 2 / 4000 * profile.get("density", 0)
+    spool["remaining_length"] = spool["remaining_weight"] / weight_per_mm if weight_per_mm > 0 else None
+    spool["remaining_percent"] = spool["remaining_weight"] * 100 / spool["weight"] if spool["weight"] else None
+    return spool
+
+
+class FrozenDict(dict):
+    """
+    Read-only dict. A deep copy returns a plain dict, which can be modified.
+    """
+
+    def _readonly(self, *args, **kwargs):
+        raise TypeError("'{name}' object is read-only".format(name=type(self).__name__))
+
+    __setitem__ = __delitem__ = clear = pop = popitem = setdefault = update = _readonly
+
+    def __deepcopy__(self, memo):
+        return dict((key, copy.deepcopy(value, memo)) for key, value in self.items())
+
+    def __reduce__(self):
+        return dict, (dict(self),)
+
+
+def freeze(value):
+    if isinstance(value, dict):
+        return FrozenDict((key, freeze(item)) for key, item in value.items())
+    if isinstance(value, list):
+        return tuple(freeze(item) for item in value)
+    return value
+
+
+class InventoryView(object):
+    """
+    Immutable copy of a snapshot for other plugins. Spools and selections are frozen once when the snapshot
+    is replaced, so that reads are plain lookups which can be shared without copying.
+    """
+
+    def __init__(self, snapshot, client_id):
+        spools = [freeze(spool) for spool in snapshot.get_all_spools()]
+        self.spools = dict((spool["id"], spool) for spool in spools)
+        self.selections = tuple(FrozenDict(tool=selection["tool"], spool=self.spools.get(selection["spool"]["id"]))
+                                for selection in snapshot.get_all_selections(client_id))
+        self.remaining = dict((selection["tool"], FrozenDict(weight=selection["spool"]["remaining_weight"],
+                                                             length=selection["spool"]["remaining_length"]))
+                              for selection in self.selections if selection["spool"] is not None)
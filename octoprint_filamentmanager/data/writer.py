@@ -0,0 +1,119 @@
+# coding=utf-8
+
+__author__ = "Sven Lohrmann <malnvenshorn@gmail.com>"
+__license__ = "GNU Affero General Public License http://www.gnu.org/licenses/agpl.html"
+__copyright__ = "Copyright (C) 2017 Sven Lohrmann - Released under terms of the AGPLv3 License"
+
+import time
+from threading import Thread, Event
+
+try:
+    from queue import Queue, Empty
+except ImportError:
+    from Queue import Queue, Empty
+
+
+class WriteTimeoutError(Exception):
+    pass
+
+
+class WriteFuture(object):
+
+    def __init__(self):
+        self._done = Event()
+        self._result = None
+        self._exception = None
+
+    def set_result(self, result):
+        self._result = result
+        self._done.set()
+
+    def set_exception(self, exception):
+        self._exception = exception
+        self._done.set()
+
+    def done(self):
+        return self._done.is_set()
+
+    def result(self, timeout=None):
+        if not self._done.wait(timeout):
+            raise WriteTimeoutError("Write operation did not complete within {timeout}s".format(timeout=timeout))
+        if self._exception is not None:
+            raise self._exception
+        return self._result
+
+
+class GroupCommitWriter(object):
+    """
+    Executes write operations on a dedicated thread. Operations which arrive within the commit window are
+    executed in one transaction, so that a burst of writes only costs a single commit.
+    """
+
+    def __init__(self, transaction, window=0.01, max_batch_size=100):
+        self.transaction = transaction
+        self.window = window
+        self.max_batch_size = max_batch_size
+
+        self._queue = Queue()
+        self.thread = Thread(target=self._run, name="FilamentManagerWriter")
+        self.thread.daemon = True
+        self.thread.start()
+
+    def submit(self, func, *args, **kwargs):
+        future = WriteFuture()
+        self._queue.put((future, func, args, kwargs))
+        return future
+
+    def stop(self, timeout=None):
+        # pending operations are still committed before the thread terminates
+        self._queue.put(None)
+        self.thread.join(timeout)
+
+    def _run(self):
+        stopped = False
+        while not stopped:
+            item = self._queue.get()
+            if item is None:
+                break
+
+            batch = [item]
+            deadline = time.time() + self.window
+            while len(batch) < self.max_batch_size:
+                timeout = deadline - time.time()
+                if timeout <= 0:
+                    break
+                try:
+                    item = self._queue.get(timeout=timeout)
+                except Empty:
+                    break
+                if item is None:
+                    stopped = True
+                    break
+                batch.append(item)
+
+            self._commit(batch)
+
+    def _commit(self, batch):
+        try:
+            with self.transaction():
+                results = [func(*args, **kwargs) for _, func, args, kwargs in batch]
+        except Exception as e:
+            if len(batch) == 1:
+                batch[0][0].set_exception(e)
+            else:
+                # the batch has been rolled back, retry each operation in its own transaction so that only the
+                # failing operation reports an error
+                for item in batch:
+                    self._execute_single(*item)
+        else:
+            for (future, _, _, _), result in zip(batch, results):
+                future.set_result(result)
+
+    def _execute_single(self, future, func, args, kwargs):
+        try:
+            with self.transaction():
+                result = func(*args, **kwargs)
+        except Exception as e:
+            future.set_exception(e)
+        else:
+            future.set_result(result)
@@ -0,0 +1,235 @@
+# coding=utf-8
+from __future__ import absolute_import
+
+__author__ = "Sven Lohrmann <malnvenshorn@gmail.com>"
+__license__ = "GNU Affero General Public License http://www.gnu.org/licenses/agpl.html"
+__copyright__ = "Copyright (C) 2017 Sven Lohrmann - Released under terms of the AGPLv3 License"
+
+import time
+from bisect import bisect_left
+from functools import wraps
+from itertools import count
+from threading import Lock
+
+# monotonic clock with the highest available resolution, python 2 only provides time.time()
+timer = getattr(time, "perf_counter", time.time)
+
+# upper bounds in seconds, from the odometer hook (µs) to database round trips (s)
+DEFAULT_BUCKETS = (0.00001, 0.000025, 0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01,
+                   0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+class Registry(object):
+
+    def __init__(self):
+        self.metrics = list()
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def render(self):
+        # Prometheus text exposition format, version 0.0.4
+        lines = []
+        for metric in self.metrics:
+            lines.append("# HELP {name} {help}".format(name=metric.name, help=metric.help))
+            lines.append("# TYPE {name} {type}".format(name=metric.name, type=metric.type))
+            lines.extend(metric.samples())
+        return "\n".join(lines) + "\n"
+
+
+class Metric(object):
+    """
+    Base class of counters and histograms. Every combination of label values gets its own child, which is created
+    on first use and cached, so that recording a value only costs a dict lookup and an addition.
+    """
+
+    type = None
+
+    def __init__(self, name, help, labelnames=()):
+        self.name = name
+        self.help = help
+        self.labelnames = labelnames
+        self._children = dict()
+        self._lock = Lock()
+        if not labelnames:
+            self._children[()] = self._child()
+
+    def labels(self, *values):
+        child = self._children.get(values)
+        if child is None:
+            with self._lock:
+                child = self._children.setdefault(values, self._child())
+        return child
+
+    def samples(self):
+        lines = []
+        for values, child in sorted(self._children.items()):
+            lines.extend(self._child_samples(values, child))
+        return lines
+
+    def _format_labels(self, values, extra=()):
+        labels = list(zip(self.labelnames, values)) + list(extra)
+        if not labels:
+            return ""
+        return "{" + ",".join('{0}="{1}"'.format(name, self._escape(value)) for name, value in labels) + "}"
+
+    @staticmethod
+    def _escape(value):
+        return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+    def _child(self):
+        raise NotImplementedError()
+
+    def _child_samples(self, values, child):
+        raise NotImplementedError()
+
+
+class Counter(Metric):
+
+    type = "counter"
+
+    class Child(object):
+
+        def __init__(self):
+            self.value = 0
+            self._lock = Lock()
+
+        def inc(self, amount=1):
+            with self._lock:
+                self.value += amount
+
+    def inc(self, amount=1):
+        self._children[()].inc(amount)
+
+    def _child(self):
+        return Counter.Child()
+
+    def _child_samples(self, values, child):
+        return ["{name}{labels} {value}".format(name=self.name, labels=self._format_labels(values), value=child.value)]
+
+
+class Histogram(Metric):
+
+    type = "histogram"
+
+    class Child(object):
+
+        def __init__(self, buckets):
+            self.buckets = buckets
+            # the last slot counts the observations above the largest bucket
+            self.counts = [0] * (len(buckets) + 1)
+            self.sum = 0.0
+            self._lock = Lock()
+
+        def observe(self, value, weight=1):
+            index = bisect_left(self.buckets, value)
+            with self._lock:
+                self.counts[index] += weight
+                self.sum += value * weight
+
+    def __init__(self, name, help, labelnames=(), buckets=DEFAULT_BUCKETS):
+        self.buckets = buckets
+        Metric.__init__(self, name, help, labelnames)
+
+    def observe(self, value):
+        self._children[()].observe(value)
+
+    def time(self, *values):
+        # decorator which observes the duration of every call
+        child = self.labels(*values)
+
+        def decorator(func):
+            @wraps(func)
+            def wrapper(*args, **kwargs):
+                started = timer()
+                try:
+                    return func(*args, **kwargs)
+                finally:
+                    child.observe(timer() - started)
+            return wrapper
+        return decorator
+
+    def sample_time(self, rate):
+        """
+        Decorator which observes the duration of every rate-th call only, weighted by the rate, so that count and sum
+        approximate all calls. Meant for hot paths like the gcode hook, the other calls only increment a counter.
+        """
+        child = self.labels()
+
+        def decorator(func):
+            # next() on a count is atomic, so concurrent callers don't need a lock
+            calls = count()
+
+            @wraps(func)
+            def wrapper(*args, **kwargs):
+                if next(calls) % rate:
+                    return func(*args, **kwargs)
+                started = timer()
+                try:
+                    return func(*args, **kwargs)
+                finally:
+                    child.observe(timer() - started, rate)
+            return wrapper
+        return decorator
+
+    def _child(self):
+        return Histogram.Child(self.buckets)
+
+    def _child_samples(self, values, child):
+        labels = self._format_labels(values)
+        lines = []
+        cumulative = 0
+        for bound, count in zip(self.buckets + (float("inf"),), child.counts):
+            cumulative += count
+            le = "+Inf" if bound == float("inf") else repr(bound)
+            lines.append("{name}_bucket{labels} {value}".format(name=self.name, value=cumulative,
+                                                                 labels=self._format_labels(values, [("le", le)])))
+        lines.append("{name}_sum{labels} {value!r}".format(name=self.name, labels=labels, value=child.sum))
+        lines.append("{name}_count{labels} {value}".format(name=self.name, labels=labels, value=cumulative))
+        return lines
+
+
+class TimedLock(object):
+    """
+    Wraps a lock and observes how long it took to acquire it.
+    """
+
+    def __init__(self, lock, histogram):
+        self._lock = lock
+        self._histogram = histogram
+
+    def acquire(self, *args, **kwargs):
+        started = timer()
+        acquired = self._lock.acquire(*args, **kwargs)
+        self._histogram.observe(timer() - started)
+        return acquired
+
+    def release(self):
+        self._lock.release()
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, *args):
+        self.release()
+
+
+REGISTRY = Registry()
+
+# every sent line passes the hook, so only every ODOMETER_HOOK_SAMPLE_RATE-th call is timed
+ODOMETER_HOOK_SAMPLE_RATE = 100
+ODOMETER_HOOK_SECONDS = REGISTRY.register(
+    Histogram("filamentmanager_odometer_hook_seconds", "Duration of the gcode sent hook, sampled"))
+DB_CALL_SECONDS = REGISTRY.register(
+    Histogram("filamentmanager_db_call_seconds", "Duration of FilamentManager calls", ("method",)))
+DB_CALL_ERRORS = REGISTRY.register(
+    Counter("filamentmanager_db_call_errors_total", "FilamentManager calls which raised an exception", ("method",)))
+DB_LOCK_WAIT_SECONDS = REGISTRY.register(
+    Histogram("filamentmanager_db_lock_wait_seconds", "Time spent waiting for the database connection lock"))
+NOTIFY_DISPATCH_SECONDS = REGISTRY.register(
+    Histogram("filamentmanager_notify_dispatch_seconds",
+              "Time from receiving a database notification until all subscribers have handled it"))
+API_REQUEST_SECONDS = REGISTRY.register(
+    Histogram("filamentmanager_api_request_seconds", "Duration of API requests", ("endpoint", "status")))
@@ -6,18 +6,28 @@ __license__ = "GNU Affero General Public License http://www.gnu.org/licenses/agp
 __copyright__ = "Copyright (C) 2017 Sven Lohrmann - Released under terms of the AGPLv3 License"
 
 import re
+from array import array
+from collections import deque
 
 
 class FilamentOdometer(object):
 
     regexE = re.compile(r'.*E(-?\d+(\.\d+)?)')
     regexT = re.compile(r'^T(\d+)')
+    regexZ = re.compile(r'.*Z(-?\d+(\.\d+)?)')
 
     def __init__(self):
         self.g90_extruder = True
+        self.tracker = None
         self.reset()
 
+    def set_tracker(self, tracker):
+        # optional per layer and per feature breakdown, None disables it
+        self.tracker = tracker
+
     def reset(self):
+        if self.tracker is not None:
+            self.tracker.reset()
         self.relativeMode = False
         self.relativeExtrusion = False
         self.lastExtrusion = [0.0]
@@ -35,6 +45,10 @@ class FilamentOdometer(object):
             return
 
         if gcode == "G1" or gcode == "G0":  # move
+            if self.tracker is not None:
+                z = self._get_float(cmd, self.regexZ)
+                if z is not None:
+                    self.tracker.move_z(z, self.relativeMode)
             e = self._get_float(cmd, self.regexE)
             if e is not None:
                 if self.relativeMode or self.relativeExtrusion:
@@ -42,10 +56,8 @@ class FilamentOdometer(object):
                     pass
                 else:
                     e -= self.lastExtrusion[self.currentTool]
-                self.totalExtrusion[self.currentTool] += e
                 self.lastExtrusion[self.currentTool] += e
-                self.maxExtrusion[self.currentTool] = max(self.maxExtrusion[self.currentTool],
-                                                          self.totalExtrusion[self.currentTool])
+                self._add_extrusion(self.currentTool, e)
         elif gcode == "G90":  # set to absolute positioning
             self.relativeMode = False
             if self.g90_extruder:
@@ -65,12 +77,21 @@ class FilamentOdometer(object):
         elif gcode.startswith("T"):  # select tool
             t = self._get_int(cmd, self.regexT)
             if t is not None:
-                self.currentTool = t
-                if len(self.lastExtrusion) <= self.currentTool:
-                    for i in xrange(len(self.lastExtrusion), self.currentTool + 1):
-                        self.lastExtrusion.append(0.0)
-                        self.totalExtrusion.append(0.0)
-                        self.maxExtrusion.append(0.0)
+                self._select_tool(t)
+
+    def _select_tool(self, tool):
+        self.currentTool = tool
+        if len(self.lastExtrusion) <= self.currentTool:
+            for i in range(len(self.lastExtrusion), self.currentTool + 1):
+                self.lastExtrusion.append(0.0)
+                self.totalExtrusion.append(0.0)
+                self.maxExtrusion.append(0.0)
+
+    def _add_extrusion(self, tool, length):
+        self.totalExtrusion[tool] += length
+        self.maxExtrusion[tool] = max(self.maxExtrusion[tool], self.totalExtrusion[tool])
+        if self.tracker is not None:
+            self.tracker.extrude(tool, length)
 
     def set_g90_extruder(self, flag=True):
         self.g90_extruder = flag
@@ -94,3 +115,175 @@ class FilamentOdometer(object):
             return float(result.group(1))
         else:
             return None
+
+
+class FirmwareOdometer(FilamentOdometer):
+    """
+    Takes the extruded length from the E position reported by the firmware (M114) instead of parsing every move,
+    which also covers firmware retraction and compensated moves. Sent commands are only followed for tool changes,
+    E resets and position requests. Every E reset or tool change starts a new origin, and every request remembers
+    the origin which was valid when it was sent, so that a report is only compared with positions of the same
+    origin. Reports are answered in the order of the requests.
+    """
+
+    regexPosition = re.compile(r'X:-?\d+(?:\.\d+)?\s+Y:-?\d+(?:\.\d+)?\s+Z:(-?\d+(?:\.\d+)?)\s+E:(-?\d+(?:\.\d+)?)')
+
+    def reset(self):
+        FilamentOdometer.reset(self)
+        self.origin = 0
+        # last reported position per origin, None until the first report since the origin is unknown
+        self.positions = {0: None}
+        self.requests = deque()  # (origin, tool) of pending position requests
+
+    def reset_extruded_length(self):
+        FilamentOdometer.reset_extruded_length(self)
+        # the position might have changed while it wasn't tracked, e.g. by manual extrusion during a pause
+        self.requests.clear()
+        self.positions = dict()
+        self._next_origin(None)
+
+    def pending_requests(self):
+        return len(self.requests)
+
+    def parse(self, gcode, cmd):
+        if gcode is None:
+            return
+
+        if gcode == "M114":  # get current position
+            self.requests.append((self.origin, self.currentTool))
+        elif gcode == "G92":  # set position
+            e = self._get_float(cmd, self.regexE)
+            if e is not None:
+                self._next_origin(e)
+        elif gcode.startswith("T"):  # select tool
+            t = self._get_int(cmd, self.regexT)
+            if t is not None:
+                self._select_tool(t)
+                self._next_origin(None)
+
+    def parse_position(self, line):
+        """
+        Applies a position report, returns True if the extruded length has been updated.
+        """
+        match = self.regexPosition.search(line)
+        if match is None:
+            return False
+
+        # unsolicited reports (auto report) belong to the current origin
+        origin, tool = self.requests.popleft() if self.requests else (self.origin, self.currentTool)
+        last = self.positions.get(origin)
+        z, e = float(match.group(1)), float(match.group(2))
+
+        if origin == self.origin or any(request[0] == origin for request in self.requests):
+            self.positions[origin] = e
+        else:
+            # last report of an outdated origin
+            self.positions.pop(origin, None)
+
+        if last is None:
+            return False
+        if self.tracker is not None:
+            self.tracker.move_z(z)
+        self._add_extrusion(tool, e - last)
+        return True
+
+    def _next_origin(self, position):
+        if not any(request[0] == self.origin for request in self.requests):
+            self.positions.pop(self.origin, None)
+        self.origin += 1
+        self.positions[self.origin] = position
+
+
+class ExtrusionTracker(object):
+    """
+    Breaks down the extruded length of a job by layer and by feature type. A new layer starts with the first
+    extrusion at a different height, so that travel moves with z-hop don't count as layers. Per layer values are
+    kept in array('d') buffers, one per tool, which grow geometrically. Once MAX_LAYERS is reached, adjacent layers
+    are merged pairwise, so that memory stays bounded and the series still covers the whole job.
+    """
+
+    INITIAL_CAPACITY = 256
+    MAX_LAYERS = 16384
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.capacity = self.INITIAL_CAPACITY
+        self.layer_z = array("d", [0.0]) * self.capacity
+        self.layer_extrusion = []  # one buffer per tool
+        self.layers = 0  # used slots
+        self.stride = 1  # layers per slot, doubles with every compaction
+        self.layers_in_slot = 0
+        self.z = 0.0
+        self.current_z = None
+        self.feature = None
+        self.features = dict()  # feature type -> extruded length per tool
+
+    def move_z(self, z, relative=False):
+        self.z = self.z + z if relative else z
+
+    def set_feature(self, feature):
+        self.feature = feature
+
+    def extrude(self, tool, length):
+        while len(self.layer_extrusion) <= tool:
+            self.layer_extrusion.append(array("d", [0.0]) * self.capacity)
+
+        if self.current_z is None or abs(self.z - self.current_z) > 1e-4:
+            self._next_layer()
+
+        self.layer_extrusion[tool][self.layers - 1] += length
+
+        if self.feature is not None:
+            per_tool = self.features.get(self.feature)
+            if per_tool is None:
+                per_tool = self.features[self.feature] = array("d")
+            if len(per_tool) <= tool:
+                per_tool.extend([0.0] * (tool + 1 - len(per_tool)))
+            per_tool[tool] += length
+
+    def _next_layer(self):
+        self.current_z = self.z
+        if self.layers > 0 and self.layers_in_slot < self.stride:
+            # merged layers share a slot until it covers stride layers
+            self.layers_in_slot += 1
+            return
+
+        if self.layers == self.capacity:
+            if self.capacity < self.MAX_LAYERS:
+                self._grow()
+            else:
+                self._compact()
+        self.layer_z[self.layers] = self.z
+        self.layers += 1
+        self.layers_in_slot = 1
+
+    def _grow(self):
+        grow_by = min(self.capacity, self.MAX_LAYERS - self.capacity)
+        padding = array("d", [0.0]) * grow_by
+        self.layer_z.extend(padding)
+        for buffer in self.layer_extrusion:
+            buffer.extend(padding)
+        self.capacity += grow_by
+
+    def _compact(self):
+        half = self.layers // 2
+        for i in range(half):
+            self.layer_z[i] = self.layer_z[2 * i]
+            for buffer in self.layer_extrusion:
+                buffer[i] = buffer[2 * i] + buffer[2 * i + 1]
+        for i in range(half, self.layers):
+            self.layer_z[i] = 0.0
+            for buffer in self.layer_extrusion:
+                buffer[i] = 0.0
+        self.layers = half
+        self.stride *= 2
+
+    def totals(self):
+        return [sum(buffer[:self.layers]) for buffer in self.layer_extrusion]
+
+    def to_dict(self):
+        return dict(layers=dict(z=self.layer_z[:self.layers].tolist(), stride=self.stride,
+                                extrusion=[buffer[:self.layers].tolist() for buffer in self.layer_extrusion]),
+                    features=dict((feature, per_tool.tolist()) for feature, per_tool in self.features.items()))
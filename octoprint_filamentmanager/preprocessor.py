@@ -0,0 +1,24 @@
+# coding=utf-8
+from __future__ import absolute_import
+
+__author__ = "Sven Lohrmann <malnvenshorn@gmail.com>"
+__license__ = "GNU Affero General Public License http://www.gnu.org/licenses/agpl.html"
+__copyright__ = "Copyright (C) 2017 Sven Lohrmann - Released under terms of the AGPLv3 License"
+
+from octoprint.filemanager.util import LineProcessorStream
+
+FEATURE_ATCOMMAND = "filamentmanager_feature"
+
+
+class FeatureMarkerStream(LineProcessorStream):
+    """
+    OctoPrint strips comments before sending, so the ;TYPE: comments of the slicer never reach the protocol hooks.
+    This inserts an @-command in front of every feature comment, which is reported by the atcommand hook instead.
+    """
+
+    def process_line(self, line):
+        if line.startswith(b";TYPE:"):
+            feature = line[len(b";TYPE:"):].strip()
+            if feature:
+                return b"@" + FEATURE_ATCOMMAND.encode("ascii") + b" " + feature + b"\n" + line
+        return line
@@ -104,6 +104,9 @@ FilamentManager.prototype.core.bridge = function pluginBridge() {
 FilamentManager.prototype.core.callbacks = function octoprintCallbacks() {
     var self = this;
 
+    // the complete spool list is only needed by the settings, the spool pickers search the backend
+    var settingsShown = false;
+
     self.onStartup = function onStartupCallback() {
         self.viewModels.warning.replaceFilamentView();
     };
@@ -116,22 +119,33 @@ FilamentManager.prototype.core.callbacks = function octoprintCallbacks() {
     };
 
     self.onStartupComplete = function onStartupCompleteCallback() {
-        var requests = [self.viewModels.profiles.requestProfiles, self.viewModels.spools.requestSpools, self.viewModels.selections.requestSelectedSpools];
+        var requests = [self.viewModels.profiles.requestProfiles, self.viewModels.selections.requestSelectedSpools];
 
-        // We chain them because, e.g. selections depends on spools
         Utils.runRequestChain(requests);
     };
 
+    self.onSettingsShown = function onSettingsShownCallback() {
+        settingsShown = true;
+        self.viewModels.spools.requestSpools();
+    };
+
+    self.onSettingsHidden = function onSettingsHiddenCallback() {
+        settingsShown = false;
+    };
+
     self.onDataUpdaterPluginMessage = function onDataUpdaterPluginMessageCallback(plugin, data) {
         if (plugin !== 'filamentmanager') return;
 
         var messageType = data.type;
-        // const messageData = data.data;
+        var messageData = data.data;
         // TODO needs improvement
         if (messageType === 'data_changed') {
             self.viewModels.profiles.requestProfiles();
-            self.viewModels.spools.requestSpools();
+            if (settingsShown) self.viewModels.spools.requestSpools();
             self.viewModels.selections.requestSelectedSpools();
+            self.viewModels.selections.searchSpools();
+        } else if (messageType === 'usage') {
+            self.viewModels.selections.updateUsage(messageData);
         }
     };
 };
@@ -192,6 +206,14 @@ FilamentManager.prototype.core.client = function apiClient() {
         get: function get(id, opts) {
             return OctoPrint.get(spoolUrl(id), opts);
         },
+        search: function search(q) {
+            var limit = arguments.length > 1 && arguments[1] !== undefined ? arguments[1] : 20;
+            var offset = arguments.length > 2 && arguments[2] !== undefined ? arguments[2] : 0;
+            var opts = arguments[3];
+
+            var query = { q: q, limit: limit, offset: offset };
+            return OctoPrint.getWithQuery(spoolUrl('search'), query, opts);
+        },
         add: function add(spool, opts) {
             var data = { spool: spool };
             return OctoPrint.postJson(spoolUrl(), data, opts);
@@ -608,7 +630,7 @@ FilamentManager.prototype.viewModels.profiles = function profilesViewModel() {
         });
     };
 };
-/* global FilamentManager ko gettext PNotify */
+/* global FilamentManager ko gettext PNotify $ */
 
 FilamentManager.prototype.viewModels.selections = function selectedSpoolsViewModel() {
     var self = this.viewModels.selections;
@@ -650,6 +672,59 @@ FilamentManager.prototype.viewModels.selections = function selectedSpoolsViewMod
 
     self.setSubscriptions = function subscribeToProfileDataObservable() {
         settingsViewModel.printerProfiles.currentProfileData.subscribe(self.setArraySize);
+        self.spoolQuery.subscribe(function () {
+            self.searchSpools();
+        });
+    };
+
+    // spools offered by the pickers, searched in the backend as the user types instead of loading all spools
+    self.SEARCH_LIMIT = 20;
+
+    self.spoolQuery = ko.observable('').extend({ rateLimit: { timeout: 300, method: 'notifyWhenChangesStop' } });
+    self.foundSpools = ko.observableArray([]);
+    self.foundTotal = ko.observable(0);
+
+    self.spoolOptions = ko.pureComputed(function () {
+        // the selected spools are always offered, otherwise the value bindings would lose their selection
+        var options = self.selectedSpools().filter(function (spool) {
+            return spool !== undefined;
+        });
+        var ids = options.map(function (spool) {
+            return spool.id;
+        });
+        self.foundSpools().forEach(function (spool) {
+            if (ids.indexOf(spool.id) === -1) {
+                options.push(spool);
+                ids.push(spool.id);
+            }
+        });
+        return options;
+    });
+
+    self.hasMoreSpools = ko.pureComputed(function () {
+        return self.foundSpools().length < self.foundTotal();
+    });
+
+    self.searchSpools = function searchSpoolsInBackend() {
+        var offset = arguments.length > 0 && arguments[0] !== undefined ? arguments[0] : 0;
+
+        var query = self.spoolQuery().trim();
+        if (!query) {
+            self.foundSpools([]);
+            self.foundTotal(0);
+            return $.Deferred().resolve();
+        }
+
+        return api.spool.search(query, self.SEARCH_LIMIT, offset).done(function (response) {
+            // ignore responses of queries the user has already typed over
+            if (query !== self.spoolQuery().trim()) return;
+            self.foundSpools(offset === 0 ? response.spools : self.foundSpools().concat(response.spools));
+            self.foundTotal(response.total);
+        });
+    };
+
+    self.searchMoreSpools = function searchNextPageOfSpoolsInBackend() {
+        self.searchSpools(self.foundSpools().length);
     };
 
     self.requestInProgress = ko.observable(false);
@@ -700,6 +775,22 @@ FilamentManager.prototype.viewModels.selections = function selectedSpoolsViewMod
             self.selectedSpools.valueHasMutated(); // notifies observers
         }
     };
+
+    // live usage of each tool while printing, published by the backend at most once per usage interval
+    self.usage = ko.observableArray([]);
+
+    self.updateUsage = function updateUsageOfSelectedSpools(data) {
+        self.usage(data !== null ? data.tools : []);
+    };
+
+    self.usageText = function formatUsageOfTool(usage) {
+        if (usage.remaining_weight === null) {
+            return (usage.length / 1000).toFixed(1) + 'm ' + gettext('used');
+        }
+        var text = usage.remaining_weight.toFixed(0) + 'g';
+        if (usage.remaining_length !== null) text += ' / ' + (usage.remaining_length / 1000).toFixed(1) + 'm';
+        return text + ' ' + gettext('left');
+    };
 };
 /* global FilamentManager ItemListHelper ko Utils $ PNotify gettext showConfirmationDialog */
 
@@ -730,8 +821,8 @@ FilamentManager.prototype.viewModels.spools = function spoolsViewModel() {
         },
         remaining: function remaining(a, b) {
             // sorts descending
-            var ra = parseFloat(a.weight) - parseFloat(a.used);
-            var rb = parseFloat(b.weight) - parseFloat(b.used);
+            var ra = a.remaining_weight;
+            var rb = b.remaining_weight;
             if (ra > rb) return -1;
             if (ra < rb) return 1;
             return 0;
@@ -754,7 +845,9 @@ FilamentManager.prototype.viewModels.spools = function spoolsViewModel() {
             cost: 20,
             weight: 1000,
             used: 0,
+            remaining_weight: 1000,
             temp_offset: 0,
+            tag: '',
             profile: {
                 id: profilesViewModel.allProfiles().length > 0 ? profilesViewModel.allProfiles()[0].id : undefined
             }
@@ -769,6 +862,7 @@ FilamentManager.prototype.viewModels.spools = function spoolsViewModel() {
         totalWeight: ko.observable(),
         remaining: ko.observable(),
         temp_offset: ko.observable(),
+        tag: ko.observable(),
         isNew: ko.observable(true)
     };
 
@@ -785,8 +879,9 @@ FilamentManager.prototype.viewModels.spools = function spoolsViewModel() {
         self.loadedSpool.profile(data.profile.id);
         self.loadedSpool.totalWeight(data.weight);
         self.loadedSpool.cost(data.cost);
-        self.loadedSpool.remaining(data.weight - data.used);
+        self.loadedSpool.remaining(data.remaining_weight);
         self.loadedSpool.temp_offset(data.temp_offset);
+        self.loadedSpool.tag(data.tag || '');
     };
 
     self.toSpoolData = function getLoadedProfileAsJSObject() {
@@ -801,6 +896,7 @@ FilamentManager.prototype.viewModels.spools = function spoolsViewModel() {
             weight: totalWeight,
             used: totalWeight - remaining,
             temp_offset: self.loadedSpool.temp_offset(),
+            tag: self.loadedSpool.tag() || null,
             profile: {
                 id: self.loadedSpool.profile()
             }
@@ -999,7 +1095,7 @@ FilamentManager.prototype.viewModels.warning = function insufficientFilamentWarn
 
 
                 var requiredFilament = calculateWeight(length, diameter, density);
-                var remainingFilament = spoolData[toolID].weight - spoolData[toolID].used;
+                var remainingFilament = spoolData[toolID].remaining_weight;
 
                 filament[i].data().weight = requiredFilament;
 
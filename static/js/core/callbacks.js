@@ -3,6 +3,9 @@
 FilamentManager.prototype.core.callbacks = function octoprintCallbacks() {
     const self = this;
 
+    // the complete spool list is only needed by the settings, the spool pickers search the backend
+    let settingsShown = false;
+
     self.onStartup = function onStartupCallback() {
         self.viewModels.warning.replaceFilamentView();
     };
@@ -17,24 +20,34 @@ FilamentManager.prototype.core.callbacks = function octoprintCallbacks() {
     self.onStartupComplete = function onStartupCompleteCallback() {
         const requests = [
             self.viewModels.profiles.requestProfiles,
-            self.viewModels.spools.requestSpools,
             self.viewModels.selections.requestSelectedSpools,
         ];
 
-        // We chain them because, e.g. selections depends on spools
         Utils.runRequestChain(requests);
     };
 
+    self.onSettingsShown = function onSettingsShownCallback() {
+        settingsShown = true;
+        self.viewModels.spools.requestSpools();
+    };
+
+    self.onSettingsHidden = function onSettingsHiddenCallback() {
+        settingsShown = false;
+    };
+
     self.onDataUpdaterPluginMessage = function onDataUpdaterPluginMessageCallback(plugin, data) {
         if (plugin !== 'filamentmanager') return;
 
         const messageType = data.type;
-        // const messageData = data.data;
+        const messageData = data.data;
         // TODO needs improvement
         if (messageType === 'data_changed') {
             self.viewModels.profiles.requestProfiles();
-            self.viewModels.spools.requestSpools();
+            if (settingsShown) self.viewModels.spools.requestSpools();
             self.viewModels.selections.requestSelectedSpools();
+            self.viewModels.selections.searchSpools();
+        } else if (messageType === 'usage') {
+            self.viewModels.selections.updateUsage(messageData);
         }
     };
 };
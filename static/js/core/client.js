@@ -55,6 +55,11 @@ FilamentManager.prototype.core.client = function apiClient() {
             return OctoPrint.get(spoolUrl(id), opts);
         },
 
+        search(q, limit = 20, offset = 0, opts) {
+            const query = { q, limit, offset };
+            return OctoPrint.getWithQuery(spoolUrl('search'), query, opts);
+        },
+
         add(spool, opts) {
             const data = { spool };
             return OctoPrint.postJson(spoolUrl(), data, opts);
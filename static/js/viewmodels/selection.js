@@ -1,4 +1,4 @@
-/* global FilamentManager ko gettext PNotify */
+/* global FilamentManager ko gettext PNotify $ */
 
 FilamentManager.prototype.viewModels.selections = function selectedSpoolsViewModel() {
     const self = this.viewModels.selections;
@@ -39,6 +39,50 @@ FilamentManager.prototype.viewModels.selections = function selectedSpoolsViewMod
 
     self.setSubscriptions = function subscribeToProfileDataObservable() {
         settingsViewModel.printerProfiles.currentProfileData.subscribe(self.setArraySize);
+        self.spoolQuery.subscribe(() => { self.searchSpools(); });
+    };
+
+    // spools offered by the pickers, searched in the backend as the user types instead of loading all spools
+    self.SEARCH_LIMIT = 20;
+
+    self.spoolQuery = ko.observable('').extend({ rateLimit: { timeout: 300, method: 'notifyWhenChangesStop' } });
+    self.foundSpools = ko.observableArray([]);
+    self.foundTotal = ko.observable(0);
+
+    self.spoolOptions = ko.pureComputed(() => {
+        // the selected spools are always offered, otherwise the value bindings would lose their selection
+        const options = self.selectedSpools().filter(spool => spool !== undefined);
+        const ids = options.map(spool => spool.id);
+        self.foundSpools().forEach((spool) => {
+            if (ids.indexOf(spool.id) === -1) {
+                options.push(spool);
+                ids.push(spool.id);
+            }
+        });
+        return options;
+    });
+
+    self.hasMoreSpools = ko.pureComputed(() => self.foundSpools().length < self.foundTotal());
+
+    self.searchSpools = function searchSpoolsInBackend(offset = 0) {
+        const query = self.spoolQuery().trim();
+        if (!query) {
+            self.foundSpools([]);
+            self.foundTotal(0);
+            return $.Deferred().resolve();
+        }
+
+        return api.spool.search(query, self.SEARCH_LIMIT, offset)
+            .done((response) => {
+                // ignore responses of queries the user has already typed over
+                if (query !== self.spoolQuery().trim()) return;
+                self.foundSpools(offset === 0 ? response.spools : self.foundSpools().concat(response.spools));
+                self.foundTotal(response.total);
+            });
+    };
+
+    self.searchMoreSpools = function searchNextPageOfSpoolsInBackend() {
+        self.searchSpools(self.foundSpools().length);
     };
 
     self.requestInProgress = ko.observable(false);
@@ -88,4 +132,20 @@ FilamentManager.prototype.viewModels.selections = function selectedSpoolsViewMod
             self.selectedSpools.valueHasMutated(); // notifies observers
         }
     };
+
+    // live usage of each tool while printing, published by the backend at most once per usage interval
+    self.usage = ko.observableArray([]);
+
+    self.updateUsage = function updateUsageOfSelectedSpools(data) {
+        self.usage(data !== null ? data.tools : []);
+    };
+
+    self.usageText = function formatUsageOfTool(usage) {
+        if (usage.remaining_weight === null) {
+            return `${(usage.length / 1000).toFixed(1)}m ${gettext('used')}`;
+        }
+        let text = `${usage.remaining_weight.toFixed(0)}g`;
+        if (usage.remaining_length !== null) text += ` / ${(usage.remaining_length / 1000).toFixed(1)}m`;
+        return `${text} ${gettext('left')}`;
+    };
 };
@@ -29,8 +29,8 @@ FilamentManager.prototype.viewModels.spools = function spoolsViewModel() {
             },
             remaining(a, b) {
                 // sorts descending
-                const ra = parseFloat(a.weight) - parseFloat(a.used);
-                const rb = parseFloat(b.weight) - parseFloat(b.used);
+                const ra = a.remaining_weight;
+                const rb = b.remaining_weight;
                 if (ra > rb) return -1;
                 if (ra < rb) return 1;
                 return 0;
@@ -55,7 +55,9 @@ FilamentManager.prototype.viewModels.spools = function spoolsViewModel() {
             cost: 20,
             weight: 1000,
             used: 0,
+            remaining_weight: 1000,
             temp_offset: 0,
+            tag: '',
             profile: {
                 id: profilesViewModel.allProfiles().length > 0 ? profilesViewModel.allProfiles()[0].id : undefined,
             },
@@ -70,6 +72,7 @@ FilamentManager.prototype.viewModels.spools = function spoolsViewModel() {
         totalWeight: ko.observable(),
         remaining: ko.observable(),
         temp_offset: ko.observable(),
+        tag: ko.observable(),
         isNew: ko.observable(true),
     };
 
@@ -82,8 +85,9 @@ FilamentManager.prototype.viewModels.spools = function spoolsViewModel() {
         self.loadedSpool.profile(data.profile.id);
         self.loadedSpool.totalWeight(data.weight);
         self.loadedSpool.cost(data.cost);
-        self.loadedSpool.remaining(data.weight - data.used);
+        self.loadedSpool.remaining(data.remaining_weight);
         self.loadedSpool.temp_offset(data.temp_offset);
+        self.loadedSpool.tag(data.tag || '');
     };
 
     self.toSpoolData = function getLoadedProfileAsJSObject() {
@@ -98,6 +102,7 @@ FilamentManager.prototype.viewModels.spools = function spoolsViewModel() {
             weight: totalWeight,
             used: totalWeight - remaining,
             temp_offset: self.loadedSpool.temp_offset(),
+            tag: self.loadedSpool.tag() || null,
             profile: {
                 id: self.loadedSpool.profile(),
             },
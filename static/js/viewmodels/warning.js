@@ -79,7 +79,7 @@ FilamentManager.prototype.viewModels.warning = function insufficientFilamentWarn
                 const { diameter, density } = spoolData[toolID].profile;
 
                 const requiredFilament = calculateWeight(length, diameter, density);
-                const remainingFilament = spoolData[toolID].weight - spoolData[toolID].used;
+                const remainingFilament = spoolData[toolID].remaining_weight;
 
                 filament[i].data().weight = requiredFilament;
 